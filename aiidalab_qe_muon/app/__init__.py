@@ -1,8 +1,5 @@
-from aiidalab_qe_muon.app.settings import Setting
-from aiidalab_qe_muon.app.structure import ImportMagnetism
-from aiidalab_qe_muon.app.workchain import workchain_and_builder
-from aiidalab_qe_muon.app.result import Result
-from aiidalab_qe_muon.app.codes import pp_code
+from collections.abc import Mapping
+from importlib import import_module
 
 from aiidalab_qe.common.panel import OutlinePanel
 
@@ -10,11 +7,42 @@ from aiidalab_qe.common.panel import OutlinePanel
 class Outline(OutlinePanel):
     title = "Muon spectroscopy"
 
-property ={
-"outline": Outline,
-"importer":ImportMagnetism,
-"setting": Setting,
-"workchain": workchain_and_builder,
-"result": Result,
-"code": {"pp_code": pp_code},
-}
\ No newline at end of file
+
+class LazyProperty(Mapping):
+    """
+    Read-only mapping for the plugin registration, in which the values given as
+    "module:attribute" strings are imported only the first time they are accessed.
+    The `aiidalab_qe.properties` entry point is loaded at every QE app start, so the
+    panels (and the heavy modules they import) are loaded only when needed.
+    """
+
+    def __init__(self, entries):
+        self._entries = dict(entries)
+        self._loaded = {}
+
+    def __getitem__(self, key):
+        if key not in self._loaded:
+            entry = self._entries[key]
+            if isinstance(entry, str):
+                module, _, attribute = entry.partition(":")
+                entry = getattr(import_module(module), attribute)
+            self._loaded[key] = entry
+        return self._loaded[key]
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+property = LazyProperty(
+    {
+        "outline": Outline,
+        "importer": "aiidalab_qe_muon.app.structure:ImportMagnetism",
+        "setting": "aiidalab_qe_muon.app.settings:Setting",
+        "workchain": "aiidalab_qe_muon.app.workchain:workchain_and_builder",
+        "result": "aiidalab_qe_muon.app.result:Result",
+        "code": LazyProperty({"pp_code": "aiidalab_qe_muon.app.codes:pp_code"}),
+    }
+)
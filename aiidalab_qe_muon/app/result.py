@@ -8,86 +8,156 @@ from aiidalab_qe.common.panel import ResultPanel
 import ipywidgets as ipw
 
 from .utils_results import (
-    produce_muonic_dataframe,
+    MuonResults,
     produce_collective_unit_cell,
+    compute_sites_second_moments,
+    results_to_arrays,
+    results_from_arrays,
     SummaryMuonStructureBarWidget,
-    SingleMuonStructureBarWidget
+    SingleMuonStructureBarWidget,
+    ReclusteringWidget,
+    pruned_sites,
 )
+from aiidalab_qe_muon.utils.cache import get_result_cache
 
 from aiida import orm
 
+
 class Result(ResultPanel):
 
     title = "Muon spectroscopy"
     workchain_label = "muonic"
 
+    def _load_results(self, findmuon_output_node):
+        """
+        Read the ``MuonResults`` (with the second moments) and the unit cell with all the
+        muon sites from the results cache, keyed by the uuid of the `unique_sites` output;
+        compute and store them if missing.
+        """
+        cache = get_result_cache()
+        key = findmuon_output_node.unique_sites.uuid
+        cached = cache.get(key)
+        if cached is not None:
+            return results_from_arrays(cached)
+
+        results = MuonResults.from_findmuon(findmuon_output_node)
+        summarized_unit_cell = produce_collective_unit_cell(
+            findmuon_output_node=findmuon_output_node
+        )
+        if summarized_unit_cell is None:
+            return results, summarized_unit_cell
+
+        results.second_moment = compute_sites_second_moments(results)
+        cache.set(key, results_to_arrays(results, summarized_unit_cell))
+        return results, summarized_unit_cell
+
+    def _recompute(self, _=None):
+        """Discard the cached results of the run, then compute and show them again."""
+        findmuon = self.node.outputs.muonic.findmuon
+        get_result_cache().invalidate(findmuon.unique_sites.uuid)
+        self._update_view()
+
     def _update_view(self):
-        
-        if "muonic" in self.node.outputs: 
+
+        if "muonic" in self.node.outputs:
             if "findmuon" in self.node.outputs.muonic:
-                
-                dataframe = produce_muonic_dataframe(findmuon_output_node=self.node.outputs.muonic.findmuon)
-                summarized_unit_cell = produce_collective_unit_cell(findmuon_output_node=self.node.outputs.muonic.findmuon)
 
-                if dataframe is not None and summarized_unit_cell is not None:
-                    first_index = dataframe.columns[0]  #<=== lowest energy unique site.
-                    
+                findmuon = self.node.outputs.muonic.findmuon
+                results, summarized_unit_cell = self._load_results(findmuon)
+
+                if len(results) and summarized_unit_cell is not None:
+                    # lowest energy unique site.
+                    first_index = results.labels[0].item()
+
                     childrens = [
-                        SummaryMuonStructureBarWidget(orm.StructureData(pymatgen=summarized_unit_cell), df=dataframe,tags=summarized_unit_cell.tags),
-                        SingleMuonStructureBarWidget(dataframe,first_index)]
+                        SummaryMuonStructureBarWidget(
+                            orm.StructureData(pymatgen=summarized_unit_cell),
+                            results=results,
+                            tags=summarized_unit_cell.tags,
+                            # the relaxed sites are sorted by energy.
+                            pruned=pruned_sites(findmuon, results.energy[0]),
+                        ),
+                        SingleMuonStructureBarWidget(results, first_index),
+                    ]
 
                     # Create the summary button
                     summary_button = ipw.Button(
-                        description='Summary of all unique muon sites',
-                        disabled=False
+                        description="Summary of all unique muon sites", disabled=False
                     )
                     summary_button.layout.width = "300px"
 
                     # Function to react to button click
                     def _show_summary(a):
-                        muon_tab_results.children = [ipw.HBox([ipw.HTML("Select view mode for muonic outputs:"),
-                                                summary_button,
-                                                single_button]),childrens[0]]
-                        
-                        #hard coded selection of the button.
-                        #single_button.disabled=False
-                        #summary_button.disabled=True
-                        single_button.style.button_color="white"
-                        summary_button.style.button_color="lightgray"
+                        muon_tab_results.children = [
+                            ipw.HBox(
+                                [
+                                    ipw.HTML("Select view mode for muonic outputs:"),
+                                    summary_button,
+                                    single_button,
+                                ]
+                            ),
+                            childrens[0],
+                        ]
+
+                        # hard coded selection of the button.
+                        # single_button.disabled=False
+                        # summary_button.disabled=True
+                        single_button.style.button_color = "white"
+                        summary_button.style.button_color = "lightgray"
+
                     summary_button.on_click(_show_summary)
 
                     # Create the single muon button
                     single_button = ipw.Button(
-                        description='Single muon site',
-                        disabled=False
+                        description="Single muon site", disabled=False
                     )
                     single_button.layout.width = "300px"
 
                     # Function to react to button click
                     def _show_single(b):
-                        muon_tab_results.children = [ipw.HBox([ipw.HTML("Select view mode for muonic outputs:"),
-                                                summary_button,
-                                                single_button]),childrens[1]]
-                        
-                        #hard coded selection of the button.
-                        #single_button.disabled=True
-                        #summary_button.disabled=False
-                        single_button.style.button_color="lightgray"
-                        summary_button.style.button_color="white"
+                        muon_tab_results.children = [
+                            ipw.HBox(
+                                [
+                                    ipw.HTML("Select view mode for muonic outputs:"),
+                                    summary_button,
+                                    single_button,
+                                ]
+                            ),
+                            childrens[1],
+                        ]
+
+                        # hard coded selection of the button.
+                        # single_button.disabled=True
+                        # summary_button.disabled=False
+                        single_button.style.button_color = "lightgray"
+                        summary_button.style.button_color = "white"
+
                     single_button.on_click(_show_single)
-                    
-                    #tab widget
+
+                    # tab widget
                     muon_tab_results = ipw.VBox(
-                                children=[ipw.HBox([
+                        children=[
+                            ipw.HBox(
+                                [
                                     ipw.HTML("Select view mode for muonic outputs:"),
                                     summary_button,
-                                    single_button]),]
-                                    #childrens[0]]
-                        #layout=ipw.Layout(min_height="250px"),
+                                    single_button,
+                                ]
+                            ),
+                        ]
+                        # childrens[0]]
+                        # layout=ipw.Layout(min_height="250px"),
                     )
-                    
-                    self.children=[muon_tab_results]
-                    
-                
-                
-                
+
+                    recompute_button = ipw.Button(
+                        description="Recompute the results",
+                        tooltip="Discard the cached results and compute them again",
+                    )
+                    recompute_button.layout.width = "300px"
+                    recompute_button.on_click(self._recompute)
+
+                    self.children = [
+                        muon_tab_results,
+                        ReclusteringWidget(findmuon),
+                        recompute_button,
+                    ]
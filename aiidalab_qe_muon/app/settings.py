@@ -10,12 +10,25 @@ import ipywidgets as ipw
 from aiida import orm
 import traitlets as tl
 import numpy as np
-from aiida_quantumespresso.calculations.functions.create_kpoints_from_distance import (
-    create_kpoints_from_distance,
-)
 from aiidalab_qe.common.panel import Panel
 from ase.build import make_supercell
-from aiida_muon.workflows.find_muon import gensup, niche_add_impurities
+from aiida.manage import get_manager
+
+from aiidalab_qe_muon.utils.background import DebouncedTask
+from aiidalab_qe_muon.utils.cost import (
+    calibrate_seconds_per_unit,
+    estimate_cost,
+    format_cost,
+    pseudo_family_info,
+)
+from aiidalab_qe_muon.utils.kmesh import kpoints_mesh
+from aiidalab_qe_muon.utils.supercells import (
+    estimate_number_of_supercells,
+    inequivalent_candidate_positions,
+    minimal_supercell,
+    number_of_supercells,
+    shortest_image_distance,
+)
 
 
 class Setting(Panel):
@@ -86,41 +99,36 @@ class Setting(Panel):
             value="moderate",
         )
 
-        # start Supercell
-        self.supercell = [1, 1, 1]
+        # start Supercell: full 3x3 matrix, the rows give the supercell vectors in units of the unit cell ones.
+        self.supercell = np.eye(3, dtype=int).tolist()
+        self._updating_supercell = False
 
         def change_supercell(_=None):
-            self.supercell = [
-                self._sc_x.value,
-                self._sc_y.value,
-                self._sc_z.value,
-            ]
+            if self._updating_supercell:
+                return
+            self.supercell = [[elem.value for elem in row] for row in self._sc_matrix]
             self._display_mesh()
             self._write_html_supercell()
 
-        for elem in ["x", "y", "z"]:
-            setattr(
-                self,
-                "_sc_" + elem,
-                ipw.BoundedIntText(
-                    value=1, min=1, layout={"width": "40px"}, disabled=True
-                ),
-            )
+        self._sc_matrix = [
+            [
+                ipw.IntText(value=int(i == j), layout={"width": "45px"}, disabled=True)
+                for j in range(3)
+            ]
+            for i in range(3)
+        ]
 
-        for elem in [self._sc_x, self._sc_y, self._sc_z]:
-            elem.observe(change_supercell, names="value")
+        for row in self._sc_matrix:
+            for elem in row:
+                elem.observe(change_supercell, names="value")
 
         self.supercell_selector = ipw.HBox(
             children=[
                 ipw.HTML(
-                    description="Supercell size:",
+                    description="Supercell matrix:",
                     style={"description_width": "initial"},
-                )
-            ]
-            + [
-                self._sc_x,
-                self._sc_y,
-                self._sc_z,
+                ),
+                ipw.VBox([ipw.HBox(row) for row in self._sc_matrix]),
             ],
         )
 
@@ -143,8 +151,18 @@ class Setting(Panel):
             disabled=True,
             width="500px",
         )
-        # supercell hint (9A lattice params)
+        # supercell hint: smallest supercell with the muon at least min_distance from its images.
         self.supercell_hint_button.on_click(self._suggest_supercell)
+        self._supercell_hint = DebouncedTask()
+        self.min_image_distance = ipw.BoundedFloatText(
+            min=1.0,
+            step=0.5,
+            value=9.0,
+            description="Min. muon-image distance (Å):",
+            disabled=True,
+            style={"description_width": "initial"},
+            layout={"width": "260px"},
+        )
 
         self.supercell_html = ipw.HTML(display="none")
 
@@ -155,6 +173,7 @@ class Setting(Panel):
                         self.supercell_label,
                         self.compute_supercell_,
                         self.supercell_hint_button,
+                        self.min_image_distance,
                         self.supercell_selector,
                     ],
                     layout=ipw.Layout(justify_content="flex-start"),
@@ -239,8 +258,147 @@ class Setting(Panel):
         )
         self.mu_spacing_.observe(self._estimate_supercells, "value")
         self.number_of_supercells = ipw.HTML()
+        self._supercells_estimate = DebouncedTask()
         # end mu spacing.
 
+        # start relaxation driver: FindMuonWorkChain, or candidates generated, pruned and relaxed by ImplantMuonWorkChain.
+        self.relax_driver_description = ipw.HTML(
+            """<div style="line-height: 140%; padding-top: 5px; padding-bottom: 5px">
+            <h5><b>Relaxation of the candidate sites</b></h5>
+            The candidate sites can be relaxed by the FindMuonWorkChain, or directly by this app, which relaxes
+            fewer supercells (symmetry-equivalent candidates are skipped). Both compute the dipolar and contact
+            hyperfine fields for magnetic systems.</div>"""
+        )
+        self.relax_driver_ = ipw.ToggleButtons(
+            options=[
+                ("FindMuonWorkChain", "findmuon"),
+                ("Pruned relaxations", "sites"),
+            ],
+            value="findmuon",
+        )
+        self.prune_symmetry_ = ipw.Checkbox(
+            description="Relax only one candidate per symmetry orbit of the host",
+            indent=False,
+            value=True,
+        )
+        self.max_concurrent_ = ipw.BoundedIntText(
+            min=0,
+            max=10000,
+            value=10,
+            description="Maximum concurrent relaxations (0: no limit):",
+            style={"description_width": "initial"},
+        )
+        self.prune_energy_ = ipw.BoundedFloatText(
+            min=0.0,
+            step=0.1,
+            value=0.0,
+            description="Prune the relaxations ΔE (eV) above the best site (0: never):",
+            style={"description_width": "initial"},
+        )
+        self.prune_steps_ = ipw.BoundedIntText(
+            min=1,
+            max=1000,
+            value=5,
+            description="after ionic steps:",
+            style={"description_width": "initial"},
+        )
+        # two-stage screening: low-precision relaxation of all the candidates, then full precision for the distinct low-energy ones.
+        self.screening_ = ipw.Checkbox(
+            description="Two-stage screening: low-precision relaxations first, then only the distinct low-energy sites",
+            indent=False,
+            value=False,
+        )
+        self.screening_cutoff_scale_ = ipw.BoundedFloatText(
+            min=0.1,
+            max=1.0,
+            step=0.05,
+            value=0.6,
+            description="Stage 1: cutoff scale:",
+            style={"description_width": "initial"},
+        )
+        self.screening_kpoints_distance_ = ipw.BoundedFloatText(
+            min=0.0,
+            step=0.05,
+            value=0.0,
+            description="k-points distance (1/Å, 0: Γ only):",
+            style={"description_width": "initial"},
+        )
+        self.screening_forc_conv_thr_ = ipw.BoundedFloatText(
+            min=1e-5,
+            max=1.0,
+            step=1e-3,
+            value=1e-2,
+            description="force threshold (Ry/bohr):",
+            style={"description_width": "initial"},
+        )
+        self.screening_energy_window_ = ipw.BoundedFloatText(
+            min=0.0,
+            step=0.1,
+            value=1.0,
+            description="Stage 2: relax the distinct sites within (eV) of the best one:",
+            style={"description_width": "initial"},
+        )
+        self.screening_options = ipw.VBox(
+            [
+                ipw.HBox(
+                    [
+                        self.screening_cutoff_scale_,
+                        self.screening_kpoints_distance_,
+                        self.screening_forc_conv_thr_,
+                    ]
+                ),
+                self.screening_energy_window_,
+            ]
+        )
+        self.screening_options.layout.display = "none"
+        self.screening_.observe(self._display_screening_options, "value")
+
+        self.reuse_relaxations_ = ipw.Checkbox(
+            description="Reuse the identical relaxations already finished in this profile",
+            indent=False,
+            value=True,
+        )
+        self.pristine_density_ = ipw.Checkbox(
+            description="Start the relaxations from the density of the pristine supercell",
+            indent=False,
+            value=False,
+        )
+        self.sites_options = ipw.VBox(
+            [
+                self.prune_symmetry_,
+                self.reuse_relaxations_,
+                self.pristine_density_,
+                self.max_concurrent_,
+                ipw.HBox([self.prune_energy_, self.prune_steps_]),
+                self.screening_,
+                self.screening_options,
+            ]
+        )
+        self.sites_options.layout.display = "none"
+        self.relax_driver_.observe(self._display_sites_options, "value")
+        self.relax_driver_.observe(self._estimate_supercells, "value")
+        self.prune_symmetry_.observe(self._estimate_supercells, "value")
+        # end relaxation driver.
+
+        # start cost estimate: updated live in a worker thread, the pseudopotentials info is cached per family and structure.
+        self.cost_estimate = ipw.HTML()
+        self._pseudo_info = {}
+        self._minimal_supercells = {}
+        self._inequivalent_candidates = {}
+        self._cost_estimate = DebouncedTask()
+        for widget in [
+            self.compute_supercell_,
+            self.hubbard_,
+            self.spin_pol_,
+            self.charged_muon_,
+            self.pseudo_choice_,
+            self.relax_driver_,
+            self.prune_symmetry_,
+            self.min_image_distance,
+        ]:
+            widget.observe(self._estimate_cost, "value")
+        # end cost estimate.
+
         # start TEMPORARY magnetic moments settings. this should be in the structure creation.
         # self.sites_widget = SitesWidgets(self)
         self.moments = ipw.HTML()
@@ -267,12 +425,16 @@ class Setting(Panel):
             ipw.HBox([self.kpoints_distance_, self.mesh_grid]),
             self.mu_spacing_description,
             ipw.HBox([self.mu_spacing_, self.number_of_supercells]),
+            self.relax_driver_description,
+            self.relax_driver_,
+            self.sites_options,
             ipw.VBox(
                 [
                     ipw.HBox([self.pseudo_label, self.pseudo_choice_]),
                     self.warning_pseudo_widget,
                 ]
             ),
+            self.cost_estimate,
             self.moments,
         ]
         super().__init__(**kwargs)
@@ -298,81 +460,104 @@ class Setting(Panel):
             self.warning_pseudo_widget.layout.display = "none"
 
     def _compute_supercell(self, change):
-        for elem in [self._sc_x, self._sc_y, self._sc_z]:
-            elem.disabled = change["new"]
+        for row in self._sc_matrix:
+            for elem in row:
+                elem.disabled = change["new"]
         self.supercell_hint_button.disabled = change["new"]
+        self.min_image_distance.disabled = change["new"]
         self._write_html_supercell()
         self.supercell_html.layout.display = "none" if change["new"] else "block"
 
     def _display_mesh(self, _=None):
         if self.input_structure is None:
             return
-        if self.kpoints_distance_.value > 0:
-            # make supercell now supports only diagonal transformation matrices.
-            supercell_ = self.input_structure.get_ase()
-            supercell_ = make_supercell(
-                supercell_,
-                [
-                    [self.supercell[0], 0, 0],
-                    [0, self.supercell[1], 0],
-                    [0, 0, self.supercell[2]],
-                ],
+        if round(np.linalg.det(self.supercell)) <= 0:
+            self.mesh_grid.value = ""
+        elif self.kpoints_distance_.value > 0:
+            # pure function of the cell metric (memoized), no node is created.
+            mesh = kpoints_mesh(
+                self.input_structure.cell,
+                self.supercell,
+                self.kpoints_distance_.value,
+                self.input_structure.pbc,
             )
-            supercell = orm.StructureData(ase=supercell_)
-            mesh = create_kpoints_from_distance(
-                supercell,
-                orm.Float(self.kpoints_distance_.value),
-                orm.Bool(False),
-            )
-            self.mesh_grid.value = "Mesh " + str(mesh.get_kpoints_mesh()[0])
+            self.mesh_grid.value = "Mesh " + str(list(mesh))
         else:
             self.mesh_grid.value = "Please select a number higher than 0.0"
+        self._estimate_cost()
 
     def _suggest_supercell(self, _=None):
         """
-        minimal supercell size for muons, imposing a min_dist (lattice parameter) of 9 A.
-        Around 8 for metal is fine, for semiconductors it has to be verified.
+        minimal supercell for muons, imposing a minimum distance between the muon and its images
+        (9 A by default). Around 8 for metal is fine, for semiconductors it has to be verified.
+        Non-diagonal matrices are considered, which for skewed or hexagonal cells give much smaller supercells.
+        The search runs in a worker thread, as for large distances it can take a fraction of a second.
         """
         if self.input_structure:
-            s = self.input_structure.get_ase()
-            suggested = 9 // np.array(s.cell.cellpar()[:3]) + 1
-            self._sc_x.value = suggested[0]
-            self._sc_y.value = suggested[1]
-            self._sc_z.value = suggested[2]
+            self._supercell_hint.submit(
+                minimal_supercell,
+                self.input_structure.cell,
+                self.min_image_distance.value,
+                on_done=lambda result: self._set_supercell(result[0]),
+                on_error=self._display_supercell_error,
+            )
         else:
             return
 
+    def _display_supercell_error(self, exception):
+        self.supercell_html.value = f"Could not find a supercell: {exception}"
+
+    def _set_supercell(self, matrix):
+        """Set the supercell matrix (3x3, or its diagonal) and update the widgets."""
+        matrix = np.asarray(matrix, dtype=int)
+        if matrix.ndim == 1:
+            matrix = np.diag(matrix)
+        self._updating_supercell = True
+        try:
+            for row, values in zip(self._sc_matrix, matrix):
+                for elem, value in zip(row, values):
+                    elem.value = int(value)
+        finally:
+            self._updating_supercell = False
+        self.supercell = matrix.tolist()
+        self._display_mesh()
+        self._write_html_supercell()
+
     def _write_html_supercell(self, _=None):
         # write html for supercell data:
         if self.input_structure:
+            if round(np.linalg.det(self.supercell)) <= 0:
+                self.supercell_html.value = (
+                    "The supercell matrix should have a positive determinant."
+                )
+                return
             s = self.input_structure.get_ase()
-            s = make_supercell(
-                s,
-                [
-                    [self.supercell[0], 0, 0],
-                    [0, self.supercell[1], 0],
-                    [0, 0, self.supercell[2]],
-                ],
-            )
+            s = make_supercell(s, self.supercell)
             sc_html = "Supercell lattice parameters, angles and volume: "
             abc = np.round(s.cell.cellpar()[:3], 3)
             alfa_beta_gamma = np.round(s.cell.cellpar()[3:], 1)
-            sc_html += f"a=" + str(abc[0]) + "Å, "
-            sc_html += f"b=" + str(abc[1]) + "Å, "
-            sc_html += f"c=" + str(abc[2]) + "Å; "
-
-            sc_html += f"α=" + str(alfa_beta_gamma[0]) + "Å, "
-            sc_html += f"β=" + str(alfa_beta_gamma[1]) + "Å, "
-            sc_html += f"γ=" + str(alfa_beta_gamma[2]) + "Å; "
-
-            sc_html += f"V={round(s.get_volume(),3)}Å<sup>3</sup>"
+            sc_html += f"a=" + str(abc[0]) + "Å, "
+            sc_html += f"b=" + str(abc[1]) + "Å, "
+            sc_html += f"c=" + str(abc[2]) + "Å; "
+
+            sc_html += f"α=" + str(alfa_beta_gamma[0]) + "Å, "
+            sc_html += f"β=" + str(alfa_beta_gamma[1]) + "Å, "
+            sc_html += f"γ=" + str(alfa_beta_gamma[2]) + "Å; "
+
+            sc_html += f"V={round(s.get_volume(),3)}Å<sup>3</sup>; "
+            sc_html += f"{len(s)} atoms; "
+            distance = shortest_image_distance(
+                self.input_structure.cell, self.supercell
+            )
+            sc_html += f"muon-image distance {round(distance, 2)}Å"
 
             self.supercell_html.value = sc_html
 
     def _estimate_supercells(self, _=None):
-        """estimate the number of supercells, given sc_matrix and mu_spacing.
-        this is copied from the FindMuonWorkChain, it is code duplication.
-        should be not.
+        """estimate the number of supercells, given mu_spacing (one supercell per candidate site).
+        The fast estimate is displayed immediately; the count of the candidates generated as in
+        the workflow runs in a worker thread, debounced, and only the result of the latest request
+        is displayed, so the kernel is never blocked.
         """
         if self.input_structure is None:
             return
@@ -380,24 +565,145 @@ class Setting(Panel):
             if False in self.input_structure.pbc:
                 self.Warning_button.layout.display = "block"
             else:
-                mu_lst = niche_add_impurities(
+                cell = self.input_structure.cell
+                positions = [site.position for site in self.input_structure.sites]
+                estimate = estimate_number_of_supercells(
+                    cell, positions, self.mu_spacing_.value, mode="fast"
+                )
+                self.number_of_supercells.value = (
+                    f"Estimated number of supercells: ~{estimate}"
+                )
+                self._estimate_cost()
+                self._supercells_estimate.submit(
+                    number_of_supercells,
                     self.input_structure,
-                    orm.Str("H"),
-                    orm.Float(self.mu_spacing_.value),
-                    orm.Float(1.0),
+                    self.mu_spacing_.value,
+                    driver=self.relax_driver_.value,
+                    prune_symmetry=self.prune_symmetry_.value,
+                    on_done=self._display_number_of_supercells,
+                    on_error=self._display_estimate_error,
                 )
 
-                sc_matrix = [
-                    [self.supercell[0], 0, 0],
-                    [0, self.supercell[1], 0],
-                    [0, 0, self.supercell[2]],
-                ]
-                supercell_list = gensup(
-                    self.input_structure.get_pymatgen(), mu_lst, sc_matrix
-                )  # ordinary function
-                self.number_of_supercells.value = "Number of supercells: " + str(
-                    len(supercell_list)
+    def _estimate_cost(self, _=None):
+        """estimate the memory and CPU time of the relaxations, from the current settings.
+        The estimate runs in a worker thread, debounced, as it queries the database (the
+        pseudopotentials, cached per family and structure, and the calibration on the finished
+        relaxations of the profile, cached for the session) and can search the minimal supercell.
+        """
+        if self.input_structure is None or False in self.input_structure.pbc:
+            return
+        if (
+            self.kpoints_distance_.value <= 0
+            or round(np.linalg.det(self.supercell)) <= 0
+        ):
+            self._cost_estimate.cancel()
+            self.cost_estimate.value = ""
+            return
+
+        self._cost_estimate.submit(
+            self._compute_cost,
+            self.input_structure,
+            self.pseudo_choice_.value or "SSSP/1.2/PBEsol/efficiency",
+            # computed by the workflow: the smallest one with the minimum distance.
+            None if self.compute_supercell_.value else self.supercell,
+            self.min_image_distance.value,
+            self.kpoints_distance_.value,
+            self.mu_spacing_.value,
+            pruned=self.relax_driver_.value == "sites" and self.prune_symmetry_.value,
+            spin_polarized=self.spin_pol_.value,
+            hubbard=self.hubbard_.value,
+            charged_muon=self.charged_muon_.value,
+            on_done=self._display_cost,
+            on_error=self._display_cost_error,
+        )
+
+    def _compute_cost(
+        self,
+        structure,
+        family,
+        sc_matrix,
+        min_distance,
+        kpoints_distance,
+        mu_spacing,
+        pruned,
+        **kwargs,
+    ):
+        """The cost estimate of ``_estimate_cost``, run in the worker thread: it only uses its
+        arguments, not the widgets."""
+        cell = structure.cell
+        positions = [site.position for site in structure.sites]
+        key = (family, structure.uuid)
+        if key not in self._pseudo_info:
+            self._pseudo_info[key] = pseudo_family_info(family, structure)
+        ecutwfc, ecutrho, z_valence = self._pseudo_info[key]
+        seconds_per_unit, n_runs = calibrate_seconds_per_unit(
+            get_manager().get_profile().name
+        )
+
+        if sc_matrix is None:
+            key = (structure.uuid, min_distance)
+            if key not in self._minimal_supercells:
+                self._minimal_supercells[key] = minimal_supercell(cell, min_distance)[0]
+            sc_matrix = self._minimal_supercells[key]
+        estimate = estimate_cost(
+            cell,
+            structure.get_ase().numbers,
+            sc_matrix,
+            self._number_of_relaxations(structure, positions, mu_spacing, pruned),
+            kpoints_distance,
+            ecutwfc=ecutwfc,
+            ecutrho=ecutrho,
+            z_valence=z_valence,
+            seconds_per_unit=seconds_per_unit,
+            **kwargs,
+        )
+        return format_cost(estimate, n_runs)
+
+    def _number_of_relaxations(self, structure, positions, mu_spacing, pruned):
+        """number of supercells to relax: fast estimate, or the inequivalent candidates if pruned.
+        Run in the worker thread; the symmetry pruning is cached per structure and spacing."""
+        if pruned:
+            key = (structure.uuid, mu_spacing)
+            if key not in self._inequivalent_candidates:
+                kinds = [site.kind_name for site in structure.sites]
+                frac, _ = inequivalent_candidate_positions(
+                    structure.cell,
+                    positions,
+                    np.unique(kinds, return_inverse=True)[1],
+                    mu_spacing,
                 )
+                self._inequivalent_candidates[key] = len(frac)
+            return self._inequivalent_candidates[key]
+        return estimate_number_of_supercells(structure.cell, positions, mu_spacing)
+
+    def _display_cost(self, html):
+        self.cost_estimate.value = html
+
+    def _display_cost_error(self, exception):
+        self.cost_estimate.value = f"Could not estimate the cost: {exception}"
+
+    def _display_sites_options(self, change):
+        self.sites_options.layout.display = (
+            "block" if change["new"] == "sites" else "none"
+        )
+
+    def _display_screening_options(self, change):
+        self.screening_options.layout.display = "block" if change["new"] else "none"
+
+    def _display_number_of_supercells(self, count):
+        # without aiida-muon, the niche candidates of the FindMuonWorkChain are estimated.
+        number, exact = count
+        if exact:
+            self.number_of_supercells.value = "Number of supercells: " + str(number)
+        else:
+            self.number_of_supercells.value = (
+                f"Estimated number of supercells: ~{number}"
+            )
+
+    def _display_estimate_error(self, exception):
+        self.number_of_supercells.value = (
+            f"Could not estimate the number of supercells: {exception}"
+        )
 
     def _display_moments(self, _=None):
         """
@@ -454,28 +760,75 @@ class Setting(Panel):
             "hubbard": self.hubbard_.value,
             "spin_pol": self.spin_pol_.value,
             "pseudo_choice": self.pseudo_choice_.value,
+            "relax_driver": self.relax_driver_.value,
+            "prune_symmetry": self.prune_symmetry_.value,
+            "max_concurrent": self.max_concurrent_.value,
+            "prune_energy": self.prune_energy_.value,
+            "prune_steps": self.prune_steps_.value,
+            "reuse_relaxations": self.reuse_relaxations_.value,
+            "pristine_density": self.pristine_density_.value,
+            "screening": self.screening_.value,
+            "screening_parameters": {
+                "cutoff_scale": self.screening_cutoff_scale_.value,
+                "kpoints_distance": self.screening_kpoints_distance_.value,
+                "forc_conv_thr": self.screening_forc_conv_thr_.value,
+                "energy_window": self.screening_energy_window_.value,
+            },
         }
 
     def load_panel_value(self, input_dict):
         """Load a dictionary with the input parameters for the plugin."""
         self.charged_muon_.value = input_dict.get("charged_muon", True)
         self.compute_supercell_.value = input_dict.get("compute_supercell", False)
-        self.supercell = input_dict.get("supercell_selector", [1, 1, 1])
+        self._set_supercell(input_dict.get("supercell_selector", [1, 1, 1]))
         self.kpoints_distance_.value = input_dict.get("kpoints_distance", 0.3)
         self.mu_spacing_.value = input_dict.get("mu_spacing", 1)
         self.magmoms = input_dict.get("magmoms", None)
         self.hubbard_.value = input_dict.get("hubbard", False)
         self.spin_pol_.value = input_dict.get("spin_pol", True)
         self.pseudo_choice_.value = input_dict.get("pseudo_choice", True)
+        self.relax_driver_.value = input_dict.get("relax_driver", "findmuon")
+        self.prune_symmetry_.value = input_dict.get("prune_symmetry", True)
+        self.max_concurrent_.value = input_dict.get("max_concurrent", 10)
+        self.prune_energy_.value = input_dict.get("prune_energy", 0.0)
+        self.prune_steps_.value = input_dict.get("prune_steps", 5)
+        self.reuse_relaxations_.value = input_dict.get("reuse_relaxations", True)
+        self.pristine_density_.value = input_dict.get("pristine_density", False)
+        self.screening_.value = input_dict.get("screening", False)
+        screening_parameters = input_dict.get("screening_parameters", {})
+        self.screening_cutoff_scale_.value = screening_parameters.get(
+            "cutoff_scale", 0.6
+        )
+        self.screening_kpoints_distance_.value = screening_parameters.get(
+            "kpoints_distance", 0.0
+        )
+        self.screening_forc_conv_thr_.value = screening_parameters.get(
+            "forc_conv_thr", 1e-2
+        )
+        self.screening_energy_window_.value = screening_parameters.get(
+            "energy_window", 1.0
+        )
 
     def reset(self):
         """Reset the panel"""
         self.charged_muon_.value = True
         self.compute_supercell_.value = True
-        self.supercell = [1, 1, 1]
+        self._set_supercell([1, 1, 1])
         self.kpoints_distance_.value = 0.3
         self.mu_spacing_.value = 1
         self.magmoms = None
         self.hubbard_.value = True
         self.spin_pol_.value = True
         self.pseudo_choice_.value = ""
+        self.relax_driver_.value = "findmuon"
+        self.prune_symmetry_.value = True
+        self.max_concurrent_.value = 10
+        self.prune_energy_.value = 0.0
+        self.prune_steps_.value = 5
+        self.reuse_relaxations_.value = True
+        self.pristine_density_.value = False
+        self.screening_.value = False
+        self.screening_cutoff_scale_.value = 0.6
+        self.screening_kpoints_distance_.value = 0.0
+        self.screening_forc_conv_thr_.value = 1e-2
+        self.screening_energy_window_.value = 1.0
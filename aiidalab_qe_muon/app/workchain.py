@@ -1,3 +1,6 @@
+import logging
+
+import numpy as np
 from aiida.orm import load_code, Dict, Bool, load_group
 from aiida.plugins import WorkflowFactory, DataFactory
 from aiida_quantumespresso.common.types import ElectronicType, SpinType
@@ -14,6 +17,75 @@ except:
 
 old_structuredata = True
 
+LOGGER = logging.getLogger(__name__)
+
+
+def get_cost_estimate(
+    structure,
+    sc_matrix,
+    mu_spacing,
+    kpoints_distance,
+    pseudo_family,
+    spin_polarized=False,
+    hubbard=False,
+    charged_muon=True,
+    prune_symmetry=False,
+):
+    """Estimate the cost of the muon workflow, see ``aiidalab_qe_muon.utils.cost``.
+
+    If ``sc_matrix`` is None (computed by the workflow), the smallest supercell with
+    the muon 9 A away from its images is assumed. If ``prune_symmetry``, only the
+    inequivalent candidates are counted.
+    """
+    from aiida.manage import get_manager
+
+    from aiidalab_qe_muon.utils.cost import (
+        calibrate_seconds_per_unit,
+        estimate_cost,
+        pseudo_family_info,
+    )
+    from aiidalab_qe_muon.utils.supercells import (
+        estimate_number_of_supercells,
+        inequivalent_candidate_positions,
+        minimal_supercell,
+    )
+
+    cell = np.array(structure.cell)
+    positions = np.array([site.position for site in structure.sites])
+    if sc_matrix is None:
+        sc_matrix, _ = minimal_supercell(cell)
+    if prune_symmetry:
+        kinds = [site.kind_name for site in structure.sites]
+        n_relaxations = len(
+            inequivalent_candidate_positions(
+                cell, positions, np.unique(kinds, return_inverse=True)[1], mu_spacing
+            )[0]
+        )
+    else:
+        n_relaxations = estimate_number_of_supercells(
+            cell, positions, mu_spacing, mode="exact"
+        )
+    ecutwfc, ecutrho, z_valence = pseudo_family_info(pseudo_family, structure)
+    seconds_per_unit, n_runs = calibrate_seconds_per_unit(
+        get_manager().get_profile().name
+    )
+    estimate = estimate_cost(
+        cell,
+        structure.get_ase().numbers,
+        sc_matrix,
+        n_relaxations,
+        kpoints_distance,
+        ecutwfc=ecutwfc,
+        ecutrho=ecutrho,
+        z_valence=z_valence,
+        spin_polarized=spin_polarized,
+        hubbard=hubbard,
+        charged_muon=charged_muon,
+        seconds_per_unit=seconds_per_unit,
+    )
+    estimate["calibration_runs"] = n_runs
+    return estimate
+
 
 def get_builder(codes, structure, parameters):
     from copy import deepcopy
@@ -23,8 +95,11 @@ def get_builder(codes, structure, parameters):
     pp_code = codes.get("pp_code")
 
     magmom = parameters["muonic"].pop("magmoms", None)
-    supercell = parameters["muonic"].pop("supercell_selector", None)
-    sc_matrix = [[[supercell[0], 0, 0], [0, supercell[1], 0], [0, 0, supercell[2]]]]
+    supercell = np.asarray(parameters["muonic"].pop("supercell_selector", [1, 1, 1]))
+    # full 3x3 matrix; the diagonal only, as given by older versions of the panel.
+    if supercell.ndim == 1:
+        supercell = np.diag(supercell)
+    sc_matrix = [supercell.astype(int).tolist()]
 
     compute_supercell = parameters["muonic"].pop("compute_supercell", False)
     mu_spacing = parameters["muonic"].pop("mu_spacing", 1.0)
@@ -46,7 +121,24 @@ def get_builder(codes, structure, parameters):
     if compute_supercell:
         sc_matrix = None
 
-    trigger = "findmuon"
+    trigger = parameters["muonic"].pop("relax_driver", "findmuon")
+    sites_options = {}
+    if trigger == "sites":
+        sites_options["prune_symmetry"] = parameters["muonic"].pop(
+            "prune_symmetry", True
+        )
+        sites_options["max_concurrent"] = parameters["muonic"].pop("max_concurrent", 0)
+        sites_options["prune_energy"] = parameters["muonic"].pop("prune_energy", 0.0)
+        sites_options["prune_steps"] = parameters["muonic"].pop("prune_steps", 5)
+        sites_options["reuse_relaxations"] = parameters["muonic"].pop(
+            "reuse_relaxations", True
+        )
+        sites_options["pristine_density"] = parameters["muonic"].pop(
+            "pristine_density", False
+        )
+        screening_parameters = parameters["muonic"].pop("screening_parameters", {})
+        if parameters["muonic"].pop("screening", False):
+            sites_options["screening"] = screening_parameters
 
     scf_overrides = deepcopy(parameters["advanced"])
     overrides = {
@@ -74,8 +166,27 @@ def get_builder(codes, structure, parameters):
         electronic_type=ElectronicType(parameters["workchain"]["electronic_type"]),
         spin_type=SpinType(parameters["workchain"]["spin_type"]),
         initial_magnetic_moments=parameters["advanced"]["initial_magnetic_moments"],
+        **sites_options,
     )
 
+    # the estimate is informative only: it never prevents the submission.
+    try:
+        cost_estimate = get_cost_estimate(
+            structure,
+            None if compute_supercell else supercell,
+            mu_spacing,
+            kpoints_distance,
+            pseudo_family,
+            spin_polarized=parameters["workchain"]["spin_type"] != "none",
+            hubbard=hubbard,
+            charged_muon=charge_supercell,
+            prune_symmetry=sites_options.get("prune_symmetry", False),
+        )
+    except Exception:
+        LOGGER.warning("could not estimate the cost of the muon workflow", exc_info=True)
+    else:
+        builder.cost_estimate = Dict(cost_estimate)
+
     pp_metadata = {
         "options": {
             "max_wallclock_seconds": 60 * 60,
@@ -85,8 +196,10 @@ def get_builder(codes, structure, parameters):
             },
         },
     }
-    if pp_code:
+    if pp_code and trigger == "findmuon":
         builder.findmuon.pp_metadata = pp_metadata
+    elif "pp_code" in builder:
+        builder.pp_metadata = pp_metadata
 
     return builder
 
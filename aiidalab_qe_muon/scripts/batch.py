@@ -0,0 +1,324 @@
+"""Batch submission of the ``ImplantMuonWorkChain`` over a group of structures.
+
+The batches run without the app: the settings are the ones of the muon panel
+(``Setting.get_panel_value``), and the builders are made by the same ``get_builder``
+as in the app. The workchains of a batch are added to the group ``muon_batch/<label>``,
+whose extras keep the settings and the codes; the status of each structure is kept in
+its extras, under the label of the batch. So a batch can be resumed at any time, e.g.
+from a cron job, and the failed structures are submitted again (the relaxations
+already finished are reused, see ``aiidalab_qe_muon.utils.reuse``).
+
+Usage::
+
+    muon_batch submit <group> --settings settings.json --pw-code pw@localhost --watch
+    muon_batch status <group>
+"""
+import argparse
+import json
+import time
+from copy import deepcopy
+
+STATUS_EXTRA = "muon_batch"
+GROUP_PREFIX = "muon_batch/"
+
+# the parameters of the app which are not in the muon panel.
+DEFAULT_PARAMETERS = {
+    "workchain": {"protocol": "fast", "electronic_type": "metal", "spin_type": "none"},
+    "advanced": {"initial_magnetic_moments": None},
+    "muonic": {},
+}
+
+
+def batch_parameters(settings):
+    """Parameters for ``get_builder``, from the settings of the muon panel or from a
+    dictionary with the `workchain`, `advanced` and `muonic` keys (the missing ones are
+    the defaults).
+
+    If the settings give neither `supercell_selector` nor `compute_supercell`, the
+    supercell of each structure is computed: the unit cell is never a sensible default.
+    """
+    if "muonic" not in settings:
+        settings = {"muonic": settings}
+    parameters = {
+        key: {**defaults, **settings.get(key, {})}
+        for key, defaults in DEFAULT_PARAMETERS.items()
+    }
+    muonic = parameters["muonic"]
+    if "supercell_selector" not in muonic and "compute_supercell" not in muonic:
+        muonic["compute_supercell"] = True
+    return parameters
+
+
+class MuonBatch:
+    """
+    Submit the ``ImplantMuonWorkChain`` for all the structures of a group, with at most
+    ``max_concurrent`` workchains of the batch running at the same time.
+
+    Status of each structure: "pending", "running", "finished", "failed" (submitted
+    again until ``max_attempts``), or "invalid" if the builder could not be made.
+    """
+
+    def __init__(self, structures, label=None):
+        """
+        :param structures: the group of structures, or its label.
+        :param label: label of the batch, by default the one of the group of structures.
+        """
+        from aiida import orm
+
+        self.structures = (
+            orm.load_group(structures) if isinstance(structures, str) else structures
+        )
+        self.label = label or self.structures.label
+        self.group, _ = orm.Group.collection.get_or_create(
+            label=f"{GROUP_PREFIX}{self.label}"
+        )
+
+    def configure(
+        self, settings, pw_code, pp_code=None, max_concurrent=10, max_attempts=2
+    ):
+        """Set the settings and the codes of the batch, used by all the next
+        submissions.
+
+        :param settings: see ``batch_parameters``.
+        :param pw_code: label or ``Code`` of pw.x; ``pp_code`` the same for pp.x, if
+            needed.
+        """
+        from aiida import orm
+
+        codes = {"pw": pw_code, "pp_code": pp_code}
+        self.group.base.extras.set_many(
+            {
+                "settings": batch_parameters(settings),
+                "codes": {
+                    key: (
+                        code
+                        if isinstance(code, orm.AbstractCode)
+                        else orm.load_code(code)
+                    ).uuid
+                    for key, code in codes.items()
+                    if code is not None
+                },
+                "max_concurrent": int(max_concurrent),
+                "max_attempts": int(max_attempts),
+            }
+        )
+
+    @property
+    def configured(self):
+        return "settings" in self.group.base.extras.keys()
+
+    def _entry(self, structure):
+        return structure.base.extras.get(STATUS_EXTRA, {}).get(
+            self.label, {"status": "pending", "workchain": None, "attempts": 0}
+        )
+
+    def _set_entry(self, structure, entry):
+        batches = structure.base.extras.get(STATUS_EXTRA, {})
+        batches[self.label] = entry
+        structure.base.extras.set(STATUS_EXTRA, batches)
+
+    def status(self):
+        """{structure pk: {status, workchain pk, attempts}}, updated with the workchains
+        terminated since."""
+        from aiida import orm
+
+        statuses = {}
+        for structure in self.structures.nodes:
+            if not isinstance(structure, orm.StructureData):
+                continue
+            entry = self._entry(structure)
+            if entry["status"] == "running":
+                workchain = orm.load_node(entry["workchain"])
+                if workchain.is_terminated:
+                    entry["status"] = (
+                        "finished" if workchain.is_finished_ok else "failed"
+                    )
+                    self._set_entry(structure, entry)
+            statuses[structure.pk] = entry
+        return statuses
+
+    def _to_submit(self, entry):
+        return entry["status"] == "pending" or (
+            entry["status"] == "failed"
+            and entry["attempts"] < self.group.base.extras.get("max_attempts")
+        )
+
+    def done(self, statuses=None):
+        """Whether nothing is running or left to submit."""
+        statuses = statuses or self.status()
+        return not any(
+            entry["status"] == "running" or self._to_submit(entry)
+            for entry in statuses.values()
+        )
+
+    def submit(self):
+        """Submit the pending and failed structures, as long as less than
+        ``max_concurrent`` workchains of the batch are running.
+
+        :return: the submitted workchains.
+        """
+        from aiida import orm
+        from aiida.engine import submit
+
+        from aiidalab_qe_muon.app.workchain import get_builder
+
+        if not self.configured:
+            raise ValueError(
+                f"the batch {self.label!r} is not configured: no settings and codes."
+            )
+        extras = self.group.base.extras
+        codes = {key: orm.load_code(uuid) for key, uuid in extras.get("codes").items()}
+
+        statuses = self.status()
+        running = sum(entry["status"] == "running" for entry in statuses.values())
+        submitted = []
+        for pk, entry in statuses.items():
+            if running >= extras.get("max_concurrent"):
+                break
+            if not self._to_submit(entry):
+                continue
+            structure = orm.load_node(pk)
+            try:
+                builder = get_builder(
+                    codes, structure, deepcopy(extras.get("settings"))
+                )
+            except Exception as exception:
+                entry.update(status="invalid", error=str(exception))
+                self._set_entry(structure, entry)
+                continue
+            workchain = submit(builder)
+            workchain.base.extras.set(
+                STATUS_EXTRA, {"label": self.label, "structure": structure.uuid}
+            )
+            self.group.add_nodes(workchain)
+            entry.update(
+                status="running", workchain=workchain.pk, attempts=entry["attempts"] + 1
+            )
+            self._set_entry(structure, entry)
+            submitted.append(workchain)
+            running += 1
+        return submitted
+
+    def run(self, interval=60):
+        """Submit and wait until all the structures are finished, or failed
+        ``max_attempts`` times."""
+        while True:
+            self.submit()
+            statuses = self.status()
+            if self.done(statuses):
+                return statuses
+            time.sleep(interval)
+
+
+def format_status(statuses):
+    """Table of the statuses, one structure per line, and the counts."""
+    lines = [f"{'structure':>10} {'status':>9} {'workchain':>10} {'attempts':>8}"]
+    for pk, entry in statuses.items():
+        lines.append(
+            f"{pk:>10} {entry['status']:>9} "
+            f"{str(entry['workchain'] or '-'):>10} {entry['attempts']:>8}"
+        )
+    counts = {}
+    for entry in statuses.values():
+        counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+    lines.append(
+        ", ".join(f"{count} {status}" for status, count in sorted(counts.items()))
+    )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    from aiida import load_profile
+
+    parser = argparse.ArgumentParser(
+        prog="muon_batch", description=__doc__.split("\n")[0]
+    )
+    parser.add_argument(
+        "--profile", default=None, help="AiiDA profile, the default one if not given."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser(
+        "submit", help="Configure the batch and submit the structures."
+    )
+    submit.add_argument("group", help="Label of the group of structures.")
+    submit.add_argument(
+        "--label",
+        default=None,
+        help="Label of the batch, by default the one of the group.",
+    )
+    submit.add_argument(
+        "--settings",
+        default=None,
+        help="JSON file with the settings of the muon panel, "
+        "or with the `workchain`, `advanced` and `muonic` keys.",
+    )
+    submit.add_argument("--pw-code", default=None, help="Label of the pw.x code.")
+    submit.add_argument("--pp-code", default=None, help="Label of the pp.x code.")
+    submit.add_argument(
+        "--max-concurrent",
+        type=int,
+        default=10,
+        help="Workchains of the batch running at the same time.",
+    )
+    submit.add_argument(
+        "--max-attempts",
+        type=int,
+        default=2,
+        help="Submissions of each structure, if it fails.",
+    )
+    submit.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep submitting until all the structures are done.",
+    )
+    submit.add_argument(
+        "--interval",
+        type=float,
+        default=60,
+        help="Seconds between the checks, with --watch.",
+    )
+
+    status = commands.add_parser(
+        "status", help="Show the status of the structures of the batch."
+    )
+    status.add_argument("group", help="Label of the group of structures.")
+    status.add_argument(
+        "--label",
+        default=None,
+        help="Label of the batch, by default the one of the group.",
+    )
+
+    args = parser.parse_args(argv)
+    load_profile(args.profile)
+    batch = MuonBatch(args.group, args.label)
+
+    if args.command == "submit":
+        if args.settings or not batch.configured:
+            if not (args.settings and args.pw_code):
+                parser.error(
+                    "--settings and --pw-code are needed "
+                    "the first time a batch is submitted."
+                )
+            with open(args.settings) as handle:
+                settings = json.load(handle)
+            batch.configure(
+                settings,
+                args.pw_code,
+                args.pp_code,
+                args.max_concurrent,
+                args.max_attempts,
+            )
+        if args.watch:
+            statuses = batch.run(args.interval)
+        else:
+            for workchain in batch.submit():
+                print(f"submitted <PK={workchain.pk}>")
+            statuses = batch.status()
+        print(format_status(statuses))
+    elif args.command == "status":
+        print(format_status(batch.status()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Export the results of finished muon runs to a dataset, without the app.
+
+For each run (QE app, ``ImplantMuonWorkChain`` or ``FindMuonWorkChain``), the table of
+the unique muon sites (energies, positions, fields, second moments) and their
+Kubo-Toyabe curves are extracted in a pool of processes, see
+``aiidalab_qe_muon.utils.results.export_results``, and written to Parquet (a folder with
+``sites.parquet`` and ``kubo_toyabe.parquet``) or to HDF5 (one file with the ``sites``
+and ``kubo_toyabe`` tables).
+
+Usage::
+
+    muon_results export 1234 1250 --output results
+    muon_results export --group muon_batch/magnets --output results.h5 --processes 8
+"""
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
+
+import numpy as np
+
+HDF5_SUFFIXES = (".h5", ".hdf5")
+
+
+def _init_worker(profile):
+    from aiida import load_profile
+
+    load_profile(profile, allow_switch=True)
+
+
+def _export_run(pk, tolerance, times):
+    from aiida import orm
+
+    from aiidalab_qe_muon.utils.results import export_results
+
+    return export_results(orm.load_node(pk), tolerance=tolerance, times=times)
+
+
+def collect_results(pks, processes=None, tolerance=1e-3, times=None, profile=None):
+    """Export the results of the runs in a pool of processes (each with its own
+    connection to the profile).
+
+    :return: tuple (list of the results, see ``export_results``, {pk: error} of the runs
+        that failed or have no muon sites).
+    """
+    results, errors = [], {}
+    # spawned, not forked: the storage connections of the parent cannot be shared.
+    with ProcessPoolExecutor(
+        processes,
+        mp_context=get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(profile,),
+    ) as pool:
+        futures = {pool.submit(_export_run, pk, tolerance, times): pk for pk in pks}
+        for future in as_completed(futures):
+            pk = futures[future]
+            try:
+                result = future.result()
+            except Exception as exception:
+                errors[pk] = f"{type(exception).__name__}: {exception}"
+                continue
+            if result is None:
+                errors[pk] = "no muon sites in the outputs"
+            else:
+                results.append(result)
+    results.sort(key=lambda result: next(iter(result["sites"]["run"]), 0))
+    return results, errors
+
+
+def to_dataframes(results):
+    """Tables of the sites (one row per site) and of the Kubo-Toyabe curves (one row per
+    site and time)."""
+    import pandas as pd
+
+    sites = pd.concat(
+        [pd.DataFrame(result["sites"]) for result in results], ignore_index=True
+    )
+    curves = pd.concat(
+        [
+            pd.DataFrame(
+                {
+                    "run": np.repeat(result["sites"]["run"], len(result["times"])),
+                    "site": np.repeat(result["sites"]["site"], len(result["times"])),
+                    "time": np.tile(
+                        result["times"] * 1e6, len(result["sites"]["site"])
+                    ),
+                    "polarization": result["kubo_toyabe"].ravel(),
+                }
+            )
+            for result in results
+        ],
+        ignore_index=True,
+    )
+    return sites, curves
+
+
+def write_dataframes(sites, curves, output):
+    """Write the tables to HDF5 if ``output`` ends with .h5 or .hdf5, to a Parquet
+    folder otherwise."""
+    output = Path(output)
+    if output.suffix in HDF5_SUFFIXES:
+        sites.to_hdf(output, key="sites", mode="w")
+        curves.to_hdf(output, key="kubo_toyabe", mode="a")
+    else:
+        output.mkdir(parents=True, exist_ok=True)
+        sites.to_parquet(output / "sites.parquet", index=False)
+        curves.to_parquet(output / "kubo_toyabe.parquet", index=False)
+
+
+def group_runs(label):
+    """PKs of the workflows in the group."""
+    from aiida import orm
+
+    return [
+        node.pk
+        for node in orm.load_group(label).nodes
+        if isinstance(node, orm.WorkflowNode)
+    ]
+
+
+def main(argv=None):
+    from aiida import load_profile
+
+    parser = argparse.ArgumentParser(
+        prog="muon_results", description=__doc__.split("\n")[0]
+    )
+    parser.add_argument(
+        "--profile", default=None, help="AiiDA profile, the default one if not given."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser(
+        "export", help="Export the sites and Kubo-Toyabe curves of finished runs."
+    )
+    export.add_argument("pks", nargs="*", type=int, help="PKs of the runs.")
+    export.add_argument(
+        "--group",
+        action="append",
+        default=[],
+        help="Label of a group of runs (repeatable).",
+    )
+    export.add_argument(
+        "--output", required=True, help="Parquet folder, or HDF5 file (.h5, .hdf5)."
+    )
+    export.add_argument(
+        "--processes",
+        type=int,
+        default=None,
+        help="Number of processes, all the CPUs by default.",
+    )
+    export.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-3,
+        help="Convergence tolerance of the second moments.",
+    )
+    export.add_argument(
+        "--t-max",
+        type=float,
+        default=40.0,
+        help="Last time of the Kubo-Toyabe curves, in microseconds.",
+    )
+    export.add_argument(
+        "--n-times",
+        type=int,
+        default=1000,
+        help="Number of times of the Kubo-Toyabe curves.",
+    )
+
+    args = parser.parse_args(argv)
+    profile = load_profile(args.profile)
+
+    pks = list(
+        dict.fromkeys(
+            args.pks + [pk for label in args.group for pk in group_runs(label)]
+        )
+    )
+    if not pks:
+        parser.error("no runs given: pass their PKs or --group.")
+    times = np.linspace(0, args.t_max * 1e-6, args.n_times)
+    results, errors = collect_results(
+        pks, args.processes, args.tolerance, times, profile.name
+    )
+    for pk, error in errors.items():
+        print(f"<PK={pk}> skipped: {error}", file=sys.stderr)
+    if not results:
+        sys.exit("no results to export.")
+
+    sites, curves = to_dataframes(results)
+    write_dataframes(sites, curves, args.output)
+    print(f"exported {len(sites)} muon sites of {len(results)} runs to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
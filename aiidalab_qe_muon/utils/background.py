@@ -0,0 +1,69 @@
+"""Debounced execution of slow estimates in a worker thread, for the widgets."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DebouncedTask:
+    """
+    Run a function in a worker thread once no call was submitted for ``delay`` seconds.
+
+    Every submission supersedes the previous ones: pending calls are cancelled and the
+    results of calls already running are discarded (a thread cannot be interrupted,
+    but only one call runs at a time). The callbacks are invoked from the worker thread.
+    """
+
+    def __init__(self, delay=0.4):
+        self.delay = delay
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._timer = None
+        self._future = None
+
+    def submit(self, function, *args, on_done=None, on_error=None, **kwargs):
+        """Schedule ``function(*args, **kwargs)``.
+
+        ``on_done(result)`` or ``on_error(exception)`` is called only if no other call
+        was submitted in the meantime.
+        """
+        with self._lock:
+            self._cancel_pending()
+            generation = self._generation
+            self._timer = threading.Timer(
+                self.delay,
+                self._start,
+                (generation, function, args, kwargs, on_done, on_error),
+            )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def cancel(self):
+        """Cancel the pending call and discard the result of the running one, if any."""
+        with self._lock:
+            self._cancel_pending()
+
+    def _cancel_pending(self):
+        self._generation += 1
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._future is not None:
+            self._future.cancel()
+
+    def _start(self, generation, function, args, kwargs, on_done, on_error):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._future = self._executor.submit(function, *args, **kwargs)
+        self._future.add_done_callback(
+            lambda future: self._finish(generation, future, on_done, on_error)
+        )
+
+    def _finish(self, generation, future, on_done, on_error):
+        if future.cancelled() or generation != self._generation:
+            return
+        exception = future.exception()
+        if exception is not None:
+            if on_error is not None:
+                on_error(exception)
+        elif on_done is not None:
+            on_done(future.result())
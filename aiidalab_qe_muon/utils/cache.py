@@ -0,0 +1,93 @@
+"""On-disk cache for the post-processed muon results.
+
+Each entry is a .npz file of plain (non-object) arrays, stored under the AiiDA
+configuration folder, separately for each profile. The total size of the cache is
+bounded: when exceeded, the least recently used entries are evicted.
+"""
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+
+class ResultCache:
+    """Size-bounded, least-recently-used cache of .npz files keyed by node UUID."""
+
+    # bump it whenever the content of the entries changes: old entries are ignored.
+    version = 2
+
+    def __init__(self, directory, max_size=256 * 1024**2):
+        """
+        :param directory: folder of the cache; it is created if needed.
+        :param max_size: maximum total size of the cache in bytes.
+        """
+        self.directory = Path(directory)
+        self.max_size = max_size
+
+    def _path(self, key):
+        return self.directory / f"{key}.v{self.version}.npz"
+
+    def get(self, key):
+        """Return the dictionary of arrays stored for ``key``, or None if not cached."""
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {k: npz[k] for k in npz.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # corrupted or truncated entry.
+            self.invalidate(key)
+            return None
+        # the modification time is used as last access time for the eviction.
+        os.utime(path)
+        return arrays
+
+    def set(self, key, arrays):
+        """Store the arrays for ``key``, then evict old entries if needed."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # write and rename, so that concurrent readers never see a partial file.
+        handle, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(handle, "wb") as fhandle:
+                np.savez_compressed(fhandle, **arrays)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+        self.evict()
+
+    def invalidate(self, key):
+        """Remove the entry of ``key``, if any."""
+        self._path(key).unlink(missing_ok=True)
+
+    def clear(self):
+        """Remove all the entries."""
+        for path in self.directory.glob("*.npz"):
+            path.unlink(missing_ok=True)
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits ``max_size``."""
+        if not self.directory.is_dir():
+            return
+        entries = sorted(
+            ((path.stat(), path) for path in self.directory.glob("*.npz")),
+            key=lambda entry: entry[0].st_mtime,
+        )
+        total = sum(stat.st_size for stat, _ in entries)
+        for stat, path in entries:
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+
+def get_result_cache(max_size=256 * 1024**2):
+    """Return the cache of the currently loaded AiiDA profile."""
+    from aiida.manage.configuration import get_config, get_profile
+
+    directory = (
+        Path(get_config().dirpath) / "cache" / "aiidalab_qe_muon" / get_profile().name
+    )
+    return ResultCache(directory, max_size=max_size)
@@ -0,0 +1,156 @@
+"""Symmetry-aware clustering of the relaxed muon positions.
+
+Relaxations started from different candidates often end in the same site, or in sites
+equivalent by the symmetry of the host. The positions are folded in the unit cell and
+compared through the space-group operations and the periodic images: only the pairs
+closer than the tolerance are found, with a k-d tree, so that thousands of positions are
+clustered in seconds. The sites are then grouped by increasing energy, within an energy
+tolerance; each group is an orbit of the space group, whose multiplicity is the number
+of equivalent positions in the unit cell.
+"""
+import numpy as np
+
+from aiidalab_qe_muon.utils.symmetry import periodic_distances, symmetry_operations
+
+
+def symmetric_neighbors(frac_points, cell, rotations, translations, cutoff):
+    """Pairs of points closer than ``cutoff`` through the symmetry operations and the
+    periodic images.
+
+    The images of the points by all the operations, folded in the unit cell, are
+    searched at once in a k-d tree of the points and of their periodic replicas within
+    the cutoff from the unit cell.
+
+    :param frac_points: (n, 3) fractional coordinates.
+    :param cutoff: in Angstrom.
+    :return: tuple (rows, cols, distances) of the pairs, sorted by rows:
+        ``distances[k]`` is the distance from ``cols[k]`` of the closest image of
+        ``rows[k]`` (the point itself included).
+    """
+    from itertools import product
+
+    from scipy.spatial import cKDTree
+
+    cell = np.asarray(cell, dtype=float)
+    frac = np.mod(np.asarray(frac_points, dtype=float).reshape(-1, 3), 1.0)
+    n = len(frac)
+    # the cutoff in fractional units along each lattice vector (over the spacing of the
+    # lattice planes): only the replicas within it from the unit cell can be close to
+    # the images, folded in the unit cell.
+    reach = cutoff * np.linalg.norm(np.linalg.inv(cell), axis=0)
+    layers = np.ceil(reach).astype(int)
+    shifts = np.array(list(product(*[range(-layer, layer + 1) for layer in layers])))
+    replicas = (frac[None, :, :] + shifts[:, None, :]).reshape(-1, 3)
+    owners = np.tile(np.arange(n), len(shifts))
+    inside = np.all((replicas > -reach) & (replicas < 1 + reach), axis=1)
+    replicas, owners = replicas[inside], owners[inside]
+
+    images = np.mod(
+        np.einsum("oij,pj->opi", rotations, frac) + translations[:, None, :], 1.0
+    )
+    pairs = cKDTree(images.reshape(-1, 3) @ cell).sparse_distance_matrix(
+        cKDTree(replicas @ cell), cutoff, output_type="ndarray"
+    )
+    rows, cols, distances = pairs["i"] % n, owners[pairs["j"]], pairs["v"]
+
+    # the minimum over the operations and the replicas, for each pair.
+    keys = rows * n + cols
+    order = np.lexsort((distances, keys))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = keys[order][1:] != keys[order][:-1]
+    order = order[first]
+    return rows[order], cols[order], distances[order]
+
+
+def leader_clustering(
+    energies, rows, cols, distances, distance_tolerance=0.5, energy_tolerance=0.05
+):
+    """Group the sites by increasing energy: each site joins the lowest-energy
+    representative closer than ``distance_tolerance`` and less than ``energy_tolerance``
+    below it, or becomes a representative.
+
+    :param rows, cols, distances: the pairs of close sites sorted by rows, see
+        ``symmetric_neighbors``.
+    :return: (n,) index of the representative of each site.
+    """
+    energies = np.asarray(energies, dtype=float)
+    n = len(energies)
+    order = np.argsort(energies, kind="stable")
+    rank = np.empty(n, dtype=int)
+    rank[order] = np.arange(n)
+    bounds = np.searchsorted(rows, np.arange(n + 1))
+
+    labels = np.full(n, -1)
+    for i in order:
+        neighbors = cols[bounds[i] : bounds[i + 1]]
+        close = distances[bounds[i] : bounds[i + 1]] < distance_tolerance
+        candidates = neighbors[
+            close
+            & (labels[neighbors] == neighbors)
+            & (energies[i] - energies[neighbors] < energy_tolerance)
+        ]
+        labels[i] = candidates[np.argmin(rank[candidates])] if len(candidates) else i
+    return labels
+
+
+def orbit_multiplicities(frac_points, cell, rotations, translations, tolerance=0.05):
+    """Number of positions equivalent to each point in the unit cell: the number of
+    operations over the size of the stabilizer of the point (the operations mapping it
+    onto itself)."""
+    frac_points = np.asarray(frac_points, dtype=float).reshape(-1, 3)
+    images = np.einsum("oij,pj->opi", rotations, frac_points) + translations[:, None, :]
+    stabilizer = np.count_nonzero(
+        periodic_distances(cell, images, frac_points[None]) < tolerance, axis=0
+    )
+    return len(rotations) // np.maximum(stabilizer, 1)
+
+
+def cluster_muon_sites(
+    cell,
+    frac_host,
+    types,
+    frac_muons,
+    energies,
+    symprec=1e-3,
+    distance_tolerance=0.5,
+    energy_tolerance=0.05,
+):
+    """Cluster the relaxed muon positions into orbits of the space group of the host.
+
+    :param cell: (3, 3) lattice vectors of the unit cell, as rows.
+    :param frac_host: (n_atoms, 3) fractional coordinates of the host.
+    :param types: (n_atoms,) integers, one per kind of the host.
+    :param frac_muons: (n, 3) fractional coordinates of the muons in the unit cell.
+    :param energies: (n,) total energies of the relaxations, in eV.
+    :param distance_tolerance: in Angstrom; ``energy_tolerance`` in eV.
+    :return: dictionary with `labels`, the index of the representative of each site;
+        `representatives`, their indices sorted by energy; `members`, the number of
+        sites of each cluster; `multiplicities`, the number of equivalent positions in
+        the unit cell of each representative.
+    """
+    cell = np.asarray(cell, dtype=float)
+    frac_muons = np.asarray(frac_muons, dtype=float).reshape(-1, 3)
+    energies = np.asarray(energies, dtype=float)
+    rotations, translations = symmetry_operations(cell, frac_host, types, symprec)
+
+    labels = leader_clustering(
+        energies,
+        *symmetric_neighbors(
+            frac_muons, cell, rotations, translations, distance_tolerance
+        ),
+        distance_tolerance=distance_tolerance,
+        energy_tolerance=energy_tolerance,
+    )
+    representatives = np.unique(labels)
+    representatives = representatives[
+        np.argsort(energies[representatives], kind="stable")
+    ]
+    members = np.bincount(labels, minlength=len(labels))[representatives]
+    return {
+        "labels": labels,
+        "representatives": representatives,
+        "members": members,
+        "multiplicities": orbit_multiplicities(
+            frac_muons[representatives], cell, rotations, translations
+        ),
+    }
@@ -0,0 +1,261 @@
+"""Estimate of the computational cost of the muon workflow, before submitting it.
+
+The model counts the relaxations, and for each muon supercell the electrons, bands,
+k-points, plane waves and FFT grid points. The CPU time is proportional to the work of
+one self-consistent iteration (FFTs plus orthogonalization of the bands), with a
+constant calibrated on the relaxations already finished in the profile, if any.
+"""
+import functools
+
+import numpy as np
+
+from aiidalab_qe_muon.utils.kmesh import kpoints_mesh
+
+RY_TO_EV = 13.605693122994
+BOHR_TO_ANGSTROM = 0.529177210903
+
+# average number of SCF iterations in a relaxation (ionic steps x iterations per step).
+SCF_ITERATIONS_PER_RELAXATION = 20 * 15
+# core-seconds per unit of work of one SCF iteration, if nothing can be calibrated.
+DEFAULT_SECONDS_PER_UNIT = 2e-9
+# defaults when the pseudopotential family is not available.
+DEFAULT_ECUTWFC = 45.0
+DEFAULT_DUAL = 8.0
+# the DFT+U projections add a small overhead to each iteration.
+HUBBARD_OVERHEAD = 1.1
+
+NOBLE_GASES = np.array([0, 2, 10, 18, 36, 54, 86, 118])
+
+
+def valence_electrons(numbers):
+    """Approximate valence electrons: Z minus the electrons of the last noble gas."""
+    numbers = np.asarray(numbers)
+    core = NOBLE_GASES[np.searchsorted(NOBLE_GASES, numbers, side="left") - 1]
+    return numbers - core
+
+
+def plane_waves(volume, ecut):
+    """Number of plane waves below ``ecut`` (Ry) in ``volume`` (Angstrom^3)."""
+    volume_bohr = volume / BOHR_TO_ANGSTROM**3
+    return volume_bohr * ecut**1.5 / (6 * np.pi**2)
+
+
+def fft_points(volume, ecutrho):
+    """Number of FFT grid points for the charge density cutoff ``ecutrho`` (Ry)."""
+    volume_bohr = volume / BOHR_TO_ANGSTROM**3
+    return volume_bohr * (np.sqrt(ecutrho) / np.pi) ** 3
+
+
+def number_of_bands(electrons):
+    """Number of bands used by pw.x by default for metals and spin-polarised systems."""
+    return int(max(np.ceil(1.2 * electrons / 2), np.ceil(electrons / 2) + 4))
+
+
+def work_units(n_kpoints, n_bands, n_pw, n_fft):
+    """Work of one SCF iteration: FFTs of all the bands and their orthogonalization."""
+    return n_kpoints * n_bands * (n_fft * np.log2(max(n_fft, 2)) + n_bands * n_pw)
+
+
+def memory_bytes(n_kpoints, n_bands, n_pw, n_fft):
+    """Rough memory of pw.x: wavefunctions (all k-points plus the Davidson workspace)
+    and some tens of arrays on the FFT grid."""
+    return 16 * n_pw * n_bands * (n_kpoints + 3) + 16 * n_fft * 30
+
+
+def estimate_cost(
+    cell,
+    numbers,
+    sc_matrix,
+    n_relaxations,
+    kpoints_distance,
+    ecutwfc=None,
+    ecutrho=None,
+    z_valence=None,
+    spin_polarized=False,
+    hubbard=False,
+    charged_muon=True,
+    seconds_per_unit=None,
+):
+    """Estimate the cost of relaxing ``n_relaxations`` muon supercells.
+
+    :param cell: (3, 3) lattice vectors of the unit cell, as rows.
+    :param numbers: atomic numbers of the unit cell.
+    :param sc_matrix: the supercell matrix (3, 3), or its diagonal.
+    :param n_relaxations: number of muon supercells to be relaxed.
+    :param kpoints_distance: k-points distance in 1/Angstrom.
+    :param ecutwfc: wavefunction cutoff in Ry.
+    :param ecutrho: charge density cutoff in Ry.
+    :param z_valence: dictionary {atomic number: valence electrons} of the
+        pseudopotentials; the missing ones are approximated by ``valence_electrons``.
+    :param spin_polarized: whether the calculations are spin polarised.
+    :param hubbard: whether the DFT+U correction is used.
+    :param charged_muon: whether the muon is charged (+1) or neutral (muonium).
+    :param seconds_per_unit: core-seconds per unit of work, see
+        ``calibrate_seconds_per_unit``.
+    :return: dictionary with the estimate, per relaxation and in total.
+    """
+    cell = np.asarray(cell, dtype=float)
+    numbers = np.asarray(numbers)
+    sc_matrix = np.asarray(sc_matrix, dtype=int)
+    if sc_matrix.ndim == 1:
+        sc_matrix = np.diag(sc_matrix)
+    ecutwfc = ecutwfc or DEFAULT_ECUTWFC
+    ecutrho = ecutrho or DEFAULT_DUAL * ecutwfc
+    seconds_per_unit = seconds_per_unit or DEFAULT_SECONDS_PER_UNIT
+
+    n_cells = int(round(abs(np.linalg.det(sc_matrix))))
+    volume = abs(np.linalg.det(cell)) * n_cells
+    valence = valence_electrons(numbers)
+    if z_valence:
+        valence = np.array([z_valence.get(Z, v) for Z, v in zip(numbers, valence)])
+    # the muon is a hydrogen atom, with its electron removed if it is charged.
+    electrons = float(np.sum(valence)) * n_cells + (0 if charged_muon else 1)
+
+    mesh = kpoints_mesh(cell, sc_matrix, kpoints_distance)
+    # the muon breaks the symmetry of the crystal: only time reversal is left.
+    n_kpoints = max(1, int(np.ceil(np.prod(mesh) / 2)))
+    n_ks = n_kpoints * (2 if spin_polarized else 1)
+    n_bands = number_of_bands(electrons)
+    n_pw = plane_waves(volume, ecutwfc)
+    n_fft = fft_points(volume, ecutrho)
+
+    seconds = (
+        work_units(n_ks, n_bands, n_pw, n_fft)
+        * SCF_ITERATIONS_PER_RELAXATION
+        * seconds_per_unit
+        * (HUBBARD_OVERHEAD if hubbard else 1.0)
+    )
+    return {
+        "relaxations": int(n_relaxations),
+        "atoms": int(len(numbers) * n_cells + 1),
+        "electrons": electrons,
+        "bands": n_bands,
+        "kpoints_mesh": list(mesh),
+        "kpoints": n_kpoints,
+        "plane_waves": int(n_pw),
+        "fft_points": int(n_fft),
+        "memory_gb": float(memory_bytes(n_ks, n_bands, n_pw, n_fft) / 1024**3),
+        "core_hours_per_relaxation": float(seconds / 3600),
+        "core_hours": float(seconds / 3600 * n_relaxations),
+        "seconds_per_unit": seconds_per_unit,
+    }
+
+
+def pseudo_family_info(family_label, structure):
+    """Recommended cutoffs (Ry) and valence electrons of a pseudopotential family.
+
+    :param family_label: label of the installed pseudopotential family.
+    :param structure: ``StructureData``.
+    :return: tuple (ecutwfc, ecutrho, {atomic number: valence}), or (None, None, None)
+        if the family is not installed or does not cover the structure.
+    """
+    from aiida import orm
+    from ase.data import atomic_numbers
+
+    try:
+        family = orm.load_group(family_label)
+        ecutwfc, ecutrho = family.get_recommended_cutoffs(
+            structure=structure, unit="Ry"
+        )
+        pseudos = family.get_pseudos(structure=structure)
+    except Exception:
+        return None, None, None
+    z_valence = {
+        atomic_numbers[structure.get_kind(kind).symbol]: pseudo.z_valence
+        for kind, pseudo in pseudos.items()
+    }
+    return ecutwfc, ecutrho, z_valence
+
+
+def _finished_relaxations():
+    """QueryBuilder of the finished pw.x relaxations, tagged "calc"."""
+    from aiida import orm
+
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.CalcJobNode,
+        filters={
+            "process_type": "aiida.calculations:quantumespresso.pw",
+            "attributes.exit_status": 0,
+        },
+        tag="calc",
+    )
+    qb.append(
+        orm.Dict,
+        with_outgoing="calc",
+        edge_filters={"label": "parameters"},
+        filters={"attributes.CONTROL.calculation": "relax"},
+    )
+    return qb
+
+
+def calibrate_seconds_per_unit(profile_name=None, max_runs=200):
+    """Calibrate the core-seconds per unit of work on the finished pw.x relaxations.
+
+    The measured core-seconds of each run are compared with the work predicted from its
+    own output parameters, and the median ratio is used. The result is cached per
+    profile, and computed again only when a new relaxation has finished.
+
+    :param profile_name: only used as key of the cache; the current profile is queried.
+    :return: tuple (core-seconds per unit, number of runs used), (None, 0) if none.
+    """
+    qb = _finished_relaxations()
+    qb.add_projection("calc", "id")
+    qb.order_by({"calc": {"id": "desc"}}).limit(1)
+    latest = qb.first(flat=True)
+    return _calibrate_seconds_per_unit(profile_name, latest, max_runs)
+
+
+@functools.lru_cache(maxsize=None)
+def _calibrate_seconds_per_unit(profile_name, latest, max_runs):
+    from aiida import orm
+
+    qb = _finished_relaxations()
+    qb.add_projection("calc", "attributes.resources")
+    qb.append(
+        orm.Dict,
+        with_incoming="calc",
+        edge_filters={"label": "output_parameters"},
+        project=["attributes"],
+    )
+    qb.order_by({"calc": {"ctime": "desc"}}).limit(max_runs)
+
+    ratios = []
+    for resources, output in qb.iterall():
+        try:
+            n_procs = resources.get("tot_num_mpiprocs") or (
+                resources["num_machines"] * resources["num_mpiprocs_per_machine"]
+            )
+            n_spin = output.get("number_of_spin_components", 1)
+            n_ks = output["number_of_k_points"] * n_spin
+            n_pw = plane_waves(output["volume"], output["wfc_cutoff"] / RY_TO_EV)
+            n_fft = fft_points(output["volume"], output["rho_cutoff"] / RY_TO_EV)
+            work = work_units(n_ks, output["number_of_bands"], n_pw, n_fft)
+            # the measured time is the one of all the SCF iterations of the run: the
+            # ratio is per iteration, as the estimate (the average count is assumed).
+            iterations = output.get(
+                "total_number_of_scf_iterations", SCF_ITERATIONS_PER_RELAXATION
+            )
+            seconds = output["wall_time_seconds"] * n_procs
+            ratios.append(seconds / (work * iterations))
+        except (KeyError, TypeError, ZeroDivisionError):
+            continue
+    if not ratios:
+        return None, 0
+    return float(np.median(ratios)), len(ratios)
+
+
+def format_cost(estimate, n_calibration_runs=0):
+    """Short HTML summary of an estimate, for the widgets."""
+    calibration = (
+        f"calibrated on {n_calibration_runs} finished relaxations"
+        if n_calibration_runs
+        else "not calibrated: no finished relaxation in this profile"
+    )
+    return (
+        f"Estimated cost: {estimate['relaxations']} relaxations of "
+        f"{estimate['atoms']} atoms, {estimate['electrons']:.0f} electrons, "
+        f"{estimate['kpoints']} k-points, ~{estimate['plane_waves']} plane waves; "
+        f"~{estimate['memory_gb']:.1f} GB per relaxation, "
+        f"~{estimate['core_hours']:.0f} core-hours in total ({calibration})."
+    )
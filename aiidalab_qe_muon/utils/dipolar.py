@@ -0,0 +1,81 @@
+"""Local fields at the muon sites.
+
+Dipolar lattice sums of the magnetic moments of the host, and contact hyperfine field
+from the spin density. The dipolar field is summed over the moments inside a Lorentz
+sphere centered at the muon; the moments outside are a uniform magnetization, which
+gives the Lorentz field mu0 M / 3 (the demagnetizing field depends on the shape of the
+sample and is not included).
+"""
+import numpy as np
+
+from aiidalab_qe_muon.utils.second_moments import lattice_translations
+
+# mu0 / (4 pi) * mu_B, in T A^3: the field of 1 mu_B at 1 A is of this order.
+DIPOLAR_CONSTANT = 0.9274010078
+# (2 / 3) mu0 mu_B, in T bohr^3: contact field of a spin density of 1 mu_B / bohr^3.
+CONTACT_CONSTANT = 52.4304
+
+
+def dipolar_field(cell, positions, moments, muon, radius=100.0):
+    """Dipolar and Lorentz fields at a muon site, in T.
+
+    :param cell: (3, 3) array, lattice vectors as rows (Angstrom).
+    :param positions: (n, 3) cartesian positions of the atoms (Angstrom).
+    :param moments: (n, 3) magnetic moments of the atoms, in Bohr magnetons.
+    :param muon: cartesian position of the muon.
+    :param radius: radius of the Lorentz sphere (Angstrom).
+    :return: `Bdip`, the sum over the moments inside the sphere, and `B_L`, the
+        Lorentz field.
+    """
+    cell = np.asarray(cell, dtype=float)
+    moments = np.asarray(moments, dtype=float).reshape(-1, 3)
+    inv_cell = np.linalg.inv(cell)
+    displacement = np.asarray(positions, dtype=float) - np.asarray(muon, dtype=float)
+    frac = displacement @ inv_cell
+    d = (frac - np.round(frac)) @ cell
+
+    translations = lattice_translations(cell, radius) @ cell
+    r = translations[:, None, :] + d[None, :, :]
+    r2 = np.einsum("tni,tni->tn", r, r)
+    inside = (r2 < radius**2) & (r2 > 1e-12)
+    r, r2 = r[inside], r2[inside]
+    m = np.broadcast_to(moments, inside.shape + (3,))[inside]
+
+    m_dot_r = np.einsum("ni,ni->n", m, r)
+    terms = 3 * r * (m_dot_r / r2**2.5)[:, None] - m / r2[:, None] ** 1.5
+    Bdip = DIPOLAR_CONSTANT * terms.sum(axis=0)
+    # mu0 M / 3 = (4 pi / 3) (mu0 / 4 pi) M.
+    magnetization = moments.sum(axis=0) / abs(np.linalg.det(cell))
+    B_L = DIPOLAR_CONSTANT * 4 * np.pi / 3 * magnetization
+    return Bdip, B_L
+
+
+def periodic_interpolation(data, frac):
+    """Trilinear interpolation of a periodic grid at fractional coordinates.
+
+    :param data: (n1, n2, n3) values at the points i / n of the cell (pp.x output).
+    :param frac: fractional coordinates of the point.
+    """
+    data = np.asarray(data, dtype=float)
+    shape = np.array(data.shape)
+    x = np.mod(np.asarray(frac, dtype=float), 1.0) * shape
+    lower = np.floor(x).astype(int)
+    weights = x - lower
+    value = 0.0
+    for corner in np.ndindex(2, 2, 2):
+        corner = np.array(corner)
+        weight = np.prod(np.where(corner, weights, 1 - weights))
+        value += weight * data[tuple((lower + corner) % shape)]
+    return value
+
+
+def contact_field(spin_density, frac):
+    """Contact hyperfine field at a muon site.
+
+    :param spin_density: (n1, n2, n3) spin density of the supercell (mu_B / bohr^3),
+        e.g. the `data` of the cube file of pp.x with ``plot_num = 6``.
+    :param frac: fractional coordinates of the muon in the supercell.
+    :return: the spin density at the muon (atomic units) and the field (T).
+    """
+    density = periodic_interpolation(spin_density, frac)
+    return density, CONTACT_CONSTANT * density
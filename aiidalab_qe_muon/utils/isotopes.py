@@ -0,0 +1,86 @@
+"""Nuclear isotope data, loaded on first use.
+
+The EasySpin table shipped in ``app/data/isotopedata.txt`` is compiled into
+``app/data/isotopedata.npz`` (see ``build_isotope_table``), which stores the isotopes
+sorted by atomic number together with the per-Z offsets and the abundance-weighted
+I(I+1)(gamma)^2 factors, so that every lookup is a plain array indexing.
+"""
+import functools
+
+import numpy as np
+from importlib_resources import as_file, files
+
+munhbar = 7.622593285e6 * 2 * np.pi  # mu_N/hbar, SI
+
+DATA_FOLDER = files("aiidalab_qe_muon") / "app" / "data"
+ISOTOPE_TABLE_SOURCE = DATA_FOLDER / "isotopedata.txt"
+ISOTOPE_TABLE = DATA_FOLDER / "isotopedata.npz"
+
+
+def _compile_table(source):
+    """Parse the text table and return the arrays stored in the compiled table."""
+    # columns: Z, A, radioactive, symbol, name, spin, g, abundance (%), quadrupole
+    table = np.loadtxt(source, comments="%", usecols=(0, 1, 5, 6, 7))
+    table = table[np.argsort(table[:, 0], kind="stable")]
+    Z = table[:, 0].astype(int)
+    spin, g_factor, abundance = table[:, 2], table[:, 3], table[:, 4]
+
+    offsets = np.searchsorted(Z, np.arange(Z.max() + 2))
+    weighted = (abundance / 100) * spin * (spin + 1) * (munhbar * g_factor) ** 2
+    species_average = np.add.reduceat(weighted, offsets[:-1].clip(max=len(Z) - 1))
+    # reduceat does not give zero for empty slices (elements without any isotope).
+    species_average[offsets[:-1] == offsets[1:]] = 0.0
+
+    return {
+        "Z": Z,
+        "A": table[:, 1].astype(int),
+        "spin": spin,
+        "g_factor": g_factor,
+        "abundance": abundance,
+        "offsets": offsets,
+        "species_average": species_average,
+    }
+
+
+def build_isotope_table(source=ISOTOPE_TABLE_SOURCE, destination=ISOTOPE_TABLE):
+    """Compile the text isotope table into the .npz file of ``get_isotope_table``."""
+    with as_file(source) as path:
+        arrays = _compile_table(path)
+    np.savez(destination, **arrays)
+
+
+@functools.lru_cache(maxsize=None)
+def get_isotope_table():
+    """Return the compiled isotope table as a dictionary of arrays.
+
+    Falls back to parsing the text table if the compiled one is missing.
+    """
+    if ISOTOPE_TABLE.is_file():
+        with as_file(ISOTOPE_TABLE) as path, np.load(path) as npz:
+            return {k: npz[k] for k in npz.files}
+    with as_file(ISOTOPE_TABLE_SOURCE) as path:
+        return _compile_table(path)
+
+
+def get_isotopes(Z):
+    """Return the (abundance, spin, g factor) rows of the isotopes of the element Z."""
+    table = get_isotope_table()
+    if not 0 <= Z < len(table["offsets"]) - 1:
+        return np.empty((0, 3))
+    start, end = table["offsets"][Z], table["offsets"][Z + 1]
+    return np.stack(
+        [
+            table["abundance"][start:end],
+            table["spin"][start:end],
+            table["g_factor"][start:end],
+        ],
+        axis=1,
+    )
+
+
+def isotope_average(Z):
+    """Abundance-weighted I(I+1)(gamma)^2 for the element Z, 0 if it has no isotope."""
+    species_average = get_isotope_table()["species_average"]
+    if not 0 <= Z < len(species_average):
+        return 0.0
+    return species_average[Z]
@@ -0,0 +1,50 @@
+"""K-points mesh of a supercell from the k-points distance, without creating any node.
+
+It reproduces the mesh of the ``create_kpoints_from_distance`` calcfunction of
+aiida-quantumespresso (which is used when submitting), only from the cell metric.
+"""
+import functools
+
+import numpy as np
+
+
+def kpoints_mesh(cell, supercell, distance, pbc=(True, True, True), force_parity=False):
+    """Return the k-points mesh of the supercell for the given k-points distance.
+
+    :param cell: (3, 3) lattice vectors of the unit cell, as rows.
+    :param supercell: the supercell matrix (3, 3), or its diagonal (3,).
+    :param distance: maximum distance between k-points in reciprocal space, 1/Angstrom.
+    :param pbc: periodicity along the three lattice vectors.
+    :param force_parity: force even numbers of k-points along the periodic directions.
+    :return: tuple of three integers.
+    """
+    supercell = np.asarray(supercell, dtype=int)
+    if supercell.ndim == 1:
+        supercell = np.diag(supercell)
+    return _kpoints_mesh(
+        tuple(map(tuple, np.asarray(cell, dtype=float))),
+        tuple(map(tuple, supercell)),
+        float(distance),
+        tuple(bool(p) for p in pbc),
+        bool(force_parity),
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def _kpoints_mesh(cell, supercell, distance, pbc, force_parity):
+    lattice = np.array(supercell) @ np.array(cell)
+    reciprocal = 2.0 * np.pi * np.linalg.inv(lattice).T
+    # rounded to the fifth digit, so that e.g. 3.00000001 does not become 4.
+    mesh = [
+        max(int(np.ceil(round(np.linalg.norm(b) / distance, 5))), 1) if periodic else 1
+        for periodic, b in zip(pbc, reciprocal)
+    ]
+    if force_parity:
+        mesh = [k + (k % 2) if periodic else 1 for periodic, k in zip(pbc, mesh)]
+
+    # if the vectors of the cell all have the same length, the mesh should be isotropic as well.
+    lengths = np.linalg.norm(lattice, axis=1)
+    if np.all(np.abs(lengths - lengths[0]) < 1e-5) and len(set(mesh)) > 1:
+        mesh = [max(mesh) if periodic else 1 for periodic in pbc]
+
+    return tuple(mesh)
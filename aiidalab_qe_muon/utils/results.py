@@ -0,0 +1,599 @@
+"""Post-processing of the muon results, without widgets: columnar results of the unique
+muon sites, unit cell with all the sites, second moments, and their serialization for
+the results cache.
+
+Used by the results panel of the app and by the ``muon_results`` command line.
+"""
+from collections.abc import Mapping
+
+from aiida import orm
+
+import numpy as np
+
+from pymatgen.core import Structure
+
+from aiidalab_qe_muon.utils.second_moments import second_moments
+
+
+def compute_second_moments(atms, cutoff_distances=None, tolerance=None):
+    """
+    Compute second moments taking care of isotope averages.
+    All the species are summed in a single pass over the periodic images, see
+    ``aiidalab_qe_muon.utils.second_moments.inverse_sixth_sums``.
+
+    If ``tolerance`` is given, the fixed cutoffs are ignored and the sums are
+    converged shell by shell with a continuum tail correction, see
+    ``second_moment_convergence``.
+    """
+    if cutoff_distances is None:
+        cutoff_distances = {}
+    radii, moments = second_moments(
+        atms.cell.array,
+        atms.positions,
+        atms.get_atomic_numbers(),
+        cutoff=40,
+        cutoff_distances=cutoff_distances,
+        tolerance=tolerance,
+        pbc=atms.pbc,
+    )
+    return {e: values[-1] for e, values in moments.items()}
+
+
+def second_moment_convergence(atms, tolerance=1e-3, r_max=40.0):
+    """
+    Second moments as a function of the cutoff, computed in one pass by accumulating
+    shells until the tail-corrected value changes less than ``tolerance``.
+
+    Returns the array of cutoffs and a dictionary {Z: array of second moments for each
+    cutoff}.
+    """
+    return second_moments(
+        atms.cell.array,
+        atms.positions,
+        atms.get_atomic_numbers(),
+        cutoff=r_max,
+        tolerance=tolerance,
+        pbc=atms.pbc,
+    )
+
+
+# (1) columnar results of the unique muon sites.
+def query_relaxation_outputs(uuids):
+    """
+    Return {uuid: (energy, output_structure)} for the given relaxation workchains,
+    fetched with a single query: the energy is projected from the attributes of the
+    `output_parameters` and the `output_structure` nodes come in the same rows.
+    """
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.WorkflowNode,
+        filters={"uuid": {"in": list(uuids)}},
+        project=["uuid"],
+        tag="relax",
+    )
+    qb.append(
+        orm.Dict,
+        with_incoming="relax",
+        edge_filters={"label": "output_parameters"},
+        project=["attributes.energy"],
+    )
+    qb.append(
+        orm.StructureData,
+        with_incoming="relax",
+        edge_filters={"label": "output_structure"},
+        project=["*"],
+    )
+    return {uuid: (energy, structure) for uuid, energy, structure in qb.iterall()}
+
+
+class StructureStore(Mapping):
+    """
+    Read-only mapping {pk: StructureData} of the relaxed structures, loaded lazily: all
+    the nodes are fetched with a single query at the first access, and then kept.
+    """
+
+    def __init__(self, pks, nodes=None):
+        """
+        :param nodes: optional {pk: StructureData} already loaded, e.g. by the query of
+            the results.
+        """
+        self._pks = [int(pk) for pk in pks]
+        self._nodes = dict(nodes) if nodes is not None else None
+
+    def _load(self):
+        if self._nodes is None:
+            qb = orm.QueryBuilder().append(
+                orm.StructureData,
+                filters={"id": {"in": self._pks}},
+                project=["id", "*"],
+            )
+            self._nodes = dict(qb.all())
+        return self._nodes
+
+    def __getitem__(self, pk):
+        return self._load()[int(pk)]
+
+    def __iter__(self):
+        return iter(self._pks)
+
+    def __len__(self):
+        return len(self._pks)
+
+
+class MuonResults:
+    """
+    Results of the unique muon sites, sorted by energy, in fixed-dtype arrays with one
+    row per site: `labels` (the muon indices, str), `energy` (eV), `positions` (n x 3,
+    fractional coordinates of the muon in its supercell), `structure_pks`, and if
+    computed the fields `B_T` and `Bdip` (n x 3, T), `hyperfine_norm` (T) and the
+    `second_moment`; the missing values are NaN. The relaxed structures are in
+    `structures`, a lazy ``StructureStore`` keyed by pk.
+    """
+
+    vectors = ("B_T", "Bdip")
+
+    def __init__(
+        self,
+        labels,
+        energy,
+        positions,
+        structure_pks,
+        B_T=None,
+        Bdip=None,
+        hyperfine_norm=None,
+        second_moment=None,
+        structures=None,
+    ):
+        n = len(labels)
+        self.labels = np.asarray(labels, dtype=str)
+        self.energy = np.asarray(energy, dtype=np.float64)
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(n, 3)
+        self.structure_pks = np.asarray(structure_pks, dtype=np.int64)
+        self.B_T = (
+            None if B_T is None else np.asarray(B_T, dtype=np.float64).reshape(n, 3)
+        )
+        self.Bdip = (
+            None if Bdip is None else np.asarray(Bdip, dtype=np.float64).reshape(n, 3)
+        )
+        self.hyperfine_norm = (
+            None
+            if hyperfine_norm is None
+            else np.asarray(hyperfine_norm, dtype=np.float64)
+        )
+        self.second_moment = (
+            None
+            if second_moment is None
+            else np.asarray(second_moment, dtype=np.float64)
+        )
+        self.structures = (
+            structures if structures is not None else StructureStore(self.structure_pks)
+        )
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def delta_E(self):
+        return self.energy - self.energy.min() if len(self) else self.energy.copy()
+
+    def norm(self, key):
+        """Norm of the field `key` ("B_T" or "Bdip") of each site."""
+        return np.linalg.norm(getattr(self, key), axis=1)
+
+    def structure(self, label):
+        """Relaxed structure of the site `label`."""
+        return self.structures[self.structure_pks[self.labels.tolist().index(label)]]
+
+    @classmethod
+    def from_findmuon(cls, findmuon_output_node):
+        """Collect the results from the outputs of the search of the muon sites
+        (`unique_sites`, `all_index_uuid` and, if computed, `unique_sites_dipolar` and
+        `unique_sites_hyperfine`)."""
+        # each Dict is deserialized only once.
+        unique_sites = findmuon_output_node.unique_sites.get_dict()
+        all_index_uuid = {
+            idx: uuid
+            for idx, uuid in findmuon_output_node.all_index_uuid.get_dict().items()
+            if idx in unique_sites
+        }
+        relaxations = query_relaxation_outputs(all_index_uuid.values())
+
+        labels = list(all_index_uuid)
+        energy = np.array(
+            [relaxations[all_index_uuid[idx]][0] for idx in labels], dtype=float
+        )
+        order = np.argsort(energy, kind="stable")
+        labels = [labels[i] for i in order]
+        nodes = [relaxations[all_index_uuid[idx]][1] for idx in labels]
+        fields = {
+            "positions": [unique_sites[idx][0]["sites"][-1]["abc"] for idx in labels],
+            "structure_pks": [node.pk for node in nodes],
+        }
+
+        if "unique_sites_dipolar" in findmuon_output_node:
+            configurations = findmuon_output_node.unique_sites_dipolar.get_list()
+            dipolar = {
+                str(configuration["idx"]): configuration
+                for configuration in configurations
+            }
+            for key in cls.vectors:
+                fields[key] = [
+                    dipolar[idx][key] if idx in dipolar else [np.nan] * 3
+                    for idx in labels
+                ]
+            if "unique_sites_hyperfine" in findmuon_output_node:
+                hyperfine = findmuon_output_node.unique_sites_hyperfine.get_dict()
+                # the last entry is in T (the first is in atomic units).
+                fields["hyperfine_norm"] = [
+                    abs(hyperfine[idx][-1])
+                    if idx in dipolar and idx in hyperfine
+                    else np.nan
+                    for idx in labels
+                ]
+
+        return cls(
+            labels,
+            energy[order],
+            structures=StructureStore(
+                fields["structure_pks"], {node.pk: node for node in nodes}
+            ),
+            **fields,
+        )
+
+    def columns(self):
+        """Flat {column: (n,) array}: one column per component of the vectors, plus
+        their norms."""
+        columns = {
+            "site": self.labels.astype(int),
+            "energy": self.energy,
+            "delta_E": self.delta_E,
+            "structure": self.structure_pks,
+        }
+        for key in ["positions"] + [
+            key for key in self.vectors if getattr(self, key) is not None
+        ]:
+            values = getattr(self, key)
+            name = "position" if key == "positions" else key
+            for axis, component in zip("xyz", values.T):
+                columns[f"{name}_{axis}"] = component
+            if key in self.vectors:
+                columns[f"{key}_norm"] = self.norm(key)
+        for key in ["hyperfine_norm", "second_moment"]:
+            if getattr(self, key) is not None:
+                columns[key] = getattr(self, key)
+        return columns
+
+    def to_dataframe(self):
+        """Frame for display, one column per site (the muon index) and one row per
+        quantity, as in the tables of the results panel; the values are rounded and the
+        structures given by pk."""
+        import pandas as pd
+
+        rows = {
+            "tot_energy": self.energy,
+            "structure": self.structure_pks,
+            "muon_index": self.labels.tolist(),
+            "muon_position_cc": np.round(self.positions, 3).tolist(),
+        }
+        for key in self.vectors:
+            if getattr(self, key) is not None:
+                rows[key] = np.round(getattr(self, key), 3).tolist()
+        for key in self.vectors:
+            if getattr(self, key) is not None:
+                rows[f"{key}_norm"] = np.round(self.norm(key), 3)
+        if self.hyperfine_norm is not None:
+            rows["hyperfine_norm"] = np.round(self.hyperfine_norm, 3)
+        rows["delta_E"] = self.delta_E
+        return pd.DataFrame.from_dict(
+            {key: list(values) for key, values in rows.items()},
+            orient="index",
+            columns=self.labels.tolist(),
+        )
+
+    def to_arrays(self):
+        """Plain arrays, e.g. for the ``ResultCache``; structures are stored by pk."""
+        arrays = {
+            "labels": self.labels,
+            "energy": self.energy,
+            "positions": self.positions,
+            "structure_pks": self.structure_pks,
+        }
+        for key in self.vectors + ("hyperfine_norm", "second_moment"):
+            if getattr(self, key) is not None:
+                arrays[key] = getattr(self, key)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Inverse of ``to_arrays``."""
+        keys = (
+            ("labels", "energy", "positions", "structure_pks")
+            + cls.vectors
+            + ("hyperfine_norm", "second_moment")
+        )
+        return cls(**{key: arrays[key] for key in keys if key in arrays})
+
+
+def produce_muonic_dataframe(findmuon_output_node):
+    """Frame for display of the unique muon sites, see ``MuonResults.to_dataframe``."""
+    return MuonResults.from_findmuon(findmuon_output_node).to_dataframe()
+
+
+# (2) unit cell with all muonic sites.
+
+
+def produce_collective_unit_cell(findmuon_output_node, proximity_tolerance=0.5):
+    """Unit cell of the host with all the unique muon sites, as H sites of kind
+    "H<index>" tagged by their index.
+
+    The muons (last site of each relaxed supercell) are folded into the unit cell all at
+    once, with the supercell matrix of each site obtained from its own lattice, so that
+    it works also for the supercells generated by musconv; the proximity of the sites is
+    checked once, and the structure is built at the end.
+
+    :raises ValueError: if a muon is closer than ``proximity_tolerance`` (Angstrom) to
+        another site.
+    """
+    from aiidalab_qe_muon.utils.sites import close_sites, fold_muons
+
+    run = findmuon_output_node.all_index_uuid.creator.caller
+    input_str = run.inputs.structure.get_pymatgen()
+    unique_sites = findmuon_output_node.unique_sites.get_dict()
+    labels = list(unique_sites)
+
+    lattices = np.array(
+        [unique_sites[key][0]["lattice"]["matrix"] for key in labels], dtype=float
+    ).reshape(-1, 3, 3)
+    muons = np.array(
+        [unique_sites[key][0]["sites"][-1]["abc"] for key in labels], dtype=float
+    ).reshape(-1, 3)
+    frac_muons = fold_muons(input_str.lattice.matrix, lattices, muons)
+
+    close = close_sites(
+        input_str.lattice.matrix, input_str.frac_coords, frac_muons, proximity_tolerance
+    )
+    if close:
+        names = [str(site.species) for site in input_str] + [
+            "H" + key for key in labels
+        ]
+        raise ValueError(
+            "muon sites too close to other sites: "
+            + ", ".join(f"H{labels[i]}-{names[j]}" for i, j in close)
+        )
+
+    site_properties = {
+        key: list(values) + [None] * len(labels)
+        for key, values in input_str.site_properties.items()
+    }
+    # the muons are H sites named by their kind: a species "H1" would be read as H+
+    # by pymatgen, which the StructureData of the viewer cannot convert.
+    site_properties["kind_name"] = site_properties.get(
+        "kind_name", [None] * (len(input_str) + len(labels))
+    )[: len(input_str)] + ["H" + key for key in labels]
+    unit_cell = Structure(
+        input_str.lattice,
+        [site.species for site in input_str] + ["H"] * len(labels),
+        np.concatenate([input_str.frac_coords, frac_muons]),
+        site_properties=site_properties,
+    )
+    # tags to recognize the muon sites.
+    unit_cell.tags = [None] * len(input_str) + labels
+    return unit_cell
+
+
+# (3) second moments and cache of the post-processed results.
+
+
+def compute_sites_second_moments(results, tolerance=1e-3):
+    """Total second moment of each muon site of the ``MuonResults``, (n,) array in the
+    order of the sites."""
+    return np.array(
+        [
+            np.sum(
+                list(
+                    compute_second_moments(
+                        results.structures[pk].get_ase(), tolerance=tolerance
+                    ).values()
+                )
+            )
+            for pk in results.structure_pks
+        ],
+        dtype=float,
+    )
+
+
+def results_to_arrays(results, unit_cell):
+    """Serialize the post-processed results into plain arrays, to be stored in the
+    ``ResultCache``. The structure nodes are stored by pk.
+    """
+    import json
+
+    return {
+        **results.to_arrays(),
+        "unit_cell": np.array(json.dumps(unit_cell.as_dict())),
+        "tags": np.array(json.dumps(unit_cell.tags)),
+    }
+
+
+def results_from_arrays(arrays):
+    """Inverse of ``results_to_arrays``: return the ``MuonResults`` (whose structures
+    are loaded lazily, with a single query) and the unit cell with all the muon sites.
+    """
+    import json
+
+    unit_cell = Structure.from_dict(json.loads(str(arrays["unit_cell"])))
+    unit_cell.tags = json.loads(str(arrays["tags"]))
+    return MuonResults.from_arrays(arrays), unit_cell
+
+
+# (4) headless export of the results of finished runs.
+
+
+def findmuon_outputs(node):
+    """Outputs of the search of the muon sites (with `unique_sites` and
+    `all_index_uuid`) of a QE app, `ImplantMuonWorkChain` or `FindMuonWorkChain` node;
+    None if there are none."""
+    outputs = node.outputs
+    for namespace in ["muonic", "findmuon"]:
+        if namespace in outputs:
+            outputs = outputs[namespace]
+    return outputs if "unique_sites" in outputs else None
+
+
+def pruned_sites(findmuon_output_node, reference_energy=None):
+    """Candidate sites pruned by energy by the run (trigger "sites" with `prune_energy`),
+    whose relaxations were stopped after `prune_steps` ionic steps.
+
+    :param reference_energy: energy of the lowest relaxed site, the reference of
+        `delta_E`; by default, the best energy known when each site was pruned.
+    :return: dictionary of (n_pruned,) arrays, sorted by energy: `site`, `energy`,
+        `delta_E` and `steps`; empty arrays for the runs without pruned sites.
+    """
+    run = findmuon_output_node.all_index_uuid.creator.caller
+    pruned = (
+        run.outputs.pruned_sites.get_dict() if "pruned_sites" in run.outputs else {}
+    )
+    labels = sorted(pruned, key=lambda idx: pruned[idx]["energy"])
+    energy = np.array([pruned[idx]["energy"] for idx in labels], dtype=float)
+    if reference_energy is None:
+        delta_E = np.array([pruned[idx]["delta_E"] for idx in labels], dtype=float)
+    else:
+        delta_E = energy - reference_energy
+    return {
+        "site": np.array(labels, dtype=str),
+        "energy": energy,
+        "delta_E": delta_E,
+        "steps": np.array([pruned[idx]["steps"] for idx in labels], dtype=int),
+    }
+
+
+def export_results(node, tolerance=1e-3, times=None):
+    """Table of the unique muon sites of a finished run and their Kubo-Toyabe curves, as
+    plain arrays.
+
+    :param tolerance: convergence tolerance of the second moments.
+    :param times: times of the Kubo-Toyabe curves, in s; by default 1000 points up to 40
+        microseconds.
+    :return: dictionary with `sites`, {column: (n_sites,) array}, see
+        ``MuonResults.columns``, plus the pk of the `run`, `times` and `kubo_toyabe`,
+        (n_sites, n_times) array; None if the run has no muon sites.
+    """
+    from aiidalab_qe_muon.utils.kubo_toyabe import kubo_toyabe_sites
+
+    outputs = findmuon_outputs(node)
+    if outputs is None:
+        return None
+    times = (
+        np.linspace(0, 40e-6, 1000) if times is None else np.asarray(times, dtype=float)
+    )
+    results = MuonResults.from_findmuon(outputs)
+    results.second_moment = compute_sites_second_moments(results, tolerance=tolerance)
+
+    return {
+        "sites": {"run": np.full(len(results), node.pk), **results.columns()},
+        "times": times,
+        "kubo_toyabe": kubo_toyabe_sites(results.second_moment, times),
+    }
+
+
+# (5) re-clustering of all the relaxed muon sites, with other tolerances.
+
+
+def query_relaxed_muons(uuids):
+    """
+    Return {uuid: (energy, cell, muon position)} for the given relaxation workchains,
+    with a single query projecting only the attributes (no nodes are loaded): the muon
+    is the last site of the `output_structure`. The relaxations without outputs (failed)
+    are missing.
+    """
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.WorkflowNode,
+        filters={"uuid": {"in": list(uuids)}},
+        project=["uuid"],
+        tag="relax",
+    )
+    qb.append(
+        orm.Dict,
+        with_incoming="relax",
+        edge_filters={"label": "output_parameters"},
+        project=["attributes.energy"],
+    )
+    qb.append(
+        orm.StructureData,
+        with_incoming="relax",
+        edge_filters={"label": "output_structure"},
+        project=["attributes.cell", "attributes.sites"],
+    )
+    return {
+        uuid: (energy, cell, sites[-1]["position"])
+        for uuid, energy, cell, sites in qb.iterall()
+    }
+
+
+def recluster_sites(
+    findmuon_output_node, distance_tolerance=0.5, energy_tolerance=0.05, symprec=None
+):
+    """Cluster again all the relaxed muon positions of a run (`all_index_uuid`, not only
+    the unique sites), with the given tolerances, see
+    ``aiidalab_qe_muon.utils.clustering.cluster_muon_sites``.
+
+    :param symprec: tolerance of spglib, by default the one of the run (or 1e-3).
+    :return: dictionary of (n_clusters,) arrays, sorted by energy: `site`, the index of
+        the representative; `energy`, `delta_E`, `members`, `multiplicity` and
+        `position_x/y/z`, the fractional coordinates of the representative in the unit
+        cell.
+    """
+    from aiidalab_qe_muon.utils.clustering import cluster_muon_sites
+    from aiidalab_qe_muon.utils.sites import fold_muons
+
+    run = findmuon_output_node.all_index_uuid.creator.caller
+    if symprec is None:
+        symprec = run.inputs.symprec.value if "symprec" in run.inputs else 1e-3
+    structure = run.inputs.structure
+    cell = np.array(structure.cell)
+
+    all_index_uuid = findmuon_output_node.all_index_uuid.get_dict()
+    relaxed = query_relaxed_muons(all_index_uuid.values())
+    labels = np.array(
+        [idx for idx, uuid in all_index_uuid.items() if uuid in relaxed], dtype=str
+    )
+    energy = np.array([relaxed[all_index_uuid[idx]][0] for idx in labels], dtype=float)
+    lattices = np.array(
+        [relaxed[all_index_uuid[idx]][1] for idx in labels], dtype=float
+    ).reshape(-1, 3, 3)
+    muons = np.array(
+        [relaxed[all_index_uuid[idx]][2] for idx in labels], dtype=float
+    ).reshape(-1, 3)
+    frac_muons = fold_muons(
+        cell, lattices, np.einsum("ni,nij->nj", muons, np.linalg.inv(lattices))
+    )
+
+    types = np.unique(
+        [site.kind_name for site in structure.sites], return_inverse=True
+    )[1]
+    positions = np.array([site.position for site in structure.sites])
+    clusters = cluster_muon_sites(
+        cell,
+        positions @ np.linalg.inv(cell),
+        types,
+        frac_muons,
+        energy,
+        symprec=symprec,
+        distance_tolerance=distance_tolerance,
+        energy_tolerance=energy_tolerance,
+    )
+    representatives = clusters["representatives"]
+    return {
+        "site": labels[representatives],
+        "energy": energy[representatives],
+        "delta_E": energy[representatives] - energy[representatives[0]]
+        if len(representatives)
+        else energy[:0],
+        "members": clusters["members"],
+        "multiplicity": clusters["multiplicities"],
+        **{
+            f"position_{axis}": frac_muons[representatives, i]
+            for i, axis in enumerate("xyz")
+        },
+    }
@@ -0,0 +1,127 @@
+"""Reuse of finished relaxations, by a canonical hash of their inputs.
+
+The hash of the inputs of each relaxation is stored in an extra of its node when it is
+submitted: the extras of the profile are the index in which the finished, equivalent
+relaxations are looked up. The hash depends on the structure, the pseudopotentials
+(their md5), the parameters and the k-points mesh, but not on the code, the
+computational resources or the metadata.
+"""
+import hashlib
+import json
+
+import numpy as np
+
+from aiidalab_qe_muon.utils.kmesh import kpoints_mesh
+
+HASH_EXTRA = "muon_relaxation_hash"
+
+
+def canonical_structure(structure):
+    """Canonical representation of a structure.
+
+    The cell, kinds and wrapped fractional positions are rounded to make it insensitive
+    to the numerical noise; the Hubbard parameters are included if any.
+    """
+    cell = np.array(structure.cell)
+    positions = np.array([site.position for site in structure.sites])
+    frac = np.mod(np.round(positions @ np.linalg.inv(cell), 6), 1.0)
+    return {
+        "cell": np.round(cell, 5).tolist(),
+        "pbc": list(structure.pbc),
+        "kinds": sorted(
+            (kind.name, kind.symbols, np.round(kind.weights, 5).tolist())
+            for kind in structure.kinds
+        ),
+        "sites": [
+            [site.kind_name, np.round(f, 5).tolist()]
+            for site, f in zip(structure.sites, frac)
+        ],
+        "hubbard": structure.base.attributes.get("hubbard", None),
+    }
+
+
+def canonical_inputs(inputs):
+    """JSON-serializable representation of a (nested) dictionary of inputs.
+
+    The codes, the `metadata` and the `parent_folder` are skipped; the data nodes are
+    replaced by their content.
+    """
+    from aiida import orm
+
+    canonical = {}
+    for key, value in inputs.items():
+        if key in ["metadata", "parent_folder"] or isinstance(value, orm.AbstractCode):
+            # the starting density (parent folder) does not change the relaxed result.
+            continue
+        if isinstance(value, orm.StructureData):
+            canonical[key] = canonical_structure(value)
+        elif isinstance(value, orm.Dict):
+            canonical[key] = value.get_dict()
+        elif isinstance(value, orm.List):
+            canonical[key] = value.get_list()
+        elif isinstance(value, orm.KpointsData):
+            try:
+                canonical[key] = {"mesh": value.get_kpoints_mesh()}
+            except AttributeError:
+                canonical[key] = {"list": np.round(value.get_kpoints(), 8).tolist()}
+        elif isinstance(value, orm.BaseType):
+            canonical[key] = value.value
+        elif hasattr(value, "md5"):
+            # pseudopotentials
+            canonical[key] = value.md5
+        elif isinstance(value, orm.Data):
+            canonical[key] = value.uuid
+        elif isinstance(value, dict):
+            canonical[key] = canonical_inputs(value)
+        else:
+            canonical[key] = value
+    return canonical
+
+
+def relaxation_hash(structure, inputs):
+    """Hash of the inputs of a `PwRelaxWorkChain` (or `PwBaseWorkChain`) for structure.
+
+    The k-points distance is replaced by the mesh it gives, so that different distances
+    giving the same mesh are equivalent.
+
+    :param inputs: the inputs of the relaxation, without the structure.
+    """
+    canonical = canonical_inputs(inputs)
+    canonical["structure"] = canonical_structure(structure)
+    base = canonical.get("base", canonical)
+    if "kpoints_distance" in base:
+        base["kpoints"] = {
+            "mesh": [
+                list(
+                    kpoints_mesh(
+                        structure.cell,
+                        np.eye(3, dtype=int),
+                        base.pop("kpoints_distance"),
+                        structure.pbc,
+                        base.pop("kpoints_force_parity", False),
+                    )
+                ),
+                [0.0, 0.0, 0.0],
+            ]
+        }
+    serialized = json.dumps(canonical, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def find_relaxation(relaxation_hash):
+    """Most recent successful relaxation of the profile with the given hash, or None."""
+    from aiida import orm
+
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.WorkflowNode,
+        filters={
+            f"extras.{HASH_EXTRA}": relaxation_hash,
+            "attributes.process_state": "finished",
+            "attributes.exit_status": 0,
+        },
+        tag="relax",
+    )
+    qb.order_by({"relax": {"ctime": "desc"}}).limit(1)
+    result = qb.first()
+    return result[0] if result else None
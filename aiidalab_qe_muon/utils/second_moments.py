@@ -0,0 +1,246 @@
+"""Periodic r^-6 lattice sums used for the nuclear dipolar second moment at the muon
+sites.
+
+All the species are accumulated in a single pass: the lattice translations needed to
+reach the cutoff are built once, and the r^-6 contributions of every atom are reduced
+per atomic number with ``np.bincount``.
+"""
+import numpy as np
+
+
+def lattice_translations(cell, cutoff, pbc=(True, True, True)):
+    """Return the integer lattice translations needed to find all the periodic images
+    within ``cutoff`` of a point, once the displacements are wrapped in [-0.5, 0.5).
+
+    :param cell: (3, 3) array, lattice vectors as rows.
+    :param cutoff: the radius in Angstrom.
+    :param pbc: periodicity along the three lattice vectors.
+    :return: (n, 3) integer array of translations.
+    """
+    cell = np.asarray(cell, dtype=float)
+    # 1/|b_j| is the distance between the lattice planes orthogonal to b_j.
+    reciprocal_norms = np.linalg.norm(np.linalg.inv(cell), axis=0)
+    reps = np.ceil(cutoff * reciprocal_norms + 0.5).astype(int)
+    reps[~np.asarray(pbc, dtype=bool)] = 0
+    ranges = [np.arange(-n, n + 1) for n in reps]
+    return np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, 3)
+
+
+def _accumulate(cell, positions, inverse, n_species, centers, lower2, upper2, pbc):
+    """Sum r^-6 for the distances ``lower2 <= r^2 < upper2`` (per atom), grouped by
+    species.
+
+    :return: (n_centers, n_species) array.
+    """
+    pbc = np.asarray(pbc, dtype=bool)
+    inv_cell = np.linalg.inv(cell)
+    upper = np.sqrt(np.max(upper2))
+    lower = np.sqrt(np.min(lower2))
+
+    translations = lattice_translations(cell, upper, pbc) @ cell
+    # drop the translations that cannot reach the [lower, upper) shell: once wrapped,
+    # a displacement is never longer than half the sum of the lattice vectors.
+    t_norms = np.linalg.norm(translations, axis=1)
+    half_diagonal = 0.5 * np.sum(np.linalg.norm(cell, axis=1))
+    keep = (t_norms - half_diagonal < upper) & (t_norms + half_diagonal >= lower)
+    translations = translations[keep]
+    translations2 = t_norms[keep] ** 2
+
+    sums = np.zeros((len(centers), n_species))
+    for i, center in enumerate(centers):
+        frac = (positions - center) @ inv_cell
+        frac[:, pbc] -= np.round(frac[:, pbc])
+        d = frac @ cell
+        # |t + d|^2 expanded: only a (n_translations, n_atoms) array is allocated.
+        r2 = translations @ (2 * d.T)
+        r2 += translations2[:, None]
+        r2 += np.einsum("ij,ij->i", d, d)[None, :]
+        mask = (r2 < upper2) & (r2 >= lower2) & (r2 > 1e-12)
+        per_atom = np.sum(np.power(r2, -3, where=mask, out=np.zeros_like(r2)), axis=0)
+        sums[i] = np.bincount(inverse, weights=per_atom, minlength=n_species)
+
+    return sums
+
+
+def inverse_sixth_sums(
+    cell,
+    positions,
+    numbers,
+    centers,
+    cutoff=40.0,
+    cutoff_distances=None,
+    pbc=(True, True, True),
+):
+    """Compute, for each center, the sum of r^-6 over all the periodic images of the
+    atoms, grouped by species.
+
+    The center itself (r=0) is excluded.
+
+    :param cell: (3, 3) array, lattice vectors as rows.
+    :param positions: (n_atoms, 3) cartesian positions.
+    :param numbers: (n_atoms,) atomic numbers.
+    :param centers: (n_centers, 3) cartesian positions of the muons.
+    :param cutoff: default cutoff radius in Angstrom.
+    :param cutoff_distances: optional dictionary {Z: cutoff} overriding ``cutoff`` per
+        species.
+    :param pbc: periodicity along the three lattice vectors.
+    :return: tuple (species, sums), with species the sorted unique atomic numbers and
+        sums a (n_centers, n_species) array.
+    """
+    cell = np.asarray(cell, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    centers = np.atleast_2d(np.asarray(centers, dtype=float))
+    cutoff_distances = cutoff_distances or {}
+
+    species, inverse = np.unique(numbers, return_inverse=True)
+    species_cutoffs = np.array(
+        [cutoff_distances.get(z, cutoff) for z in species], dtype=float
+    )
+
+    sums = _accumulate(
+        cell,
+        positions,
+        inverse,
+        len(species),
+        centers,
+        np.zeros(len(positions)),
+        species_cutoffs[inverse] ** 2,
+        pbc,
+    )
+    return species, sums
+
+
+def converged_inverse_sixth_sums(
+    cell,
+    positions,
+    numbers,
+    centers,
+    tolerance=1e-3,
+    shell_width=1.0,
+    r_start=5.0,
+    r_max=40.0,
+    pbc=(True, True, True),
+    exclude=(),
+):
+    """Accumulate the r^-6 sums shell by shell, adding the continuum tail correction
+    beyond the last shell, until the relative change is below ``tolerance`` for two
+    consecutive shells.
+
+    The tail beyond a radius R of a species with number density n is the integral
+    of n * 4 pi r^2 * r^-6 from R to infinity, i.e. 4 pi n / (3 R^3).
+
+    :param tolerance: relative change of the corrected sums between two shells at which
+        we stop.
+    :param shell_width: width of each shell in Angstrom.
+    :param r_start: radius of the first sphere in Angstrom.
+    :param r_max: maximum radius in Angstrom, reached only if not converged before.
+    :param exclude: atomic numbers not considered in the convergence check.
+    :return: tuple (species, radii, sums), with sums a (n_radii, n_centers, n_species)
+        array of the tail-corrected sums with cutoff radii[k]; the last entry is the
+        converged value.
+    """
+    cell = np.asarray(cell, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    centers = np.atleast_2d(np.asarray(centers, dtype=float))
+
+    species, inverse = np.unique(numbers, return_inverse=True)
+    density = np.bincount(inverse, minlength=len(species)) / abs(np.linalg.det(cell))
+    checked = ~np.isin(species, exclude)
+
+    radii, curve = [], []
+    below = 0
+    accumulated = np.zeros((len(centers), len(species)))
+    r_in, r_out = 0.0, min(r_start, r_max)
+    while True:
+        accumulated += _accumulate(
+            cell,
+            positions,
+            inverse,
+            len(species),
+            centers,
+            np.full(len(positions), r_in**2),
+            np.full(len(positions), r_out**2),
+            pbc,
+        )
+        corrected = accumulated + 4 * np.pi * density / (3 * r_out**3)
+        radii.append(r_out)
+        curve.append(corrected)
+
+        # converged when two consecutive shells change less than the tolerance,
+        # so that an accidental agreement of two shells does not stop the sum.
+        if len(curve) > 1:
+            change = np.abs(curve[-1] - curve[-2])[:, checked]
+            below = (
+                below + 1
+                if np.all(change <= tolerance * np.abs(corrected[:, checked]))
+                else 0
+            )
+            if below == 2:
+                break
+        if r_out >= r_max:
+            break
+        r_in, r_out = r_out, min(r_out + shell_width, r_max)
+
+    return species, np.array(radii), np.array(curve)
+
+
+# (2/3)(mu_0/4pi)^2 (hbar 2pi x 135.5 MHz/T)^2, with distances in Angstrom.
+factor = 5.37402139e-5
+
+
+def second_moments(
+    cell,
+    positions,
+    numbers,
+    cutoff=40.0,
+    cutoff_distances=None,
+    tolerance=None,
+    pbc=(True, True, True),
+):
+    """Nuclear dipolar second moment at the muon sites (the H atoms), per host species,
+    averaged over the muons and over the isotopes.
+
+    :param tolerance: if given, the cutoffs are ignored and the sums are converged with
+        ``converged_inverse_sixth_sums``.
+    :return: tuple (radii, moments), with moments a dictionary {Z: array of second
+        moments for each cutoff in radii}; for fixed cutoffs radii is None and the
+        arrays have a single entry.
+    """
+    from aiidalab_qe_muon.utils.isotopes import isotope_average
+
+    numbers = np.asarray(numbers)
+    positions = np.asarray(positions, dtype=float)
+    muons = numbers == 1
+    tot_H = np.count_nonzero(muons)
+
+    if tolerance is None:
+        radii = None
+        species, sums = inverse_sixth_sums(
+            cell,
+            positions,
+            numbers,
+            positions[muons],
+            cutoff=cutoff,
+            cutoff_distances=cutoff_distances,
+            pbc=pbc,
+        )
+        sums = sums.sum(axis=0)[None, :]
+    else:
+        species, radii, sums = converged_inverse_sixth_sums(
+            cell,
+            positions,
+            numbers,
+            positions[muons],
+            tolerance=tolerance,
+            r_max=cutoff,
+            pbc=pbc,
+            exclude=(1,),
+        )
+        sums = sums.sum(axis=1)
+
+    moments = {}
+    for i, e in enumerate(species):
+        if e == 1:
+            continue
+        moments[e] = isotope_average(e) * sums[:, i] * factor / tot_H
+    return radii, moments
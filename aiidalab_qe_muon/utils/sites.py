@@ -0,0 +1,65 @@
+"""Mapping of muon positions between the muon supercells and the unit cell."""
+import numpy as np
+
+
+def supercell_matrix(unit_lattice, supercell_lattice):
+    """Integer M such that supercell_lattice = M @ unit_lattice (vectors as rows).
+
+    Obtained from the lattices themselves, so it does not matter whether the supercell
+    was given as input or generated by musconv.
+    """
+    matrix = np.asarray(supercell_lattice) @ np.linalg.inv(unit_lattice)
+    return np.rint(matrix).astype(int)
+
+
+def fold_to_unit_cell(frac_coords, matrix):
+    """Fold fractional coordinates of the supercell into the unit cell, in [0, 1).
+
+    :param frac_coords: (n, 3) fractional coordinates with respect to the supercell.
+    :param matrix: the supercell matrix, see ``supercell_matrix``.
+    :return: (n, 3) fractional coordinates with respect to the unit cell.
+    """
+    folded = np.mod(np.atleast_2d(frac_coords) @ matrix, 1.0)
+    # values like 1 - 1e-17 are rounded up to 1.0 by np.mod.
+    folded[folded >= 1.0] = 0.0
+    return folded
+
+
+def fold_muons(unit_lattice, supercell_lattices, frac_coords):
+    """Fold the muon positions of many supercells, possibly different (e.g. generated
+    by musconv), into the unit cell at once.
+
+    :param supercell_lattices: (n, 3, 3) lattices of the supercells, or (3, 3) if all
+        the same.
+    :param frac_coords: (n, 3) fractional coordinates of each muon in its supercell.
+    :return: (n, 3) fractional coordinates in the unit cell, in [0, 1).
+    """
+    matrices = supercell_matrix(unit_lattice, supercell_lattices)
+    frac_coords = np.atleast_2d(frac_coords)
+    if matrices.ndim == 2:
+        folded = frac_coords @ matrices
+    else:
+        folded = np.einsum("ni,nij->nj", frac_coords, matrices)
+    folded = np.mod(folded, 1.0)
+    folded[folded >= 1.0] = 0.0
+    return folded
+
+
+def close_sites(lattice, frac_sites, frac_muons, tolerance=0.5):
+    """Pairs closer than ``tolerance`` (Angstrom, through the periodic images) between
+    the muons and the other sites or muons, checked at once for all of them.
+
+    :param frac_sites: (m, 3) fractional coordinates of the host sites.
+    :param frac_muons: (n, 3) fractional coordinates of the muons.
+    :return: list of (muon index, index among the host sites followed by the muons).
+    """
+    from aiidalab_qe_muon.utils.symmetry import periodic_distances
+
+    frac_muons = np.atleast_2d(frac_muons)
+    others = np.concatenate([np.reshape(frac_sites, (-1, 3)), frac_muons])
+    distances = periodic_distances(lattice, frac_muons[:, None, :], others[None, :, :])
+    offset = len(others) - len(frac_muons)
+    # each pair of muons only once, and not the muon with itself.
+    muons = np.arange(len(frac_muons))
+    distances[:, offset:][muons[:, None] >= muons[None, :]] = np.inf
+    return [tuple(pair) for pair in np.argwhere(distances < tolerance).tolist()]
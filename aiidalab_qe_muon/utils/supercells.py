@@ -0,0 +1,275 @@
+"""Supercell utilities for the muon settings.
+
+Estimate of the number of candidate muon supercells, and search of the smallest
+supercell keeping the muon far from its images.
+"""
+import numpy as np
+
+from aiidalab_qe_muon.utils.second_moments import lattice_translations
+
+
+def muon_grid_shape(cell, mu_spacing):
+    """Number of points of the candidate muon grid along each lattice vector."""
+    lengths = np.linalg.norm(np.asarray(cell, dtype=float), axis=1)
+    return np.maximum(np.ceil(lengths / mu_spacing).astype(int), 1)
+
+
+def estimate_number_of_supercells(
+    cell, positions, mu_spacing, exclusion=1.0, mode="fast"
+):
+    """Estimate the number of candidate muon sites, hence of supercells, without them.
+
+    The candidates are the points of a grid with spacing ``mu_spacing`` in the unit cell
+    which are farther than ``exclusion`` from every atom.
+
+    :param cell: (3, 3) lattice vectors of the unit cell, as rows.
+    :param positions: (n_atoms, 3) cartesian positions.
+    :param mu_spacing: distance between the candidate muon positions, in Angstrom.
+    :param exclusion: minimum distance between a candidate and the atoms, in Angstrom.
+    :param mode: "fast" subtracts the volume of the exclusion spheres from the grid
+        (O(1)); "exact" masks the grid points inside the spheres of each atom.
+    :return: the number of candidates.
+
+    The "exact" count is exact for the candidates relaxed by the
+    ``ImplantMuonWorkChain`` itself (same grid as ``candidate_positions``). The
+    ``FindMuonWorkChain`` generates its candidates with niche, whose grid is not
+    reproduced here: see ``number_of_supercells``.
+    """
+    cell = np.asarray(cell, dtype=float)
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    shape = muon_grid_shape(cell, mu_spacing)
+
+    if mode == "fast":
+        volume = abs(np.linalg.det(cell))
+        excluded = len(positions) * 4 / 3 * np.pi * exclusion**3 / volume
+        return int(round(np.prod(shape) * max(0.0, 1.0 - excluded)))
+    elif mode == "exact":
+        return int(
+            np.count_nonzero(~excluded_grid_points(cell, positions, shape, exclusion))
+        )
+    raise ValueError(f"mode should be 'fast' or 'exact', not {mode!r}")
+
+
+def number_of_supercells(
+    structure, mu_spacing, driver="findmuon", prune_symmetry=False, exclusion=1.0
+):
+    """Number of supercells relaxed by the workflow, one per candidate muon site.
+
+    For the "sites" driver, the candidates of ``candidate_positions`` (one per orbit if
+    ``prune_symmetry``). For the "findmuon" driver, the candidates are generated by
+    niche, as in the ``FindMuonWorkChain``; if aiida-muon cannot be imported, the grid
+    count of ``estimate_number_of_supercells`` is returned as an estimate.
+
+    :param structure: the host ``StructureData``.
+    :param mu_spacing: distance between the candidate muon positions, in Angstrom.
+    :param driver: "findmuon" or "sites".
+    :param prune_symmetry: for the "sites" driver, one candidate per symmetry orbit.
+    :param exclusion: minimum distance between a candidate and the atoms, in Angstrom.
+    :return: tuple (number of supercells, whether the number is exact).
+    """
+    cell = np.asarray(structure.cell, dtype=float)
+    positions = [site.position for site in structure.sites]
+    if driver == "sites":
+        if prune_symmetry:
+            kinds = [site.kind_name for site in structure.sites]
+            frac, _ = inequivalent_candidate_positions(
+                cell,
+                positions,
+                np.unique(kinds, return_inverse=True)[1],
+                mu_spacing,
+                exclusion,
+            )
+        else:
+            frac, _ = candidate_positions(cell, positions, mu_spacing, exclusion)
+        return len(frac), True
+    try:
+        return len(niche_candidate_positions(structure, mu_spacing, exclusion)), True
+    except ImportError:
+        return (
+            estimate_number_of_supercells(
+                cell, positions, mu_spacing, exclusion, mode="exact"
+            ),
+            False,
+        )
+
+
+def niche_candidate_positions(structure, mu_spacing, exclusion=1.0):
+    """Candidate muon positions of the ``FindMuonWorkChain``, generated by niche.
+
+    :param structure: the host ``StructureData``.
+    :return: list of fractional coordinates in the unit cell.
+    :raises ImportError: if aiida-muon is not installed.
+    """
+    from aiida_muon.utils.sitegen_tools import niche_add_impurities
+
+    return niche_add_impurities(
+        structure.get_pymatgen_structure(),
+        niche_atom="H",
+        niche_spacing=mu_spacing,
+        niche_distance=exclusion,
+    )
+
+
+def candidate_positions(cell, positions, mu_spacing, exclusion=1.0):
+    """Candidate muon positions: the grid points farther than ``exclusion`` from atoms.
+
+    Same grid as ``estimate_number_of_supercells``: their number is its exact estimate.
+
+    :return: tuple ((n, 3) fractional coordinates in the unit cell, shape of the grid).
+    """
+    cell = np.asarray(cell, dtype=float)
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    shape = muon_grid_shape(cell, mu_spacing)
+    free = ~excluded_grid_points(cell, positions, shape, exclusion)
+    return np.argwhere(free) / shape, shape
+
+
+def inequivalent_candidate_positions(
+    cell, positions, types, mu_spacing, exclusion=1.0, symprec=1e-3
+):
+    """Candidate muon positions, one per orbit of the space group of the host.
+
+    :param types: (n_atoms,) integers, one per kind of the host.
+    :return: tuple ((n, 3) fractional coordinates of the representatives,
+        (n,) multiplicities).
+    """
+    from aiidalab_qe_muon.utils.symmetry import grid_orbits, symmetry_operations
+
+    cell = np.asarray(cell, dtype=float)
+    frac, shape = candidate_positions(cell, positions, mu_spacing, exclusion)
+    rotations, translations = symmetry_operations(
+        cell, np.asarray(positions, dtype=float) @ np.linalg.inv(cell), types, symprec
+    )
+    representatives, multiplicities, _ = grid_orbits(
+        frac, shape, cell, rotations, translations
+    )
+    return frac[representatives], multiplicities
+
+
+def excluded_grid_points(cell, positions, shape, exclusion):
+    """Boolean grid of the given shape, True within ``exclusion`` of any atom.
+
+    Only the stencil of grid points around each atom is checked, vectorized over atoms.
+    """
+    shape = np.asarray(shape)
+    frac = positions @ np.linalg.inv(cell)
+    # half-width of the box of grid points containing the sphere: exclusion / spacing
+    # of the lattice planes.
+    spacings = 1 / (np.linalg.norm(np.linalg.inv(cell), axis=0) * shape)
+    reach = np.ceil(exclusion / spacings).astype(int) + 1
+    offsets = np.stack(
+        np.meshgrid(*[np.arange(-r, r + 1) for r in reach], indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+
+    base = np.floor(frac * shape).astype(int)
+    excluded = np.zeros(shape, dtype=bool)
+    # chunks of atoms, to bound the (n_atoms, n_offsets, 3) arrays.
+    chunk = max(1, 2_000_000 // (3 * len(offsets)))
+    for start in range(0, len(frac), chunk):
+        indices = base[start : start + chunk, None, :] + offsets[None, :, :]
+        displacement = (indices / shape - frac[start : start + chunk, None, :]) @ cell
+        inside = np.einsum("ijk,ijk->ij", displacement, displacement) < exclusion**2
+        hit = np.mod(indices[inside], shape)
+        excluded[hit[:, 0], hit[:, 1], hit[:, 2]] = True
+    return excluded
+
+
+def minimal_supercell(cell, min_distance=9.0, max_det=None):
+    """Smallest supercell in which the muon is ``min_distance`` away from its images.
+
+    The images of the muon are the lattice vectors of the supercell. A Minkowski-reduced
+    basis of a valid supercell has rows not shorter than ``min_distance`` and, by
+    Minkowski's second theorem, the product of their lengths is at most sqrt(2) times
+    its volume: so the supercells are searched among the triples of unit cell lattice
+    vectors in these bounds, instead of all the sublattices (Hermite normal forms). The
+    determinants are checked from the smallest possible one (the one of the densest
+    packing); among the valid supercells, the one with the longest shortest vector is
+    chosen and its basis is Minkowski-reduced.
+
+    :param cell: (3, 3) lattice vectors of the unit cell, as rows.
+    :param min_distance: minimum distance between the muon and its images, in Angstrom.
+    :param max_det: maximum number of unit cells in the supercell; None for no limit.
+    :return: tuple (3x3 integer supercell matrix, shortest muon-image distance, in A).
+    :raises ValueError: if no supercell with at most ``max_det`` unit cells is valid.
+    """
+    from ase.geometry import minkowski_reduce
+
+    cell = np.asarray(cell, dtype=float)
+    volume = abs(np.linalg.det(cell))
+    distance = shortest_image_distance(cell, np.eye(3))
+    if distance >= min_distance:
+        return np.eye(3, dtype=int), distance
+    # the shortest vector of a Minkowski-reduced basis is one of these combinations.
+    combinations = np.stack(
+        np.meshgrid(*[[-1, 0, 1]] * 3, indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    combinations = combinations[np.any(combinations != 0, axis=1)]
+
+    # the densest packing bounds the volume of a lattice whose shortest is min_distance.
+    det = max(2, int(np.floor(min_distance**3 / np.sqrt(2) / volume)))
+    while max_det is None or det <= max_det:
+        # the lattice vectors are computed for a few determinants at once.
+        last = int(1.1 * det) + 1
+        if max_det is not None:
+            last = min(last, max_det)
+        bound = np.sqrt(2) * last * volume
+        points = lattice_translations(cell, bound / min_distance**2)
+        lengths = np.linalg.norm(points @ cell, axis=1)
+        # one of each +-n pair, sorted by length.
+        keep = (
+            (lengths >= min_distance)
+            & (lengths <= bound / min_distance**2)
+            & (points @ [1e6, 1e3, 1] > 0)
+        )
+        order = np.argsort(lengths[keep])
+        points, lengths = points[keep][order], lengths[keep][order]
+        if not len(points):
+            det = last + 1
+            continue
+        # |b1| |b2|^2 <= |b1| |b2| |b3| <= bound, with |b1| >= the shortest length.
+        n2 = np.searchsorted(lengths, np.sqrt(bound / lengths[0]), side="right")
+        n1 = np.searchsorted(lengths, np.cbrt(bound), side="right")
+        first, second = np.triu_indices(n2, k=1)
+        pair = first < n1
+        first, second = first[pair], second[pair]
+        # number of unit cells in the supercell of each triple of vectors.
+        products = np.cross(points[first], points[second]) @ points.T
+        valid = (np.arange(len(points))[None, :] > second[:, None]) & (
+            lengths[None, :] <= bound / (lengths[first] * lengths[second])[:, None]
+        )
+        products = np.where(valid, np.abs(products), 0)
+
+        for current in range(det, last + 1):
+            i, k = np.nonzero(products == current)
+            if not len(i):
+                continue
+            bases = np.stack([points[first[i]], points[second[i]], points[k]], axis=1)
+            # exact for the Minkowski-reduced bases, an upper bound for the others.
+            images = combinations @ (bases @ cell)
+            shortest = np.linalg.norm(images, axis=-1).min(axis=1)
+            best, best_distance = None, 0.0
+            for n in np.argsort(-shortest):
+                if shortest[n] < max(min_distance, best_distance):
+                    break
+                distance = shortest_image_distance(cell, bases[n])
+                if distance >= min_distance and distance > best_distance:
+                    best, best_distance = bases[n], distance
+            if best is not None:
+                _, op = minkowski_reduce(best @ cell)
+                matrix = op @ best
+                if np.linalg.det(matrix) < 0:
+                    matrix = -matrix
+                return matrix, shortest_image_distance(cell, matrix)
+        det = last + 1
+    raise ValueError(
+        f"no supercell of at most {max_det} unit cells keeps the muon {min_distance} A "
+        "away from its images"
+    )
+
+
+def shortest_image_distance(cell, matrix):
+    """Length of the shortest lattice vector of the supercell ``matrix @ cell``."""
+    lattice = np.asarray(matrix) @ np.asarray(cell, dtype=float)
+    from ase.geometry import minkowski_reduce
+
+    return float(np.linalg.norm(minkowski_reduce(lattice)[0], axis=1).min())
@@ -0,0 +1,79 @@
+"""Space-group symmetry of the host crystal, to find the equivalent muon positions."""
+import numpy as np
+
+
+def symmetry_operations(cell, frac_positions, types, symprec=1e-3):
+    """Space-group operations of the host, from spglib.
+
+    :param cell: (3, 3) lattice vectors, as rows.
+    :param frac_positions: (n_atoms, 3) fractional coordinates.
+    :param types: (n_atoms,) integers; use different ones for the kinds that should not
+        be considered equivalent (e.g. different magnetic sublattices).
+    :param symprec: tolerance of spglib, in Angstrom.
+    :return: tuple (rotations (n_ops, 3, 3) int, translations (n_ops, 3)), acting on
+        fractional coordinates as ``rotation @ x + translation``.
+    """
+    import spglib
+
+    dataset = spglib.get_symmetry(
+        (
+            np.asarray(cell, dtype=float),
+            np.asarray(frac_positions, dtype=float),
+            np.asarray(types),
+        ),
+        symprec=symprec,
+    )
+    if dataset is None:
+        # no symmetry could be found: only the identity.
+        return np.eye(3, dtype=int)[None], np.zeros((1, 3))
+    return dataset["rotations"], dataset["translations"]
+
+
+def periodic_distances(cell, frac_a, frac_b):
+    """Distances between the fractional coordinates ``frac_a`` and ``frac_b`` (broadcast
+    against each other), through the closest periodic image.
+
+    The displacement is wrapped in [-0.5, 0.5), which is exact as long as the distance
+    is below half the smallest distance between lattice planes: enough for comparisons.
+    """
+    displacement = np.asarray(frac_a) - np.asarray(frac_b)
+    displacement -= np.rint(displacement)
+    return np.linalg.norm(displacement @ np.asarray(cell, dtype=float), axis=-1)
+
+
+def grid_orbits(frac_points, shape, cell, rotations, translations, tolerance=0.05):
+    """Orbits of points of a regular grid under the symmetry operations.
+
+    Each point is mapped by every operation, and the image is matched to the closest
+    grid point if it is within ``tolerance`` (periodic distance, in Angstrom), all at
+    once for all the points and operations. As the operations form a group, the orbit of
+    a point is the set of its matched images, and its smallest index is the
+    representative of the orbit. Images falling between the grid points (grids
+    incompatible with the symmetry) are not matched, so equivalent points are at worst
+    kept, never wrongly merged.
+
+    :param frac_points: (n, 3) fractional coordinates, all on the grid of ``shape``.
+    :param shape: number of grid points along each lattice vector.
+    :return: tuple (representatives, multiplicities, labels): the indices of the
+        representative points, the size of their orbits, and for each point the index
+        of its representative.
+    """
+    frac_points = np.asarray(frac_points, dtype=float)
+    shape = np.asarray(shape)
+    # index of each grid point in frac_points, -1 for the points not in the list.
+    lookup = np.full(shape, -1)
+    indices = np.mod(np.rint(frac_points * shape).astype(int), shape)
+    lookup[indices[:, 0], indices[:, 1], indices[:, 2]] = np.arange(len(frac_points))
+
+    images = np.einsum("oij,pj->opi", rotations, frac_points) + translations[:, None, :]
+    nearest = np.rint(images * shape)
+    close = periodic_distances(cell, images, nearest / shape) < tolerance
+    nearest = np.mod(nearest.astype(int), shape)
+    matches = lookup[nearest[..., 0], nearest[..., 1], nearest[..., 2]]
+    matches[~close] = -1
+
+    # the point itself is always part of its orbit (identity).
+    candidates = np.where(matches >= 0, matches, len(frac_points))
+    labels = np.minimum(candidates.min(axis=0), np.arange(len(frac_points)))
+    representatives, multiplicities = np.unique(labels, return_counts=True)
+    return representatives, multiplicities, labels
@@ -1,31 +1,75 @@
 """Implementation of the VibroWorkchain for managing the aiida-vibroscopy workchains."""
+import numpy as np
+
 from aiida.common import AttributeDict
-from aiida.engine import ToContext, WorkChain, calcfunction
-from aiida.orm import AbstractCode, Int, Float, Dict, Code, StructureData, load_code
-from aiida.plugins import WorkflowFactory
+from aiida.engine import ProcessState, ToContext, WorkChain, calcfunction
+from aiida.orm import (
+    AbstractCode,
+    Bool,
+    CalcJobNode,
+    Int,
+    Float,
+    Dict,
+    Code,
+    KpointsData,
+    List,
+    StructureData,
+    ArrayData,
+    load_code,
+)
+from aiida.plugins import CalculationFactory, WorkflowFactory
 from aiida_quantumespresso.utils.mapping import prepare_process_inputs
 from aiida_quantumespresso.common.types import ElectronicType, SpinType
-from aiida.engine import WorkChain, calcfunction, if_
+from aiida.engine import WorkChain, calcfunction, if_, while_
+from aiida_quantumespresso.common.types import RelaxType
+
+from aiidalab_qe_muon.utils.reuse import HASH_EXTRA, find_relaxation, relaxation_hash
+from aiidalab_qe_muon.workflows.muon_sites import (
+    collect_contact_fields,
+    collect_unique_sites,
+    compact_results,
+    compute_dipolar_fields,
+    generate_muon_supercells,
+    last_ionic_step,
+    select_screened_sites,
+)
 
 
-MusconvWorkChain = WorkflowFactory('musconv')
-FindMuonWorkChain = WorkflowFactory('muon.find_muon')
-PwRelaxWorkChain = WorkflowFactory('quantumespresso.pw.relax')
-original_PwRelaxWorkChain = WorkflowFactory('quantumespresso.pw.relax')
+MusconvWorkChain = WorkflowFactory("musconv")
+FindMuonWorkChain = WorkflowFactory("muon.find_muon")
+PwRelaxWorkChain = WorkflowFactory("quantumespresso.pw.relax")
+PwBaseWorkChain = WorkflowFactory("quantumespresso.pw.base")
+original_PwRelaxWorkChain = WorkflowFactory("quantumespresso.pw.relax")
 
 
-def FindMuonWorkChain_override_validator(inputs,ctx=None):
+def FindMuonWorkChain_override_validator(inputs, ctx=None):
     """validate inputs for musconv.relax; actually, it is
-    just a way to avoid defining it if we do not want it. 
-    otherwise the default check is done and it will excepts. 
+    just a way to avoid defining it if we do not want it.
+    otherwise the default check is done and it will excepts.
     """
     return None
-    
+
+
 FindMuonWorkChain.spec().inputs.validator = FindMuonWorkChain_override_validator
 
+
 def implant_input_validator(inputs, ctx=None):
     return None
 
+
+DEFAULT_SCREENING_PARAMETERS = {
+    # stage 1: fraction of the protocol cutoffs, k-points distance (0 for the Gamma point only),
+    # convergence thresholds of the relaxation (Ry/bohr and Ry).
+    "cutoff_scale": 0.6,
+    "kpoints_distance": 0.0,
+    "forc_conv_thr": 1e-2,
+    "etot_conv_thr": 1e-3,
+    # stage 2: only the distinct sites within energy_window (eV) of the best one are relaxed again.
+    "energy_window": 1.0,
+    "distance_tolerance": 0.5,
+}
+
+
 class ImplantMuonWorkChain(WorkChain):
     "WorkChain to compute muon stopping sites in a crystal."
     label = "muon"
@@ -34,55 +78,239 @@ class ImplantMuonWorkChain(WorkChain):
     def define(cls, spec):
         """Specify inputs and outputs."""
         super().define(spec)
-        
-        spec.input('structure', valid_type=StructureData) #Maybe not needed as input... just in the protocols. but in this way it is not easy to automate it in the app, after the relaxation. So let's keep it for now. 
+
+        spec.input(
+            "structure", valid_type=StructureData
+        )  # Maybe not needed as input... just in the protocols. but in this way it is not easy to automate it in the app, after the relaxation. So let's keep it for now.
+        spec.input(
+            "cost_estimate",
+            valid_type=Dict,
+            required=False,
+            help="Estimate of the computational cost made before the submission, see `aiidalab_qe_muon.utils.cost`.",
+        )
 
         spec.expose_inputs(
             MusconvWorkChain,
-            namespace='musconv',
-            exclude=('clean_workdir'), #AAA check this... maybe not needed.
+            namespace="musconv",
+            exclude=("clean_workdir"),  # AAA check this... maybe not needed.
             namespace_options={
-                'required': False,
-                'populate_defaults': False,
-                'help': 'Inputs for the `MusconvWorkChain`.',           
-            }
+                "required": False,
+                "populate_defaults": False,
+                "help": "Inputs for the `MusconvWorkChain`.",
+            },
         )
         spec.expose_inputs(
-            FindMuonWorkChain, 
-            namespace='findmuon',
-            exclude=('clean_workdir'), #AAA check this... maybe not needed.
+            PwRelaxWorkChain,
+            namespace="relax",
+            exclude=("structure", "clean_workdir"),
             namespace_options={
-                'required': False,
-                'populate_defaults': False,
-                'help': (
-                    'Inputs for the `FindMuonWorkChain` that will be'
-                    'used to calculate the muon stopping sites.'),
+                "required": False,
+                "populate_defaults": False,
+                "help": (
+                    "Inputs for the `PwRelaxWorkChain` of each muon supercell, if the candidate "
+                    'sites are generated and relaxed by this workchain (trigger "sites").'
+                ),
             },
-            #exclude=('symmetry')
         )
-        
+        spec.input(
+            "sc_matrix",
+            valid_type=List,
+            required=False,
+            help='The supercell matrix, wrapped in a list (trigger "sites").',
+        )
+        spec.input(
+            "mu_spacing",
+            valid_type=Float,
+            default=lambda: Float(1.0),
+            help='Distance between the candidate muon positions (trigger "sites").',
+        )
+        spec.input(
+            "prune_symmetry",
+            valid_type=Bool,
+            default=lambda: Bool(True),
+            help='Relax only one candidate muon position per orbit of the space group of the host (trigger "sites").',
+        )
+        spec.input(
+            "symprec",
+            valid_type=Float,
+            default=lambda: Float(1e-3),
+            help="Tolerance of spglib, in Angstrom.",
+        )
+        spec.input(
+            "prune_energy",
+            valid_type=Float,
+            default=lambda: Float(0.0),
+            help=(
+                "If positive, each relaxation first runs `prune_steps` ionic steps only, and it is continued only if its "
+                'energy is less than `prune_energy` (eV) above the best one known; otherwise it is pruned (trigger "sites").'
+            ),
+        )
+        spec.input(
+            "prune_steps",
+            valid_type=Int,
+            default=lambda: Int(5),
+            help="Ionic steps before the energy-based pruning.",
+        )
+        spec.input(
+            "screening",
+            valid_type=Bool,
+            default=lambda: Bool(False),
+            help=(
+                "Relax first all the candidates with a low precision (stage 1), then again with the `relax` inputs only "
+                'the distinct sites within an energy window of the best one (stage 2) (trigger "sites").'
+            ),
+        )
+        spec.input(
+            "screening_parameters",
+            valid_type=Dict,
+            default=lambda: Dict(DEFAULT_SCREENING_PARAMETERS),
+            help="Parameters of the two stages, the missing ones are taken from `DEFAULT_SCREENING_PARAMETERS`.",
+        )
+        spec.input(
+            "reuse_relaxations",
+            valid_type=Bool,
+            default=lambda: Bool(True),
+            help=(
+                "Reuse the finished relaxations of the profile with the same structure, pseudopotentials, parameters "
+                'and k-points, instead of running them again (trigger "sites").'
+            ),
+        )
+        spec.input(
+            "pristine_density",
+            valid_type=Bool,
+            default=lambda: Bool(False),
+            help=(
+                "Run first the SCF of the pristine supercell, and start the relaxations of the final stage from its "
+                'charge density (trigger "sites").'
+            ),
+        )
+        spec.input(
+            "max_concurrent",
+            valid_type=Int,
+            default=lambda: Int(0),
+            help='Maximum number of relaxations running at the same time, 0 for no limit (trigger "sites").',
+        )
+        spec.input(
+            "magmom",
+            valid_type=List,
+            required=False,
+            help=(
+                "Magnetic moments of the sites of the unit cell (3-vectors, Bohr magnetons): the dipolar fields at the "
+                'muon sites are computed from them and, with `pp_code`, the contact fields (trigger "sites").'
+            ),
+        )
+        spec.input(
+            "pp_code",
+            valid_type=AbstractCode,
+            required=False,
+            help="The pp.x code for the spin densities.",
+        )
+        spec.input(
+            "pp_metadata",
+            valid_type=dict,
+            non_db=True,
+            required=False,
+            help="Metadata of the pp.x calculations.",
+        )
+        spec.expose_inputs(
+            FindMuonWorkChain,
+            namespace="findmuon",
+            exclude=("clean_workdir"),  # AAA check this... maybe not needed.
+            namespace_options={
+                "required": False,
+                "populate_defaults": False,
+                "help": (
+                    "Inputs for the `FindMuonWorkChain` that will be"
+                    "used to calculate the muon stopping sites."
+                ),
+            },
+            # exclude=('symmetry')
+        )
+
         ###
         spec.outline(
             cls.setup,
-            cls.implant_muon,
+            if_(cls.relax_sites)(
+                cls.generate_candidates,
+                if_(cls.pristine_density)(
+                    cls.run_pristine_scf,
+                    cls.inspect_pristine_scf,
+                ),
+                if_(cls.screening)(
+                    while_(cls.should_run_relaxations)(
+                        cls.run_relaxations,
+                        cls.inspect_relaxations,
+                    ),
+                    cls.select_sites,
+                ),
+                while_(cls.should_run_relaxations)(
+                    cls.run_relaxations,
+                    cls.inspect_relaxations,
+                ),
+                cls.collect_sites,
+                if_(cls.magnetic)(
+                    cls.compute_dipolar_fields,
+                    if_(cls.contact_fields)(
+                        cls.run_spin_densities,
+                        cls.collect_contact_fields,
+                    ),
+                ),
+            ).else_(
+                cls.implant_muon,
+            ),
             cls.results,
         )
         ###
         spec.expose_outputs(
-            FindMuonWorkChain, namespace='findmuon',
+            FindMuonWorkChain,
+            namespace="findmuon",
             namespace_options={
-                'required': False, 
-                'help':'Outputs of the `PhononWorkChain`.'},
+                "required": False,
+                "help": "Outputs of the `PhononWorkChain`.",
+            },
         )
         spec.expose_outputs(
-            MusconvWorkChain, namespace='musconv',
-            namespace_options={'required': False, 'help':'Outputs of the `DielectricWorkChain`.'},
+            MusconvWorkChain,
+            namespace="musconv",
+            namespace_options={
+                "required": False,
+                "help": "Outputs of the `DielectricWorkChain`.",
+            },
+        )
+        spec.output(
+            "candidates",
+            valid_type=ArrayData,
+            required=False,
+            help='Candidate muon positions in the unit cell and multiplicities of their orbits (trigger "sites").',
+        )
+        spec.output(
+            "pruned_sites",
+            valid_type=Dict,
+            required=False,
+            help="Candidate sites pruned by energy: {index: {energy, delta_E, steps, uuid}}, the energy after `prune_steps` ionic steps (eV).",
+        )
+        spec.output(
+            "screening",
+            valid_type=Dict,
+            required=False,
+            help="Results of the low-precision stage: {index: {energy, delta_E, representative, selected}}.",
+        )
+        spec.output(
+            "summary",
+            valid_type=ArrayData,
+            required=False,
+            help="Compact summary of the unique muon sites: indices, energies, positions in the unit cell, fields and second moments.",
         )
         ###
-        spec.exit_code(400, 'ERROR_WORKCHAIN_FAILED', message='The workchain failed.')
+        spec.exit_code(400, "ERROR_WORKCHAIN_FAILED", message="The workchain failed.")
+        spec.exit_code(
+            401,
+            "ERROR_RELAXATIONS_FAILED",
+            message="All the relaxations of the muon supercells failed.",
+        )
         ###
         spec.inputs.validator = implant_input_validator
-    
+
     @classmethod
     def get_builder_from_protocol(
         cls,
@@ -92,15 +320,22 @@ class ImplantMuonWorkChain(WorkChain):
         pp_code=None,
         protocol=None,
         overrides: dict = {},
-        trigger = None,
-        relax_musconv: bool =False, #in the end you relax in the first step of the QeAppWorkchain.
+        trigger=None,
+        relax_musconv: bool = False,  # in the end you relax in the first step of the QeAppWorkchain.
         magmom: list = None,
         options=None,
-        sc_matrix: list =None,
+        sc_matrix: list = None,
         mu_spacing: float = 1.0,
-        kpoints_distance: float =0.301,
-        charge_supercell: bool =True,
-        **kwargs
+        kpoints_distance: float = 0.301,
+        charge_supercell: bool = True,
+        prune_symmetry: bool = True,
+        max_concurrent: int = 0,
+        prune_energy: float = 0.0,
+        prune_steps: int = 5,
+        screening: dict = None,
+        reuse_relaxations: bool = True,
+        pristine_density: bool = False,
+        **kwargs,
     ):
         """Return a builder prepopulated with inputs selected according to the chosen protocol.
 
@@ -108,6 +343,24 @@ class ImplantMuonWorkChain(WorkChain):
         :param structure: the ``StructureData`` instance to use.
         :param protocol: protocol to use, if not specified, the default will be used.
         :param overrides: optional dictionary of inputs to override the defaults of the protocol.
+        :param sc_matrix: the supercell matrix, wrapped in a list, e.g. ``[[[2, 0, 0], [0, 2, 0], [0, 0, 2]]]``.
+            It can be any 3x3 integer matrix with positive determinant, not only a diagonal one; the rows give
+            the supercell vectors in units of the unit cell ones. If None, it is computed by the workflow
+            (for the trigger "sites", the smallest supercell with the muon 9 A away from its images is used).
+        :param trigger: "findmuon", "musconv", or "sites": the candidate muon sites are generated, pruned
+            by symmetry and relaxed by this workchain, instead of the `FindMuonWorkChain`; for magnetic
+            systems, the dipolar and contact hyperfine fields are computed by this workchain too.
+        :param prune_symmetry: for the trigger "sites", relax only one candidate per symmetry orbit.
+        :param max_concurrent: for the trigger "sites", maximum number of relaxations running at the same
+            time (0 for no limit).
+        :param prune_energy: for the trigger "sites", prune the relaxations whose energy after `prune_steps`
+            ionic steps is more than `prune_energy` (eV) above the best one; 0 to disable.
+        :param screening: for the trigger "sites", parameters of the two-stage screening (see
+            `DEFAULT_SCREENING_PARAMETERS`, the missing ones are taken from there); None to disable it.
+        :param reuse_relaxations: for the trigger "sites", reuse the equivalent relaxations already finished
+            in the profile.
+        :param pristine_density: for the trigger "sites", run first the SCF of the pristine supercell and start
+            the relaxations from its charge density.
         :param options: A dictionary of options that will be recursively set for the ``metadata.options`` input of all
             the ``CalcJobs`` that are nested in this work chain.
         :param kwargs: additional keyword arguments that will be passed to the ``get_builder_from_protocol`` of all the
@@ -115,15 +368,27 @@ class ImplantMuonWorkChain(WorkChain):
         :return: a process builder instance with all inputs defined ready for launch.
         """
         from aiida_quantumespresso.workflows.protocols.utils import recursive_merge
-        
-        if trigger not in ["findmuon","musconv"]:
-            raise ValueError('trigger not in "findmuon" or "musconv"') 
-        
+
+        if trigger not in ["findmuon", "musconv", "sites"]:
+            raise ValueError('trigger not in "findmuon", "musconv" or "sites"')
+
+        if sc_matrix is not None:
+            sc_matrix = [
+                np.asarray(matrix, dtype=int).reshape(3, 3).tolist()
+                for matrix in sc_matrix
+            ]
+            if any(round(np.linalg.det(matrix)) <= 0 for matrix in sc_matrix):
+                raise ValueError(
+                    "the supercell matrix should have a positive determinant."
+                )
+
         if magmom and not pp_code:
-            raise ValueError("pp code not provided but required, as the system is magnetic.")
-        
+            raise ValueError(
+                "pp code not provided but required, as the system is magnetic."
+            )
+
         builder = cls.get_builder()
-        
+
         if trigger == "findmuon":
             builder_findmuon = FindMuonWorkChain.get_builder_from_protocol(
                 pw_code=pw_code,
@@ -131,24 +396,24 @@ class ImplantMuonWorkChain(WorkChain):
                 structure=structure,
                 protocol=protocol,
                 overrides=overrides,
-                relax_musconv=relax_musconv, #relaxation of unit cell already done if needed.
+                relax_musconv=relax_musconv,  # relaxation of unit cell already done if needed.
                 magmom=magmom,
                 sc_matrix=sc_matrix,
                 mu_spacing=mu_spacing,
                 kpoints_distance=kpoints_distance,
                 charge_supercell=charge_supercell,
                 pseudo_family=pseudo_family,
-                **kwargs
+                **kwargs,
             )
-            #builder.findmuon = builder_findmuon
-            for k,v in builder_findmuon.items():
-                setattr(builder.findmuon,k,v)   
-            
-            #I have to set this, otherwise we have no parameters. TOBE understood.
+            # builder.findmuon = builder_findmuon
+            for k, v in builder_findmuon.items():
+                setattr(builder.findmuon, k, v)
+
+            # I have to set this, otherwise we have no parameters. TOBE understood.
             builder.findmuon.musconv.relax.base.pw.parameters = Dict({})
             if sc_matrix:
                 builder.findmuon.musconv.pwscf.pw.parameters = Dict({})
-                    
+
         elif trigger == "musconv":
             builder_musconv = MusconvWorkChain.get_builder_from_protocol(
                 code=pw_code,
@@ -156,43 +421,595 @@ class ImplantMuonWorkChain(WorkChain):
                 protocol=protocol,
                 overrides=overrides,
                 pseudo_family=pseudo_family,
-                **kwargs
+                **kwargs,
             )
             builder.musconv = builder_musconv
-        
-        for wchain in ["findmuon","musconv"]:
-            if trigger != wchain: builder.pop(wchain,None)
-        
+
+        elif trigger == "sites":
+            from aiidalab_qe_muon.utils.supercells import minimal_supercell
+
+            if sc_matrix is None:
+                sc_matrix = [minimal_supercell(structure.cell)[0].tolist()]
+            # the protocol inputs are the same for all the muon supercells (pseudos, k-points, ...),
+            # so they are obtained from one of them.
+            probe = muon_supercell(structure, np.array(sc_matrix[0]), np.zeros(3))
+            for key in ["relax_unitcell", "hubbard"]:
+                kwargs.pop(key, None)
+            overrides = recursive_merge(
+                {
+                    "base": {
+                        "pseudo_family": pseudo_family,
+                        "kpoints_distance": kpoints_distance,
+                    }
+                },
+                overrides,
+            )
+            builder_relax = PwRelaxWorkChain.get_builder_from_protocol(
+                code=pw_code,
+                structure=probe,
+                protocol=protocol,
+                overrides=overrides,
+                relax_type=RelaxType.POSITIONS,
+                options=options,
+                **kwargs,
+            )
+            builder_relax.pop("structure", None)
+            builder_relax.pop("clean_workdir", None)
+            builder_relax.pop("base_final_scf", None)
+            if charge_supercell:
+                parameters = builder_relax.base.pw.parameters.get_dict()
+                parameters.setdefault("SYSTEM", {})["tot_charge"] = 1.0
+                builder_relax.base.pw.parameters = Dict(parameters)
+            builder.relax = builder_relax
+            builder.sc_matrix = List(sc_matrix)
+            builder.mu_spacing = Float(mu_spacing)
+            builder.prune_symmetry = Bool(prune_symmetry)
+            builder.max_concurrent = Int(max_concurrent)
+            builder.prune_energy = Float(prune_energy)
+            builder.prune_steps = Int(prune_steps)
+            builder.reuse_relaxations = Bool(reuse_relaxations)
+            builder.pristine_density = Bool(pristine_density)
+            builder.screening = Bool(screening is not None)
+            builder.screening_parameters = Dict(
+                {**DEFAULT_SCREENING_PARAMETERS, **(screening or {})}
+            )
+            if magmom:
+                # the moments give the fields only: the spin of the relaxations is set by the protocol.
+                builder.magmom = List([list(moment) for moment in magmom])
+                builder.pp_code = pp_code
+                builder.pp_metadata = {
+                    "options": dict(options or builder_relax.base.pw.metadata.options)
+                }
+
+        for wchain in ["findmuon", "musconv"]:
+            if trigger != wchain:
+                builder.pop(wchain, None)
+        if trigger != "sites":
+            builder.pop("relax", None)
+
         builder.structure = structure
-        
+
         return builder
-        
+
     def setup(self):
-        #key, class, outputs namespace.
+        # key, class, outputs namespace.
         if "findmuon" in self.inputs:
             self.ctx.key = "findmuon"
             self.ctx.workchain = FindMuonWorkChain
         elif "musconv" in self.inputs:
             self.ctx.key = "musconv"
             self.ctx.workchain = MusconvWorkChain
-            
-    
+        elif "relax" in self.inputs:
+            self.ctx.key = "sites"
+            self.ctx.workchain = PwRelaxWorkChain
+
+        if "cost_estimate" in self.inputs:
+            estimate = self.inputs.cost_estimate.get_dict()
+            self.report(
+                f"estimated cost: {estimate['relaxations']} relaxations, "
+                f"~{estimate['core_hours']:.0f} core-hours, ~{estimate['memory_gb']:.1f} GB per relaxation"
+            )
+
+    def relax_sites(self):
+        """Whether the candidate muon sites are generated and relaxed by this workchain."""
+        return self.ctx.key == "sites"
+
+    def generate_candidates(self):
+        """Generate the muon supercells of the candidate sites, pruned by symmetry."""
+        outputs = generate_muon_supercells(
+            structure=self.inputs.structure,
+            sc_matrix=self.inputs.sc_matrix,
+            mu_spacing=self.inputs.mu_spacing,
+            prune_symmetry=self.inputs.prune_symmetry,
+            symprec=self.inputs.symprec,
+            metadata={"call_link_label": "generate_candidates"},
+        )
+        self.ctx.candidates = outputs["candidates"]
+        self.ctx.supercells = {
+            key[len("supercell_") :]: node
+            for key, node in outputs.items()
+            if key.startswith("supercell_")
+        }
+        self.out("candidates", self.ctx.candidates)
+        self.ctx.pristine = outputs["pristine"]
+        self.ctx.stage = "screening" if self.inputs.screening else "final"
+        self.ctx.screening_parameters = {
+            **DEFAULT_SCREENING_PARAMETERS,
+            **self.inputs.screening_parameters.get_dict(),
+        }
+        self.ctx.pruned = {}
+        self.ctx.reuse = {"hits": 0, "misses": 0}
+        self.ctx.saved_iterations = {}
+        self._queue_relaxations(sorted(self.ctx.supercells, key=int))
+
+        multiplicities = self.ctx.candidates.get_array("multiplicities")
+        self.report(
+            f"{len(multiplicities)} inequivalent candidate muon sites out of {multiplicities.sum()}"
+        )
+
+    def _queue_relaxations(self, indices):
+        """Queue the relaxations of the given sites, for the current stage."""
+        self.ctx.queue = list(indices)
+        self.ctx.running = []
+        self.ctx.failed = []
+        self.ctx.relaxations = {}
+        # energy pruning: latest energy of each site, structures to continue from.
+        self.ctx.energies = {}
+        self.ctx.continued = {}
+
+    def pristine_density(self):
+        """Whether the relaxations start from the charge density of the pristine supercell."""
+        return self.inputs.pristine_density.value
+
+    def run_pristine_scf(self):
+        """Run the SCF of the pristine supercell, with the parameters of the relaxations.
+
+        The supercell is neutral: it has the electrons of the supercell with a charged muon, while
+        for muonium pw.x renormalizes the starting density to the extra electron. The pseudopotentials
+        and starting magnetizations of the kinds missing without the muon are removed.
+        """
+        inputs = AttributeDict(
+            self.exposed_inputs(PwRelaxWorkChain, namespace="relax")["base"]
+        )
+        inputs.pw = AttributeDict(inputs.pw)
+        kinds = set(self.ctx.pristine.get_kind_names())
+        inputs.pw.structure = self.ctx.pristine
+        inputs.pw.pseudos = {
+            kind: pseudo for kind, pseudo in inputs.pw.pseudos.items() if kind in kinds
+        }
+
+        parameters = inputs.pw.parameters.get_dict()
+        parameters.setdefault("CONTROL", {})["calculation"] = "scf"
+        for namelist in ["IONS", "CELL"]:
+            parameters.pop(namelist, None)
+        system = parameters.setdefault("SYSTEM", {})
+        system.pop("tot_charge", None)
+        if isinstance(system.get("starting_magnetization"), dict):
+            system["starting_magnetization"] = {
+                kind: value
+                for kind, value in system["starting_magnetization"].items()
+                if kind in kinds
+            }
+        inputs.pw.parameters = Dict(parameters)
+        inputs.metadata = AttributeDict({"call_link_label": "pristine_scf"})
+
+        future = self.submit(PwBaseWorkChain, **inputs)
+        self.report(
+            f"submitting `PwBaseWorkChain` <PK={future.pk}> for the pristine supercell"
+        )
+        return ToContext(pristine_scf=future)
+
+    def inspect_pristine_scf(self):
+        """Keep the remote folder of the pristine SCF; if it failed, the relaxations start from scratch."""
+        workchain = self.ctx.pristine_scf
+        if not workchain.is_finished_ok:
+            self.report(
+                f"the SCF <PK={workchain.pk}> of the pristine supercell failed: "
+                "the relaxations start from the superposition of atomic densities"
+            )
+            return
+        self.ctx.pristine_folder = workchain.outputs.remote_folder
+        self.ctx.pristine_iterations = workchain.outputs.output_parameters.get(
+            "scf_iterations", None
+        )
+
+    def screening(self):
+        """Whether the candidates are screened with a low precision first."""
+        return self.inputs.screening.value
+
+    def should_run_relaxations(self):
+        """Whether some relaxations are still queued or running."""
+        return bool(self.ctx.queue or self.ctx.running)
+
+    def early_pruning(self):
+        """Whether the relaxations are pruned by energy after `prune_steps` ionic steps."""
+        return self.inputs.prune_energy.value > 0
+
+    def run_relaxations(self):
+        """Submit the queued relaxations, up to `max_concurrent` running at the same time, then
+        wait for any running one to terminate: the queue is refilled as the relaxations finish.
+
+        With the energy pruning, a relaxation first runs only `prune_steps` ionic steps (and is not
+        restarted); if not pruned, it is queued again and continued from the last structure.
+        """
+        limit = self.inputs.max_concurrent.value or len(self.ctx.queue) + len(
+            self.ctx.running
+        )
+        while self.ctx.queue and len(self.ctx.running) < limit:
+            idx = self.ctx.queue.pop(0)
+            process_class, inputs, base = self._relaxation_inputs(idx)
+            prefix = "screen" if self.ctx.stage == "screening" else "relax"
+            if self.ctx.stage == "screening":
+                self._screening_inputs(base)
+            if idx in self.ctx.continued:
+                inputs.metadata.call_link_label = f"{prefix}_{idx}_continued"
+            else:
+                inputs.metadata.call_link_label = f"{prefix}_{idx}"
+                if self.early_pruning():
+                    parameters = base.pw.parameters.get_dict()
+                    parameters.setdefault("CONTROL", {})[
+                        "nstep"
+                    ] = self.inputs.prune_steps.value
+                    base.pw.parameters = Dict(parameters)
+                    base.max_iterations = Int(1)
+            if self.inputs.reuse_relaxations:
+                inputs_hash = self._reuse_hash(inputs)
+                reused = find_relaxation(inputs_hash)
+                if reused is not None:
+                    self.ctx.reuse["hits"] += 1
+                    self.report(
+                        f"reusing the finished relaxation <PK={reused.pk}> for the candidate site {idx}"
+                    )
+                    # already terminated: it is collected at the next inspection.
+                    self.ctx.relaxations[idx] = reused
+                    self.ctx.running.append(idx)
+                    continue
+                self.ctx.reuse["misses"] += 1
+
+            future = self.submit(process_class, **inputs)
+            self.report(
+                f"submitting `{process_class.__name__}` <PK={future.pk}> for the candidate site {idx}"
+            )
+            if self.inputs.reuse_relaxations:
+                future.base.extras.set(HASH_EXTRA, inputs_hash)
+            self.ctx.relaxations[idx] = future
+            self.ctx.running.append(idx)
+
+        self.report(
+            f"{self.ctx.stage} relaxations: {len(self.ctx.queue)} queued, {len(self.ctx.running)} running, "
+            f"{len(self.ctx.relaxations) - len(self.ctx.running)} finished ({len(self.ctx.failed)} failed, "
+            f"{len(self.ctx.pruned)} pruned); reused: {self.ctx.reuse['hits']} hits, {self.ctx.reuse['misses']} misses"
+        )
+        # the awaitables are reset at each step: all the running ones are awaited again.
+        self.to_context(
+            **{
+                f"relaxation_{idx}": self.ctx.relaxations[idx]
+                for idx in self.ctx.running
+            }
+        )
+
+    def _on_awaitable_finished(self, awaitable):
+        """Resume as soon as any awaited relaxation terminates, not when all of them did.
+
+        The relaxations still running are awaited again by the next `run_relaxations`, so the
+        callbacks of the previous waits are ignored: their awaitables are equal to the current
+        ones (they are dictionaries), but not the same.
+        """
+        if not any(current is awaitable for current in self._awaitables):
+            return
+        super()._on_awaitable_finished(awaitable)
+        if (
+            awaitable.key.startswith("relaxation_")
+            and self.state == ProcessState.WAITING
+        ):
+            self.resume()
+
+    def inspect_relaxations(self):
+        """Remove the terminated relaxations from the running ones; the failed ones are discarded.
+
+        With the energy pruning, a relaxation stopped after `prune_steps` ionic steps is pruned if
+        its energy is more than `prune_energy` above the best energy known (the relaxed ones and the
+        ones after the first steps, which can only decrease), otherwise it is queued again.
+        """
+        for idx in list(self.ctx.running):
+            workchain = self.ctx.relaxations[idx]
+            if not workchain.is_terminated:
+                continue
+            self.ctx.running.remove(idx)
+            if workchain.is_finished_ok:
+                self.ctx.energies[idx] = workchain.outputs.output_parameters["energy"]
+                self._report_saved_iterations(idx, workchain)
+                continue
+
+            screened = None
+            if self.early_pruning() and idx not in self.ctx.continued:
+                screened = last_ionic_step(workchain)
+            if screened is None:
+                self.ctx.failed.append(idx)
+                self.report(
+                    f"the relaxation <PK={workchain.pk}> of the candidate site {idx} failed"
+                )
+                continue
+
+            energy, structure = screened
+            self.ctx.energies[idx] = energy
+            delta_E = energy - min(self.ctx.energies.values())
+            if delta_E > self.inputs.prune_energy.value:
+                self.ctx.pruned[idx] = {
+                    "energy": energy,
+                    "delta_E": delta_E,
+                    "steps": self.inputs.prune_steps.value,
+                    "uuid": workchain.uuid,
+                }
+                self.report(
+                    f"the candidate site {idx} is pruned: {delta_E:.3f} eV above the best site "
+                    f"after {self.inputs.prune_steps.value} ionic steps"
+                )
+            else:
+                self.ctx.continued[idx] = structure
+                self.ctx.queue.insert(0, idx)
+
+    def _relaxation_inputs(self, idx):
+        """Process class and inputs of the relaxation of a candidate site, and their `PwBaseWorkChain` namespace.
+
+        The relaxations starting from the pristine density (final stage only, as the screening uses other
+        cutoffs) are `PwBaseWorkChain`s, since the `PwRelaxWorkChain` does not accept a `parent_folder`.
+        """
+        inputs = AttributeDict(self.exposed_inputs(PwRelaxWorkChain, namespace="relax"))
+        structure = self.ctx.continued.get(idx, self.ctx.supercells[idx])
+        base = AttributeDict(inputs.base)
+        base.pw = AttributeDict(base.pw)
+        if self.ctx.stage == "final" and "pristine_folder" in self.ctx:
+            parameters = base.pw.parameters.get_dict()
+            parameters.setdefault("CONTROL", {})["calculation"] = "relax"
+            parameters.setdefault("ELECTRONS", {})["startingpot"] = "file"
+            base.pw.parameters = Dict(parameters)
+            base.pw.structure = structure
+            base.pw.parent_folder = self.ctx.pristine_folder
+            base.metadata = AttributeDict()
+            return PwBaseWorkChain, base, base
+        inputs.structure = structure
+        inputs.base = base
+        return PwRelaxWorkChain, inputs, base
+
+    @staticmethod
+    def _reuse_hash(inputs):
+        """Canonical hash of the inputs of a relaxation, see `aiidalab_qe_muon.utils.reuse`."""
+        if "structure" in inputs:
+            return relaxation_hash(
+                inputs.structure,
+                {key: value for key, value in inputs.items() if key != "structure"},
+            )
+        # `PwBaseWorkChain`: the structure is in the `pw` namespace.
+        pw = {key: value for key, value in inputs.pw.items() if key != "structure"}
+        return relaxation_hash(inputs.pw.structure, {**inputs, "pw": pw})
+
+    def _report_saved_iterations(self, idx, workchain):
+        """Report the SCF iterations of the first ionic step saved by starting from the pristine density."""
+        if self.ctx.stage != "final" or self.ctx.get("pristine_iterations") is None:
+            return
+        calculations = [
+            node
+            for node in workchain.called_descendants
+            if isinstance(node, CalcJobNode) and "output_trajectory" in node.outputs
+        ]
+        if not calculations:
+            return
+        trajectory = min(
+            calculations, key=lambda node: node.ctime
+        ).outputs.output_trajectory
+        if "scf_iterations" not in trajectory.get_arraynames():
+            return
+        first = int(trajectory.get_array("scf_iterations")[0])
+        self.ctx.saved_iterations[idx] = self.ctx.pristine_iterations - first
+        self.report(
+            f"candidate site {idx}: {first} SCF iterations in the first ionic step, "
+            f"{self.ctx.saved_iterations[idx]} saved with respect to the pristine SCF"
+        )
+
+    def _screening_inputs(self, base):
+        """Set the low-precision inputs of the screening stage in the `PwBaseWorkChain` namespace `base`:
+        scaled cutoffs, coarse k-points, loose thresholds."""
+        parameters = self.ctx.screening_parameters
+        pw_parameters = base.pw.parameters.get_dict()
+        for key in ["ecutwfc", "ecutrho"]:
+            if key in pw_parameters.get("SYSTEM", {}):
+                pw_parameters["SYSTEM"][key] *= parameters["cutoff_scale"]
+        pw_parameters.setdefault("CONTROL", {}).update(
+            forc_conv_thr=parameters["forc_conv_thr"],
+            etot_conv_thr=parameters["etot_conv_thr"],
+        )
+        base.pw.parameters = Dict(pw_parameters)
+        if parameters["kpoints_distance"] > 0:
+            base.pop("kpoints", None)
+            base.kpoints_distance = Float(parameters["kpoints_distance"])
+        else:
+            kpoints = KpointsData()
+            kpoints.set_kpoints_mesh([1, 1, 1])
+            base.pop("kpoints_distance", None)
+            base.kpoints = kpoints
+
+    def select_sites(self):
+        """Select the distinct low-energy sites of the screening, and queue their relaxation with the
+        full precision, starting from the structures of the screening."""
+        relaxed = {}
+        for idx, workchain in self.ctx.relaxations.items():
+            if workchain.is_finished_ok:
+                relaxed[f"structure_{idx}"] = workchain.outputs.output_structure
+                relaxed[f"parameters_{idx}"] = workchain.outputs.output_parameters
+        if not relaxed:
+            return self.exit_codes.ERROR_RELAXATIONS_FAILED
+
+        screening = select_screened_sites(
+            structure=self.inputs.structure,
+            sc_matrix=self.inputs.sc_matrix,
+            symprec=self.inputs.symprec,
+            screening_parameters=Dict(self.ctx.screening_parameters),
+            metadata={"call_link_label": "select_screened_sites"},
+            **relaxed,
+        )["screening"]
+        self.out("screening", screening)
+
+        selected = [
+            idx for idx, site in screening.get_dict().items() if site["selected"]
+        ]
+        selected.sort(key=lambda idx: screening[idx]["energy"])
+        for idx in selected:
+            self.ctx.supercells[idx] = self.ctx.relaxations[
+                idx
+            ].outputs.output_structure
+        self.report(
+            f"{len(selected)} distinct sites out of {len(relaxed)} selected after the screening, "
+            f"within {self.ctx.screening_parameters['energy_window']} eV of the best one"
+        )
+        self.ctx.stage = "final"
+        self._queue_relaxations(selected)
+
+    def collect_sites(self):
+        """Group the equivalent relaxed sites, and set the outputs in the `findmuon` namespace."""
+        relaxed = {}
+        for idx, workchain in self.ctx.relaxations.items():
+            if workchain.is_finished_ok:
+                relaxed[f"structure_{idx}"] = workchain.outputs.output_structure
+                relaxed[f"parameters_{idx}"] = workchain.outputs.output_parameters
+        if not relaxed:
+            return self.exit_codes.ERROR_RELAXATIONS_FAILED
+        outputs = collect_unique_sites(
+            structure=self.inputs.structure,
+            sc_matrix=self.inputs.sc_matrix,
+            relaxations=Dict(
+                {idx: self.ctx.relaxations[idx].uuid for idx in self.ctx.relaxations}
+            ),
+            symprec=self.inputs.symprec,
+            metadata={"call_link_label": "collect_unique_sites"},
+            **({"pruned": Dict(self.ctx.pruned)} if self.early_pruning() else {}),
+            **relaxed,
+        )
+        if "pruned_sites" in outputs:
+            self.out("pruned_sites", outputs["pruned_sites"])
+        # same format and place as the outputs of the FindMuonWorkChain, read by the results panel.
+        self.out("findmuon.unique_sites", outputs["unique_sites"])
+        self.out("findmuon.all_index_uuid", outputs["all_index_uuid"])
+        self.ctx.unique_sites = outputs["unique_sites"]
+        self.report(
+            f"{len(outputs['unique_sites'].get_dict())} unique muon sites after the relaxations"
+        )
+        if self.inputs.reuse_relaxations:
+            self.report(
+                f"reused relaxations: {self.ctx.reuse['hits']} hits, {self.ctx.reuse['misses']} misses"
+            )
+        if self.ctx.saved_iterations:
+            saved = list(self.ctx.saved_iterations.values())
+            self.report(
+                f"the pristine density saved {sum(saved)} SCF iterations of the first ionic steps, "
+                f"{np.mean(saved):.1f} per site"
+            )
+
+    def magnetic(self):
+        """Whether the fields at the muon sites are computed from the magnetic moments of the host."""
+        return "magmom" in self.inputs
+
+    def contact_fields(self):
+        """Whether the contact hyperfine fields are computed from the spin densities."""
+        return "pp_code" in self.inputs
+
+    def compute_dipolar_fields(self):
+        """Compute the dipolar fields at the unique sites, set in the `findmuon` namespace."""
+        self.ctx.unique_sites_dipolar = compute_dipolar_fields(
+            structure=self.inputs.structure,
+            unique_sites=self.ctx.unique_sites,
+            magmom=self.inputs.magmom,
+            metadata={"call_link_label": "compute_dipolar_fields"},
+        )
+        self.out("findmuon.unique_sites_dipolar", self.ctx.unique_sites_dipolar)
+
+    def run_spin_densities(self):
+        """Run pp.x on the relaxation of each unique site, for the spin density at the muon."""
+        PpCalculation = CalculationFactory("quantumespresso.pp")
+        futures = {}
+        for idx in self.ctx.unique_sites.get_dict():
+            inputs = {
+                "code": self.inputs.pp_code,
+                "parent_folder": self.ctx.relaxations[idx].outputs.remote_folder,
+                "parameters": Dict({"INPUTPP": {"plot_num": 6}, "PLOT": {"iflag": 3}}),
+                "metadata": {
+                    **self.inputs.get("pp_metadata", {}),
+                    "call_link_label": f"spin_density_{idx}",
+                },
+            }
+            future = self.submit(PpCalculation, **inputs)
+            self.report(
+                f"submitting `PpCalculation` <PK={future.pk}> for the spin density of the site {idx}"
+            )
+            futures[f"spin_density_{idx}"] = future
+        return ToContext(**futures)
+
+    def collect_contact_fields(self):
+        """Collect the contact fields at the unique sites, set in the `findmuon` namespace; the sites
+        whose pp.x calculation failed (e.g. reused relaxations with a cleaned folder) are skipped."""
+        densities = {}
+        for idx in self.ctx.unique_sites.get_dict():
+            calculation = self.ctx[f"spin_density_{idx}"]
+            if calculation.is_finished_ok:
+                densities[f"density_{idx}"] = calculation.outputs.output_data
+            else:
+                self.report(
+                    f"the pp.x calculation <PK={calculation.pk}> of the site {idx} failed: no contact field"
+                )
+        if not densities:
+            return
+        self.ctx.unique_sites_hyperfine = collect_contact_fields(
+            unique_sites=self.ctx.unique_sites,
+            metadata={"call_link_label": "collect_contact_fields"},
+            **densities,
+        )
+        self.out("findmuon.unique_sites_hyperfine", self.ctx.unique_sites_hyperfine)
+
     def implant_muon(self):
         """Run a WorkChain for vibrational properties."""
-        #maybe we can unify this, thanks to a wise setup.
-        inputs = AttributeDict(self.exposed_inputs(self.ctx.workchain, namespace=self.ctx.key))
+        # maybe we can unify this, thanks to a wise setup.
+        inputs = AttributeDict(
+            self.exposed_inputs(self.ctx.workchain, namespace=self.ctx.key)
+        )
         inputs.metadata.call_link_label = self.ctx.key
-        
+
         future = self.submit(self.ctx.workchain, **inputs)
-        self.report(f'submitting `WorkChain` <PK={future.pk}>')
+        self.report(f"submitting `WorkChain` <PK={future.pk}>")
         self.to_context(**{self.ctx.key: future})
 
     def results(self):
         """Inspect all sub-processes."""
-        workchain = self.ctx[self.ctx.key]
+        fields = {}
+        if self.ctx.key == "sites":
+            unique_sites = self.ctx.unique_sites
+            for key in ["unique_sites_dipolar", "unique_sites_hyperfine"]:
+                if key in self.ctx:
+                    fields[key] = self.ctx[key]
+        else:
+            workchain = self.ctx[self.ctx.key]
 
-        if not workchain.is_finished_ok:
-            self.report(f'the child WorkChain with <PK={workchain.pk}> failed')
-            return self.exit_codes.ERROR_WORKCHAIN_FAILED
+            if not workchain.is_finished_ok:
+                self.report(f"the child WorkChain with <PK={workchain.pk}> failed")
+                return self.exit_codes.ERROR_WORKCHAIN_FAILED
 
-        self.out_many(self.exposed_outputs(self.ctx[self.ctx.key], self.ctx.workchain, namespace=self.ctx.key))
+            self.out_many(
+                self.exposed_outputs(
+                    self.ctx[self.ctx.key], self.ctx.workchain, namespace=self.ctx.key
+                )
+            )
+
+            unique_sites = None
+            if self.ctx.key == "findmuon" and "unique_sites" in workchain.outputs:
+                unique_sites = workchain.outputs.unique_sites
+                for key in ["unique_sites_dipolar", "unique_sites_hyperfine"]:
+                    if key in workchain.outputs:
+                        fields[key] = workchain.outputs[key]
+
+        if unique_sites is not None:
+            inputs = {
+                "structure": self.inputs.structure,
+                "unique_sites": unique_sites,
+                "metadata": {"call_link_label": "compact_results"},
+                **fields,
+            }
+            self.out("summary", compact_results(**inputs))
@@ -0,0 +1,353 @@
+"""Calcfunctions and helpers of the ``ImplantMuonWorkChain`` for the trigger "sites".
+
+They only need aiida-core and aiida-quantumespresso, not the aiida-muon plugins.
+"""
+import numpy as np
+from aiida.engine import calcfunction
+from aiida.orm import ArrayData, CalcJobNode, Dict, List, StructureData
+
+
+@calcfunction
+def compact_results(
+    structure, unique_sites, unique_sites_dipolar=None, unique_sites_hyperfine=None
+):
+    """Collect the results for the unique muon sites in a single ArrayData, sorted by energy.
+
+    Arrays (one entry per site): `site_index`, `energy`, `delta_E` (eV), `positions` (fractional
+    coordinates in the unit cell, n x 3), `second_moment`; if the fields were computed also
+    `B_T`, `Bdip` (n x 3), `B_T_norm`, `Bdip_norm` and `hyperfine_norm` (T, NaN if missing).
+    """
+    from pymatgen.core import Structure
+    from aiidalab_qe_muon.utils.second_moments import second_moments
+    from aiidalab_qe_muon.utils.sites import fold_to_unit_cell, supercell_matrix
+
+    sites = unique_sites.get_dict()
+    labels = sorted(sites, key=lambda idx: sites[idx][1])
+    unit_lattice = np.array(structure.cell)
+
+    energies = np.array([sites[idx][1] for idx in labels], dtype=float)
+    positions = np.zeros((len(labels), 3))
+    moments = np.zeros(len(labels))
+    for i, idx in enumerate(labels):
+        supercell = Structure.from_dict(sites[idx][0])
+        # the muon is the last site of the supercell.
+        matrix = supercell_matrix(unit_lattice, supercell.lattice.matrix)
+        positions[i] = fold_to_unit_cell(supercell.frac_coords[-1], matrix)[0]
+        _, species_moments = second_moments(
+            supercell.lattice.matrix,
+            supercell.cart_coords,
+            supercell.atomic_numbers,
+            tolerance=1e-3,
+        )
+        moments[i] = sum(values[-1] for values in species_moments.values())
+
+    summary = ArrayData()
+    summary.set_array("site_index", np.array([int(idx) for idx in labels]))
+    summary.set_array("energy", energies)
+    summary.set_array("delta_E", energies - energies.min() if len(labels) else energies)
+    summary.set_array("positions", positions)
+    summary.set_array("second_moment", moments)
+
+    if unique_sites_dipolar is not None:
+        fields = {
+            str(configuration["idx"]): configuration
+            for configuration in unique_sites_dipolar.get_list()
+        }
+        for key in ["B_T", "Bdip"]:
+            vectors = np.array(
+                [fields[idx][key] if idx in fields else [np.nan] * 3 for idx in labels],
+                dtype=float,
+            )
+            summary.set_array(key, vectors.reshape(-1, 3))
+            summary.set_array(
+                f"{key}_norm", np.linalg.norm(vectors.reshape(-1, 3), axis=1)
+            )
+
+    if unique_sites_hyperfine is not None:
+        hyperfine = unique_sites_hyperfine.get_dict()
+        # the last entry is in T (the first is in atomic units).
+        summary.set_array(
+            "hyperfine_norm",
+            np.array(
+                [
+                    abs(hyperfine[idx][-1]) if idx in hyperfine else np.nan
+                    for idx in labels
+                ],
+                dtype=float,
+            ),
+        )
+
+    return summary
+
+
+def muon_supercell(structure, matrix, frac_muon=None):
+    """Supercell ``matrix @ cell`` of the structure, with a muon (H) appended as last site.
+
+    The kind names are kept and, for a ``HubbardStructureData``, the onsite Hubbard parameters as well.
+
+    :param frac_muon: fractional coordinates of the muon in the unit cell; None for the pristine supercell.
+    """
+    from ase import Atom
+    from ase.build import make_supercell
+    from aiida_quantumespresso.data.hubbard_structure import HubbardStructureData
+
+    atoms = make_supercell(structure.get_ase(), matrix)
+    if frac_muon is not None:
+        frac = np.asarray(frac_muon) @ np.linalg.inv(matrix)
+        atoms.append(Atom("H", position=frac @ atoms.cell.array))
+    supercell = StructureData(ase=atoms)
+
+    if isinstance(structure, HubbardStructureData):
+        supercell = HubbardStructureData.from_structure(supercell)
+        for parameter in structure.hubbard.parameters:
+            if parameter.atom_index == parameter.neighbour_index:
+                supercell.initialize_onsites_hubbard(
+                    structure.sites[parameter.atom_index].kind_name,
+                    parameter.atom_manifold,
+                    parameter.value,
+                    parameter.hubbard_type,
+                )
+    return supercell
+
+
+@calcfunction
+def generate_muon_supercells(structure, sc_matrix, mu_spacing, prune_symmetry, symprec):
+    """Generate one muon supercell per candidate muon position.
+
+    The candidates are the points of a grid with spacing `mu_spacing` farther than 1 A from the atoms.
+    If `prune_symmetry`, only one candidate per orbit of the space group of the host is kept
+    (the kinds are distinguished, so that different magnetic sublattices are not merged).
+
+    Outputs: `candidates`, an ArrayData with the `positions` of the candidates (fractional
+    coordinates in the unit cell) and the `multiplicities` of their orbits; `supercell_{i}`,
+    the muon supercell of each candidate; `pristine`, the supercell without the muon.
+    """
+    from aiidalab_qe_muon.utils.supercells import (
+        candidate_positions,
+        inequivalent_candidate_positions,
+    )
+
+    cell = np.array(structure.cell)
+    positions = np.array([site.position for site in structure.sites])
+    if prune_symmetry.value:
+        types = np.unique(
+            [site.kind_name for site in structure.sites], return_inverse=True
+        )[1]
+        frac, multiplicities = inequivalent_candidate_positions(
+            cell, positions, types, mu_spacing.value, symprec=symprec.value
+        )
+    else:
+        frac, _ = candidate_positions(cell, positions, mu_spacing.value)
+        multiplicities = np.ones(len(frac), dtype=int)
+
+    candidates = ArrayData()
+    candidates.set_array("positions", frac)
+    candidates.set_array("multiplicities", multiplicities)
+
+    matrix = np.array(sc_matrix.get_list()[0])
+    outputs = {"candidates": candidates, "pristine": muon_supercell(structure, matrix)}
+    for idx, frac_muon in enumerate(frac):
+        outputs[f"supercell_{idx}"] = muon_supercell(structure, matrix, frac_muon)
+    return outputs
+
+
+def group_relaxed_sites(
+    structure,
+    sc_matrix,
+    symprec,
+    relaxed,
+    distance_tolerance=0.5,
+    energy_tolerance=0.05,
+):
+    """Group the relaxed muon sites which are equivalent by symmetry.
+
+    The muon positions are folded in the unit cell; sorted by energy, each site is merged in
+    a previous one if the two are closer than `distance_tolerance` (A, through the
+    symmetry operations of the host) and within `energy_tolerance` (eV), see
+    `cluster_muon_sites`.
+
+    :param relaxed: `structure_{index}` and `parameters_{index}`, the outputs of the relaxations.
+    :return: tuple (indices sorted by energy, their energies, index of the representative of each).
+    """
+    from aiidalab_qe_muon.utils.clustering import cluster_muon_sites
+    from aiidalab_qe_muon.utils.sites import fold_to_unit_cell
+
+    labels = [
+        key[len("structure_") :] for key in relaxed if key.startswith("structure_")
+    ]
+    energies = np.array([relaxed[f"parameters_{idx}"]["energy"] for idx in labels])
+    order = np.argsort(energies, kind="stable")
+    labels, energies = [labels[i] for i in order], energies[order]
+
+    cell = np.array(structure.cell)
+    matrix = np.array(sc_matrix.get_list()[0])
+    muons = np.array(
+        [relaxed[f"structure_{idx}"].sites[-1].position for idx in labels]
+    ).reshape(-1, 3)
+    supercell_cell = matrix @ cell
+    frac = fold_to_unit_cell(muons @ np.linalg.inv(supercell_cell), matrix)
+
+    types = np.unique(
+        [site.kind_name for site in structure.sites], return_inverse=True
+    )[1]
+    positions = np.array([site.position for site in structure.sites])
+    clusters = cluster_muon_sites(
+        cell,
+        positions @ np.linalg.inv(cell),
+        types,
+        frac,
+        energies,
+        symprec=symprec.value,
+        distance_tolerance=distance_tolerance,
+        energy_tolerance=energy_tolerance,
+    )
+    representatives = [labels[label] for label in clusters["labels"]]
+    return labels, energies, representatives
+
+
+@calcfunction
+def collect_unique_sites(
+    structure, sc_matrix, relaxations, symprec, pruned=None, **relaxed
+):
+    """Group the relaxed muon sites which are equivalent by symmetry (see `group_relaxed_sites`),
+    in the same format as the outputs of the `FindMuonWorkChain`.
+
+    :param relaxations: Dict {index: uuid of the relaxation}.
+    :param pruned: Dict of the sites pruned by energy, returned as `pruned_sites`.
+    :param relaxed: `structure_{index}` and `parameters_{index}`, the outputs of the relaxations.
+    :return: `unique_sites`, Dict {index: [pymatgen dict of the relaxed supercell, energy]}, and
+        `all_index_uuid`, Dict {index: uuid of the relaxation}.
+    """
+    labels, energies, representatives = group_relaxed_sites(
+        structure, sc_matrix, symprec, relaxed
+    )
+    unique_sites = {
+        idx: [
+            relaxed[f"structure_{idx}"].get_pymatgen_structure().as_dict(),
+            float(energy),
+        ]
+        for idx, energy, representative in zip(labels, energies, representatives)
+        if idx == representative
+    }
+    outputs = {
+        "unique_sites": Dict(unique_sites),
+        "all_index_uuid": Dict(relaxations.get_dict()),
+    }
+    if pruned is not None:
+        outputs["pruned_sites"] = Dict(pruned.get_dict())
+    return outputs
+
+
+@calcfunction
+def select_screened_sites(
+    structure, sc_matrix, symprec, screening_parameters, **relaxed
+):
+    """Select the sites of the low-precision screening to be relaxed again with the full precision:
+    one per group of equivalent sites (see `group_relaxed_sites`), within `energy_window` (eV)
+    of the lowest energy.
+
+    :param relaxed: `structure_{index}` and `parameters_{index}`, the outputs of the screening relaxations.
+    :return: `screening`, Dict {index: {energy, delta_E, representative, selected}}.
+    """
+    parameters = screening_parameters.get_dict()
+    labels, energies, representatives = group_relaxed_sites(
+        structure,
+        sc_matrix,
+        symprec,
+        relaxed,
+        distance_tolerance=parameters["distance_tolerance"],
+    )
+    screening = {
+        idx: {
+            "energy": float(energy),
+            "delta_E": float(energy - energies[0]),
+            "representative": representative,
+            "selected": bool(
+                idx == representative
+                and energy - energies[0] <= parameters["energy_window"]
+            ),
+        }
+        for idx, energy, representative in zip(labels, energies, representatives)
+    }
+    return {"screening": Dict(screening)}
+
+
+@calcfunction
+def compute_dipolar_fields(structure, unique_sites, magmom):
+    """Dipolar fields at the unique muon sites, from the magnetic moments of the unit cell,
+    in the format of the output `unique_sites_dipolar` of the `FindMuonWorkChain`.
+
+    The relaxed muon positions are folded in the unit cell, the moments are the ones given
+    for the pristine host (see `aiidalab_qe_muon.utils.dipolar.dipolar_field`).
+
+    :param magmom: List of the magnetic moments of the sites (3-vectors, Bohr magnetons).
+    :return: List of {idx, Bdip, B_L, B_T, Bdip_norm, B_T_norm} (T), with B_T = Bdip + B_L
+        (the contact field is in `unique_sites_hyperfine`).
+    """
+    from pymatgen.core import Structure
+    from aiidalab_qe_muon.utils.dipolar import dipolar_field
+    from aiidalab_qe_muon.utils.sites import fold_to_unit_cell, supercell_matrix
+
+    unit_lattice = np.array(structure.cell)
+    positions = np.array([site.position for site in structure.sites])
+    fields = []
+    for idx, (supercell, _) in unique_sites.get_dict().items():
+        supercell = Structure.from_dict(supercell)
+        matrix = supercell_matrix(unit_lattice, supercell.lattice.matrix)
+        muon = fold_to_unit_cell(supercell.frac_coords[-1], matrix)[0] @ unit_lattice
+        Bdip, B_L = dipolar_field(unit_lattice, positions, magmom.get_list(), muon)
+        fields.append(
+            {
+                "idx": idx,
+                "Bdip": Bdip.tolist(),
+                "B_L": B_L.tolist(),
+                "B_T": (Bdip + B_L).tolist(),
+                "Bdip_norm": float(np.linalg.norm(Bdip)),
+                "B_T_norm": float(np.linalg.norm(Bdip + B_L)),
+            }
+        )
+    return List(fields)
+
+
+@calcfunction
+def collect_contact_fields(unique_sites, **spin_densities):
+    """Contact hyperfine fields at the unique muon sites, in the format of the output
+    `unique_sites_hyperfine` of the `FindMuonWorkChain`.
+
+    :param spin_densities: `density_{index}`, the output of pp.x (`plot_num = 6`) for the
+        relaxed supercell of each site.
+    :return: Dict {index: [spin density at the muon (atomic units), contact field (T)]}.
+    """
+    from pymatgen.core import Structure
+    from aiidalab_qe_muon.utils.dipolar import contact_field
+
+    sites = unique_sites.get_dict()
+    hyperfine = {}
+    for key, density in spin_densities.items():
+        idx = key[len("density_") :]
+        muon = Structure.from_dict(sites[idx][0]).frac_coords[-1]
+        hyperfine[idx] = [
+            float(value) for value in contact_field(density.get_array("data"), muon)
+        ]
+    return Dict(hyperfine)
+
+
+def last_ionic_step(workchain):
+    """Energy and structure of the last calculation of a relaxation stopped after `nstep` ionic
+    steps, or None if its last calculation failed otherwise (the relaxation really failed)."""
+    from aiida.plugins import CalculationFactory
+
+    calculations = [
+        node for node in workchain.called_descendants if isinstance(node, CalcJobNode)
+    ]
+    if not calculations:
+        return None
+    last = max(calculations, key=lambda node: node.ctime)
+    exceeded_nstep = CalculationFactory(
+        "quantumespresso.pw"
+    ).exit_codes.ERROR_IONIC_CYCLE_EXCEEDED_NSTEP.status
+    if last.exit_status != exceeded_nstep or not all(
+        label in last.outputs for label in ("output_structure", "output_parameters")
+    ):
+        return None
+    return last.outputs.output_parameters["energy"], last.outputs.output_structure
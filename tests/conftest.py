@@ -0,0 +1,164 @@
+import numpy as np
+import pytest
+
+pytest_plugins = ["aiida.tools.pytest_fixtures"]
+
+# fractional coordinates of the muon in the unit cell and energy (eV) of each
+# relaxation: 1 and 3 are equivalent by symmetry (and almost degenerate), 2 and 4
+# are distinct sites.
+RELAXED_MUONS = {
+    "1": ([0.5, 0.25, 0.0], -1000.00),
+    "2": ([0.5, 0.5, 0.0], -999.60),
+    "3": ([0.25, 0.0, 0.5], -999.99),
+    "4": ([0.25, 0.25, 0.25], -999.20),
+}
+UNIQUE_SITES = ["1", "2", "4"]
+# the candidate sites pruned by energy after 3 ionic steps.
+PRUNED_SITES = {
+    "6": {"energy": -998.0, "delta_E": 2.0, "steps": 3, "uuid": "uuid-6"},
+    "5": {"energy": -998.5, "delta_E": 1.4, "steps": 3, "uuid": "uuid-5"},
+}
+SUPERCELL = [2, 2, 2]
+
+
+def fake_relaxation(host, frac_muon, energy):
+    """Stored relaxation, returning the `output_structure` (the supercell with the muon)
+    and the `output_parameters`."""
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from ase import Atom
+
+    atoms = host.get_ase() * SUPERCELL
+    atoms.append(
+        Atom("H", position=np.asarray(frac_muon) / SUPERCELL @ atoms.cell.array)
+    )
+    relaxation = orm.WorkflowNode().store()
+    outputs = {
+        "output_structure": orm.StructureData(ase=atoms).store(),
+        "output_parameters": orm.Dict({"energy": energy}).store(),
+    }
+    for label, node in outputs.items():
+        node.base.links.add_incoming(
+            relaxation, link_type=LinkType.RETURN, link_label=label
+        )
+    relaxation.seal()
+    return relaxation, outputs["output_structure"]
+
+
+def findmuon_run(pruned=None):
+    """A finished run with the outputs of the search of the muon sites, in the
+    `findmuon` namespace, and the `pruned_sites` if given.
+
+    The provenance is the one of the ``ImplantMuonWorkChain``: the outputs are created
+    by a calcfunction called by the run, whose input `structure` is the host (bcc Fe,
+    conventional cell).
+    """
+    from aiida import orm
+    from aiida.common.links import LinkType
+    from ase.build import bulk
+
+    host = orm.StructureData(ase=bulk("Fe", cubic=True)).store()
+    relaxations, structures = {}, {}
+    for idx, (frac_muon, energy) in RELAXED_MUONS.items():
+        relaxations[idx], structures[idx] = fake_relaxation(host, frac_muon, energy)
+
+    run = orm.WorkflowNode()
+    run.base.links.add_incoming(
+        host, link_type=LinkType.INPUT_WORK, link_label="structure"
+    )
+    run.store()
+    creator = orm.CalcFunctionNode()
+    creator.base.links.add_incoming(
+        run, link_type=LinkType.CALL_CALC, link_label="collect_unique_sites"
+    )
+    creator.store()
+
+    outputs = {
+        "unique_sites": orm.Dict(
+            {
+                idx: [
+                    structures[idx].get_pymatgen_structure().as_dict(),
+                    RELAXED_MUONS[idx][1],
+                ]
+                for idx in UNIQUE_SITES
+            }
+        ),
+        "all_index_uuid": orm.Dict(
+            {idx: node.uuid for idx, node in relaxations.items()}
+        ),
+        "unique_sites_dipolar": orm.List(
+            [
+                {
+                    "idx": int(idx),
+                    "B_T": [0.0, 0.0, 0.1 * i],
+                    "Bdip": [0.0, 0.1 * i, 0.0],
+                }
+                for i, idx in enumerate(UNIQUE_SITES)
+            ]
+        ),
+        "unique_sites_hyperfine": orm.Dict(
+            {idx: [0.01 * i, -0.5 * i] for i, idx in enumerate(UNIQUE_SITES)}
+        ),
+    }
+    if pruned is not None:
+        outputs["pruned_sites"] = orm.Dict(pruned)
+    for label, node in outputs.items():
+        node.base.links.add_incoming(
+            creator, link_type=LinkType.CREATE, link_label=label
+        )
+        node.store()
+        node.base.links.add_incoming(
+            run,
+            link_type=LinkType.RETURN,
+            link_label=label if label == "pruned_sites" else f"findmuon__{label}",
+        )
+    creator.seal()
+    run.seal()
+    return run
+
+
+@pytest.fixture
+def fake_findmuon(aiida_profile):
+    """See ``findmuon_run``."""
+    return findmuon_run()
+
+
+@pytest.fixture
+def pruned_findmuon(aiida_profile):
+    """See ``findmuon_run``, with the `PRUNED_SITES`."""
+    return findmuon_run(PRUNED_SITES)
+
+
+@pytest.fixture
+def many_relaxations(aiida_profile):
+    """Stored relaxations of 50 muon sites in bcc Fe, with random positions and
+    energies: {uuid: (energy, output_structure)}."""
+    from aiida import orm
+    from ase.build import bulk
+
+    rng = np.random.default_rng(0)
+    host = orm.StructureData(ase=bulk("Fe", cubic=True)).store()
+    relaxations = {}
+    for frac_muon, energy in zip(rng.random((50, 3)), -1000 + rng.random(50)):
+        relaxation, structure = fake_relaxation(host, frac_muon, energy)
+        relaxations[relaxation.uuid] = (energy, structure)
+    return relaxations
+
+
+@pytest.fixture
+def relaxed_muons(aiida_profile):
+    """The host (bcc Fe, conventional cell), the supercell matrix, the uuids of the
+    relaxations of ``RELAXED_MUONS`` and their outputs, as passed to the calcfunctions
+    of the trigger "sites": {`structure_{idx}`, `parameters_{idx}`}."""
+    from aiida import orm
+    from ase.build import bulk
+
+    host = orm.StructureData(ase=bulk("Fe", cubic=True)).store()
+    uuids, relaxed = {}, {}
+    for idx, (frac_muon, energy) in RELAXED_MUONS.items():
+        relaxation, structure = fake_relaxation(host, frac_muon, energy)
+        uuids[idx] = relaxation.uuid
+        relaxed[f"structure_{idx}"] = structure
+        relaxed[f"parameters_{idx}"] = relaxation.outputs.output_parameters
+    sc_matrix = orm.List([np.diag(SUPERCELL).tolist()])
+    return host, sc_matrix, uuids, relaxed
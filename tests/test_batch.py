@@ -0,0 +1,114 @@
+import sys
+import types
+
+import pytest
+from aiida import engine, orm
+from aiida.engine import ProcessState
+from ase.build import bulk
+
+from aiidalab_qe_muon.scripts.batch import (
+    STATUS_EXTRA,
+    MuonBatch,
+    batch_parameters,
+    format_status,
+)
+
+
+@pytest.fixture
+def structures_group(aiida_profile):
+    group = orm.Group(label="batch_structures").store()
+    structures = [
+        orm.StructureData(ase=bulk(element)) for element in ("Cu", "Fe", "Si")
+    ]
+    invalid = orm.StructureData(ase=bulk("Al"))
+    invalid.label = "invalid"
+    group.add_nodes([node.store() for node in structures + [invalid]])
+    # not a structure: ignored.
+    group.add_nodes(orm.Dict({"a": 1}).store())
+    yield group
+    orm.Group.collection.delete(group.pk)
+
+
+@pytest.fixture
+def fake_submission(monkeypatch):
+    """Builders and submissions without the app and the daemon: the submitted
+    workchains are stored nodes, left running."""
+    builders = []
+
+    def get_builder(codes, structure, parameters):
+        if structure.label == "invalid":
+            raise ValueError("no pseudopotentials for Al")
+        builders.append((codes, structure.pk, parameters))
+        return structure.pk
+
+    def submit(builder):
+        workchain = orm.WorkflowNode().store()
+        workchain.set_process_state(ProcessState.RUNNING)
+        return workchain
+
+    module = types.ModuleType("aiidalab_qe_muon.app.workchain")
+    module.get_builder = get_builder
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    monkeypatch.setattr(engine, "submit", submit)
+    return builders
+
+
+def terminate(workchain, exit_status):
+    workchain.set_process_state(ProcessState.FINISHED)
+    workchain.set_exit_status(exit_status)
+
+
+def test_batch_parameters():
+    parameters = batch_parameters({"mu_spacing": 1.0})
+    assert parameters["muonic"] == {"mu_spacing": 1.0, "compute_supercell": True}
+    # an explicit supercell is kept.
+    parameters = batch_parameters({"supercell_selector": [2, 2, 2]})
+    assert parameters["muonic"] == {"supercell_selector": [2, 2, 2]}
+    parameters = batch_parameters({"compute_supercell": False})
+    assert parameters["muonic"] == {"compute_supercell": False}
+    assert parameters["workchain"]["protocol"] == "fast"
+    parameters = batch_parameters({"muonic": {}, "workchain": {"protocol": "precise"}})
+    assert parameters["workchain"]["protocol"] == "precise"
+    assert parameters["workchain"]["spin_type"] == "none"
+
+
+def test_muon_batch(structures_group, fake_submission, aiida_code_installed):
+    pw_code = aiida_code_installed(default_calc_job_plugin="quantumespresso.pw")
+    batch = MuonBatch(structures_group.label)
+    assert batch.group.label == "muon_batch/batch_structures"
+    with pytest.raises(ValueError):
+        batch.submit()
+
+    batch.configure({"mu_spacing": 1.0}, pw_code, max_concurrent=2, max_attempts=2)
+    assert batch.configured
+    statuses = batch.status()
+    assert len(statuses) == 4
+    assert all(entry["status"] == "pending" for entry in statuses.values())
+
+    submitted = batch.submit()
+    assert len(submitted) == 2
+    assert {node.pk for node in batch.group.nodes} == {node.pk for node in submitted}
+    assert submitted[0].base.extras.get(STATUS_EXTRA)["label"] == batch.label
+    codes, _, parameters = fake_submission[0]
+    assert codes["pw"].uuid == pw_code.uuid
+    assert parameters["muonic"] == {"mu_spacing": 1.0, "compute_supercell": True}
+    # at most max_concurrent running.
+    assert batch.submit() == []
+    assert not batch.done()
+
+    terminate(submitted[0], 0)
+    terminate(submitted[1], 1)
+    statuses = batch.status()
+    entries = {entry["workchain"]: entry for entry in statuses.values()}
+    assert entries[submitted[0].pk]["status"] == "finished"
+    assert entries[submitted[1].pk]["status"] == "failed"
+
+    # the failed structure is submitted again, the invalid one is marked.
+    while not batch.done():
+        for workchain in batch.submit():
+            terminate(workchain, 0)
+    statuses = batch.status()
+    counts = [entry["status"] for entry in statuses.values()]
+    assert sorted(counts) == ["finished", "finished", "finished", "invalid"]
+    assert max(entry["attempts"] for entry in statuses.values()) == 2
+    assert "3 finished, 1 invalid" in format_status(statuses)
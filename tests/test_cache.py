@@ -0,0 +1,102 @@
+import os
+
+import numpy as np
+import pytest
+
+from aiidalab_qe_muon.utils.cache import ResultCache, get_result_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(tmp_path / "cache")
+
+
+def arrays(size=10, seed=0):
+    rng = np.random.default_rng(seed)
+    return {"energy": rng.random(size), "labels": np.arange(size)}
+
+
+def entries(cache):
+    return sorted(path.name for path in cache.directory.iterdir())
+
+
+def test_hit_and_miss(cache):
+    assert cache.get("a") is None
+    stored = arrays()
+    cache.set("a", stored)
+    cached = cache.get("a")
+    assert set(cached) == set(stored)
+    for key, values in stored.items():
+        np.testing.assert_array_equal(cached[key], values)
+    assert cache.get("b") is None
+
+
+def test_version_bump(cache, monkeypatch):
+    cache.set("a", arrays())
+    monkeypatch.setattr(ResultCache, "version", ResultCache.version + 1)
+    assert cache.get("a") is None
+    cache.set("a", arrays(seed=1))
+    np.testing.assert_array_equal(cache.get("a")["energy"], arrays(seed=1)["energy"])
+
+
+def test_atomic_write(cache, monkeypatch):
+    cache.set("a", arrays())
+
+    def failing_savez(fhandle, **arrays):
+        fhandle.write(b"partial")
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(np, "savez_compressed", failing_savez)
+    with pytest.raises(KeyboardInterrupt):
+        cache.set("a", arrays(seed=1))
+    # the previous entry is untouched, and no temporary file is left.
+    assert entries(cache) == [f"a.v{cache.version}.npz"]
+    np.testing.assert_array_equal(cache.get("a")["energy"], arrays()["energy"])
+
+
+def test_corrupted_entry(cache):
+    cache.set("a", arrays())
+    cache._path("a").write_bytes(b"not a npz file")
+    assert cache.get("a") is None
+    assert entries(cache) == []
+
+
+def test_lru_eviction(tmp_path):
+    cache = ResultCache(tmp_path / "cache")
+    for n, key in enumerate("abc"):
+        cache.set(key, arrays(size=1000, seed=n))
+        # distinct access times, also on file systems with a coarse resolution.
+        os.utime(cache._path(key), (n, n))
+    sizes = [path.stat().st_size for path in cache.directory.iterdir()]
+
+    # "a" becomes the most recently used, "b" the least.
+    assert cache.get("a") is not None
+    # room for three entries only.
+    cache.max_size = sum(sizes) + min(sizes) // 2
+    cache.set("d", arrays(size=1000, seed=3))
+    assert cache.get("b") is None
+    assert all(cache.get(key) is not None for key in "acd")
+    assert sum(path.stat().st_size for path in cache.directory.iterdir()) <= (
+        cache.max_size
+    )
+
+
+def test_invalidate_and_clear(cache):
+    for key in "abc":
+        cache.set(key, arrays())
+    cache.invalidate("b")
+    cache.invalidate("missing")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    cache.clear()
+    assert entries(cache) == []
+    # nothing to evict or clear in a cache never written.
+    empty = ResultCache(cache.directory / "empty")
+    empty.evict()
+    empty.clear()
+
+
+def test_get_result_cache(aiida_profile):
+    cache = get_result_cache()
+    assert cache.directory.name == aiida_profile.name
+    assert cache.directory.parent.name == "aiidalab_qe_muon"
@@ -0,0 +1,148 @@
+import numpy as np
+import pytest
+from ase.build import bulk
+
+from aiidalab_qe_muon.utils.cost import (
+    HUBBARD_OVERHEAD,
+    RY_TO_EV,
+    SCF_ITERATIONS_PER_RELAXATION,
+    _calibrate_seconds_per_unit,
+    calibrate_seconds_per_unit,
+    estimate_cost,
+    fft_points,
+    format_cost,
+    number_of_bands,
+    plane_waves,
+    valence_electrons,
+    work_units,
+)
+from aiidalab_qe_muon.utils.kmesh import kpoints_mesh
+
+
+def test_valence_electrons():
+    assert valence_electrons([1, 8, 14, 26, 29]).tolist() == [1, 6, 4, 8, 11]
+
+
+def test_number_of_bands():
+    # four more bands for few electrons, 20% more for many.
+    assert number_of_bands(8) == 8
+    assert number_of_bands(100) == 60
+
+
+def test_estimate_cost():
+    atoms = bulk("Cu")
+    cell, numbers = atoms.cell.array, atoms.numbers
+    estimate = estimate_cost(cell, numbers, [2, 2, 2], 10, 0.3)
+    assert estimate["relaxations"] == 10
+    assert estimate["atoms"] == 9
+    assert estimate["electrons"] == 88
+    assert estimate["bands"] == number_of_bands(88)
+    mesh = kpoints_mesh(cell, [2, 2, 2], 0.3)
+    assert estimate["kpoints_mesh"] == list(mesh)
+    # only time reversal is left.
+    assert estimate["kpoints"] == int(np.ceil(np.prod(mesh) / 2))
+    assert estimate["core_hours"] == pytest.approx(
+        10 * estimate["core_hours_per_relaxation"]
+    )
+
+    # muonium has one electron more.
+    neutral = estimate_cost(cell, numbers, [2, 2, 2], 10, 0.3, charged_muon=False)
+    assert neutral["electrons"] == 89
+    # the pseudopotentials give the valence electrons.
+    pseudo = estimate_cost(
+        cell, numbers, np.diag([2, 2, 2]), 10, 0.3, z_valence={29: 19}
+    )
+    assert pseudo["electrons"] == 8 * 19
+
+    # the time is proportional to the calibration, spin and Hubbard.
+    scaled = estimate_cost(cell, numbers, [2, 2, 2], 10, 0.3, seconds_per_unit=4e-9)
+    assert scaled["core_hours"] == pytest.approx(2 * estimate["core_hours"])
+    hubbard = estimate_cost(cell, numbers, [2, 2, 2], 10, 0.3, hubbard=True)
+    assert hubbard["core_hours"] == pytest.approx(
+        HUBBARD_OVERHEAD * estimate["core_hours"]
+    )
+    spin = estimate_cost(cell, numbers, [2, 2, 2], 10, 0.3, spin_polarized=True)
+    assert spin["core_hours"] == pytest.approx(2 * estimate["core_hours"])
+    assert spin["memory_gb"] > estimate["memory_gb"]
+
+    # the plane waves and the FFT grid scale with the volume of the supercell.
+    larger = estimate_cost(cell, numbers, [3, 3, 3], 10, 0.3)
+    assert larger["plane_waves"] == pytest.approx(
+        27 / 8 * estimate["plane_waves"], 1e-3
+    )
+    assert larger["fft_points"] == pytest.approx(27 / 8 * estimate["fft_points"], 1e-3)
+    assert "10 relaxations of 9 atoms" in format_cost(estimate)
+
+
+OUTPUT = {
+    "volume": 100.0,
+    "wfc_cutoff": 40 * RY_TO_EV,
+    "rho_cutoff": 320 * RY_TO_EV,
+    "number_of_k_points": 4,
+    "number_of_bands": 30,
+}
+
+
+def fake_pw_relaxation(
+    seconds_per_unit, calculation="relax", exit_status=0, missing=None, **extra
+):
+    """Stored pw.x calculation which ran for ``seconds_per_unit`` per unit of work and
+    SCF iteration, on 4 cores; ``missing`` is removed from its output parameters."""
+    from aiida import orm
+    from aiida.common.links import LinkType
+
+    output = {**OUTPUT, **extra}
+    iterations = output.get(
+        "total_number_of_scf_iterations", SCF_ITERATIONS_PER_RELAXATION
+    )
+    work = work_units(
+        output["number_of_k_points"],
+        output["number_of_bands"],
+        plane_waves(output["volume"], 40),
+        fft_points(output["volume"], 320),
+    )
+    output["wall_time_seconds"] = seconds_per_unit * work * iterations / 4
+    output.pop(missing, None)
+
+    node = orm.CalcJobNode(process_type="aiida.calculations:quantumespresso.pw")
+    node.set_option("resources", {"num_machines": 1, "num_mpiprocs_per_machine": 4})
+    parameters = orm.Dict({"CONTROL": {"calculation": calculation}}).store()
+    node.base.links.add_incoming(parameters, LinkType.INPUT_CALC, "parameters")
+    node.store()
+    output_parameters = orm.Dict(output)
+    output_parameters.base.links.add_incoming(
+        node, LinkType.CREATE, "output_parameters"
+    )
+    output_parameters.store()
+    node.set_exit_status(exit_status)
+    node.seal()
+    return node
+
+
+def test_calibrate_seconds_per_unit(aiida_profile_clean):
+    profile = aiida_profile_clean.name
+    _calibrate_seconds_per_unit.cache_clear()
+    assert calibrate_seconds_per_unit(profile) == (None, 0)
+
+    for seconds_per_unit in (1e-9, 2e-9, 6e-9):
+        fake_pw_relaxation(seconds_per_unit)
+    # the runs which are not relaxations, failed, or are incomplete are skipped.
+    fake_pw_relaxation(1e-6, calculation="scf")
+    fake_pw_relaxation(1e-6, exit_status=300)
+    fake_pw_relaxation(1e-6, missing="number_of_bands")
+    # the actual number of SCF iterations is used, when given.
+    fake_pw_relaxation(2e-9, total_number_of_scf_iterations=37)
+
+    seconds_per_unit, n_runs = calibrate_seconds_per_unit(profile)
+    assert n_runs == 4
+    assert seconds_per_unit == pytest.approx(2e-9)
+
+    # a new relaxation refreshes the cached calibration.
+    fake_pw_relaxation(6e-9)
+    fake_pw_relaxation(6e-9)
+    seconds_per_unit, n_runs = calibrate_seconds_per_unit(profile)
+    assert n_runs == 6
+    assert seconds_per_unit == pytest.approx(4e-9)
+    assert _calibrate_seconds_per_unit.cache_info().hits == 0
+    calibrate_seconds_per_unit(profile)
+    assert _calibrate_seconds_per_unit.cache_info().hits == 1
@@ -0,0 +1,61 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from aiidalab_qe_muon.utils.dipolar import (
+    DIPOLAR_CONSTANT,
+    contact_field,
+    dipolar_field,
+    periodic_interpolation,
+)
+
+
+def reference_dipolar_field(cell, positions, moments, muon, radius):
+    """Explicit loop over the periodic images inside the sphere."""
+    field = np.zeros(3)
+    n = int(np.ceil(radius / min(np.linalg.norm(cell, axis=1)))) + 2
+    for shift in itertools.product(range(-n, n + 1), repeat=3):
+        for position, moment in zip(positions, moments):
+            r = position + np.array(shift) @ cell - muon
+            distance = np.linalg.norm(r)
+            if 1e-6 < distance < radius:
+                field += 3 * r * np.dot(moment, r) / distance**5
+                field -= moment / distance**3
+    return DIPOLAR_CONSTANT * field
+
+
+def test_cubic_site_has_no_dipolar_field():
+    cell = 3.0 * np.eye(3)
+    Bdip, B_L = dipolar_field(cell, [[0, 0, 0]], [[0, 0, 1]], [1.5, 1.5, 1.5])
+    assert np.allclose(Bdip, 0.0, atol=1e-10)
+    assert np.allclose(B_L, [0, 0, 4 * np.pi / 3 * DIPOLAR_CONSTANT / 27])
+
+
+def test_antiferromagnet_against_explicit_sum():
+    cell = np.array([[4.0, 0.0, 0.0], [0.5, 3.5, 0.0], [0.3, 0.2, 5.0]])
+    positions = np.array([[0.0, 0.0, 0.0], [2.1, 1.8, 2.4]])
+    moments = np.array([[0.3, -0.2, 2.0], [-0.3, 0.2, -2.0]])
+    muon = np.array([1.1, 0.7, 1.3])
+    Bdip, B_L = dipolar_field(cell, positions, moments, muon, radius=15.0)
+    reference = reference_dipolar_field(cell, positions, moments, muon, 15.0)
+    assert np.allclose(Bdip, reference)
+    assert np.allclose(B_L, 0.0)
+
+
+def test_periodic_interpolation():
+    rng = np.random.default_rng(0)
+    data = rng.normal(size=(4, 5, 6))
+    on_grid = periodic_interpolation(data, [2 / 4, 3 / 5, 1 / 6])
+    assert on_grid == pytest.approx(data[2, 3, 1])
+    # periodic: the last points are interpolated with the first ones.
+    middle = periodic_interpolation(data, [3.5 / 4, 0.0, 0.0])
+    assert middle == pytest.approx(0.5 * (data[3, 0, 0] + data[0, 0, 0]))
+    wrapped = periodic_interpolation(data, [1.25, -1.0, 0.0])
+    assert wrapped == pytest.approx(data[1, 0, 0])
+
+
+def test_contact_field_units():
+    density, field = contact_field(np.full((3, 3, 3), 0.01), [0.1, 0.2, 0.3])
+    assert density == pytest.approx(0.01)
+    assert field == pytest.approx(0.524304)
@@ -0,0 +1,284 @@
+"""Runs of the ``ImplantMuonWorkChain`` for the trigger "sites", with mocked relaxations."""
+import io
+
+import numpy as np
+import pytest
+from aiida import orm
+from aiida.common.exceptions import MissingEntryPointError
+from aiida.common.links import LinkType
+from aiida.engine import ProcessState, run_get_node
+from aiida.plugins import WorkflowFactory
+from ase.build import bulk
+
+try:
+    WorkflowFactory("musconv")
+    WorkflowFactory("muon.find_muon")
+except MissingEntryPointError:
+    pytest.skip("the aiida-muon workchains are not installed", allow_module_level=True)
+
+# the 4 inequivalent candidates of bcc Fe with a spacing of 0.8 A, and their energies.
+ENERGIES = {"0": -10.0, "1": -9.8, "2": -9.0, "3": -9.7}
+
+
+class FakeRelaxations:
+    """Stand-in of the submission of the relaxations.
+
+    Each submission is a stored running node, terminated on the event loop of the runner
+    after ``delays[site]`` seconds: it finishes with the energy ``energies[site]`` and
+    its input structure; with the energy pruning (``nstep`` in the inputs), it stops
+    after the first ionic steps, 0.1 eV higher.
+    """
+
+    def __init__(self, energies):
+        self.energies = energies
+        self.delays = {}
+        # (call link label, node, inputs, labels of the relaxations running), in order.
+        self.submitted = []
+
+    def submit(self, workchain, process_class, inputs=None, **kwargs):
+        inputs = inputs or kwargs
+        label = inputs["metadata"]["call_link_label"]
+        site = label.split("_")[1]
+        node = orm.WorkChainNode(
+            process_type="aiida.workflows:quantumespresso.pw.relax"
+        )
+        node.set_process_state(ProcessState.RUNNING)
+        node.store()
+        running = [entry[0] for entry in self.submitted if not entry[1].is_terminated]
+        running.append(label)
+        self.submitted.append((label, node, inputs, running))
+
+        parameters = inputs["base"]["pw"]["parameters"].get_dict()
+        stopped = "nstep" in parameters.get("CONTROL", {})
+        workchain.runner.loop.call_later(
+            self.delays.get(site, 0.0),
+            self.terminate,
+            node,
+            inputs["structure"],
+            self.energies[site] + (0.1 if stopped else 0.0),
+            stopped,
+        )
+        return node
+
+    @staticmethod
+    def terminate(node, structure, energy, stopped):
+        outputs = {
+            "output_structure": structure.clone(),
+            "output_parameters": orm.Dict({"energy": energy}),
+        }
+        if stopped:
+            # the pw.x calculation exceeded `nstep`, the relaxation is not restarted.
+            calculation = orm.CalcJobNode(
+                process_type="aiida.calculations:quantumespresso.pw"
+            )
+            calculation.set_option("resources", {"num_machines": 1})
+            calculation.base.links.add_incoming(
+                node, LinkType.CALL_CALC, "iteration_01"
+            )
+            calculation.store()
+            for label, output in outputs.items():
+                output.base.links.add_incoming(calculation, LinkType.CREATE, label)
+                output.store()
+            calculation.set_process_state(ProcessState.FINISHED)
+            calculation.set_exit_status(502)
+            calculation.seal()
+            exit_status = 401
+        else:
+            for label, output in outputs.items():
+                output.store()
+                output.base.links.add_incoming(node, LinkType.RETURN, label)
+            exit_status = 0
+        node.set_process_state(ProcessState.FINISHED)
+        node.set_exit_status(exit_status)
+        node.seal()
+
+    def labels(self):
+        return [label for label, *_ in self.submitted]
+
+
+@pytest.fixture
+def relaxations(monkeypatch):
+    from aiida.manage import get_manager
+
+    from aiidalab_qe_muon.workflows.implantmuonworkchain import ImplantMuonWorkChain
+
+    fake = FakeRelaxations(ENERGIES)
+    monkeypatch.setattr(
+        ImplantMuonWorkChain,
+        "submit",
+        lambda self, process, inputs=None, **kwargs: fake.submit(
+            self, process, inputs, **kwargs
+        ),
+    )
+    monkeypatch.setattr(get_manager().get_runner(), "_poll_interval", 0.01)
+    return fake
+
+
+def pseudo(element):
+    from aiida_pseudo.data.pseudo import UpfData
+
+    content = f'<UPF version="2.0.1">\n<PP_HEADER element="{element}" z_valence="1.0"/>\n</UPF>\n'
+    return UpfData(io.BytesIO(content.encode()), filename=f"{element}.upf")
+
+
+@pytest.fixture
+def implant_muon(aiida_profile_clean, aiida_code_installed):
+    """Run the workchain on bcc Fe with the given inputs: return the results and node."""
+    from aiidalab_qe_muon.workflows.implantmuonworkchain import ImplantMuonWorkChain
+
+    code = aiida_code_installed(default_calc_job_plugin="quantumespresso.pw")
+    structure = orm.StructureData(ase=bulk("Fe", cubic=True)).store()
+
+    def run(**inputs):
+        inputs.setdefault("mu_spacing", orm.Float(0.8))
+        return run_get_node(
+            ImplantMuonWorkChain,
+            structure=structure,
+            sc_matrix=orm.List([np.eye(3, dtype=int).tolist()]),
+            relax={
+                "base": {
+                    "pw": {
+                        "code": code,
+                        "parameters": orm.Dict(
+                            {
+                                "CONTROL": {"calculation": "relax"},
+                                "SYSTEM": {"ecutwfc": 30.0, "ecutrho": 240.0},
+                            }
+                        ),
+                        "pseudos": {"Fe": pseudo("Fe"), "H": pseudo("H")},
+                        "metadata": {"options": {"resources": {"num_machines": 1}}},
+                    },
+                    "kpoints_distance": orm.Float(0.3),
+                },
+            },
+            **inputs,
+        )
+
+    return run
+
+
+def test_throttling(implant_muon, relaxations):
+    results, node = implant_muon(max_concurrent=orm.Int(2))
+    assert node.is_finished_ok
+    assert relaxations.labels() == ["relax_0", "relax_1", "relax_2", "relax_3"]
+    assert max(len(running) for *_, running in relaxations.submitted) == 2
+    unique_sites = results["findmuon"]["unique_sites"].get_dict()
+    assert {idx: energy for idx, (_, energy) in unique_sites.items()} == ENERGIES
+    assert results["summary"].get_array("site_index").tolist() == [0, 1, 3, 2]
+
+
+def test_relaxations_finishing_out_of_order(implant_muon, relaxations):
+    """The queue is refilled as soon as any relaxation terminates, not the oldest."""
+    relaxations.delays = {"0": 2.0}
+    _, node = implant_muon(max_concurrent=orm.Int(2))
+    assert node.is_finished_ok
+    assert [running for *_, running in relaxations.submitted] == [
+        ["relax_0"],
+        ["relax_0", "relax_1"],
+        ["relax_0", "relax_2"],
+        ["relax_0", "relax_3"],
+    ]
+
+
+def test_pruning(implant_muon, relaxations):
+    relaxations.delays = {"0": 0.0, "1": 0.1, "2": 0.2, "3": 0.3}
+    results, node = implant_muon(
+        prune_energy=orm.Float(0.5), prune_steps=orm.Int(3), max_concurrent=orm.Int(2)
+    )
+    assert node.is_finished_ok
+    # after 3 steps, the site 2 is 1.1 eV above the relaxed site 0: it is not continued.
+    pruned = results["pruned_sites"].get_dict()
+    assert list(pruned) == ["2"]
+    assert pruned["2"]["delta_E"] == pytest.approx(1.1)
+    assert pruned["2"]["steps"] == 3
+    assert sorted(relaxations.labels()) == [
+        "relax_0",
+        "relax_0_continued",
+        "relax_1",
+        "relax_1_continued",
+        "relax_2",
+        "relax_3",
+        "relax_3_continued",
+    ]
+    for label, child, inputs, _ in relaxations.submitted:
+        parameters = inputs["base"]["pw"]["parameters"].get_dict()
+        if label.endswith("continued"):
+            assert "nstep" not in parameters["CONTROL"]
+            # from the last ionic step of the first relaxation.
+            first = next(n for lab, n, *_ in relaxations.submitted if lab == label[:7])
+            assert inputs["structure"].uuid == (
+                first.called[0].outputs.output_structure.uuid
+            )
+        else:
+            assert parameters["CONTROL"]["nstep"] == 3
+            assert inputs["base"]["max_iterations"].value == 1
+    unique_sites = results["findmuon"]["unique_sites"].get_dict()
+    assert sorted(unique_sites) == ["0", "1", "3"]
+    assert sorted(results["findmuon"]["all_index_uuid"].get_dict()) == list("0123")
+
+
+def test_screening(implant_muon, relaxations):
+    results, node = implant_muon(
+        screening=orm.Bool(True),
+        screening_parameters=orm.Dict({"energy_window": 0.5}),
+    )
+    assert node.is_finished_ok
+    screening = results["screening"].get_dict()
+    assert {idx for idx, site in screening.items() if site["selected"]} == {
+        "0",
+        "1",
+        "3",
+    }
+    assert relaxations.labels() == [
+        "screen_0",
+        "screen_1",
+        "screen_2",
+        "screen_3",
+        "relax_0",
+        "relax_1",
+        "relax_3",
+    ]
+    children = {
+        label: (child, inputs) for label, child, inputs, _ in relaxations.submitted
+    }
+    screen = children["screen_0"][1]["base"]
+    assert screen["pw"]["parameters"]["SYSTEM"]["ecutwfc"] == pytest.approx(18.0)
+    assert screen["kpoints"].get_kpoints_mesh()[0] == [1, 1, 1]
+    relax = children["relax_0"][1]
+    assert relax["base"]["pw"]["parameters"]["SYSTEM"]["ecutwfc"] == 30.0
+    assert relax["base"]["kpoints_distance"].value == 0.3
+    # from the structure relaxed by the screening.
+    assert relax["structure"].uuid == (
+        children["screen_0"][0].outputs.output_structure.uuid
+    )
+    assert sorted(results["findmuon"]["unique_sites"].get_dict()) == ["0", "1", "3"]
+
+
+def test_reuse(implant_muon, relaxations):
+    from aiidalab_qe_muon.utils.reuse import HASH_EXTRA
+
+    first, _ = implant_muon()
+    assert len(relaxations.submitted) == 4
+    assert all(
+        child.base.extras.get(HASH_EXTRA) for _, child, *_ in relaxations.submitted
+    )
+
+    results, node = implant_muon()
+    assert node.is_finished_ok
+    # all the relaxations are reused, none is submitted.
+    assert len(relaxations.submitted) == 4
+    assert (
+        results["findmuon"]["all_index_uuid"].get_dict()
+        == first["findmuon"]["all_index_uuid"].get_dict()
+    )
+    assert results["findmuon"]["unique_sites"].get_dict() == (
+        first["findmuon"]["unique_sites"].get_dict()
+    )
+
+    # not the relaxations of other candidates, nor without reuse.
+    relaxations.energies = {"0": -10.0}
+    implant_muon(mu_spacing=orm.Float(1.0))
+    assert len(relaxations.submitted) == 5
+    relaxations.energies = ENERGIES
+    implant_muon(reuse_relaxations=orm.Bool(False))
+    assert len(relaxations.submitted) == 9
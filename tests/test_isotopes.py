@@ -0,0 +1,69 @@
+"""The compiled isotope table against the previous pandas lookup of the text table."""
+import numpy as np
+import pandas as pd
+import pytest
+from importlib_resources import as_file
+
+from aiidalab_qe_muon.utils.isotopes import (
+    ISOTOPE_TABLE_SOURCE,
+    _compile_table,
+    get_isotope_table,
+    get_isotopes,
+    isotope_average,
+    munhbar,
+)
+
+
+@pytest.fixture(scope="module")
+def info():
+    with as_file(ISOTOPE_TABLE_SOURCE) as path:
+        return pd.read_table(
+            path,
+            comment="%",
+            sep=r"\s+",
+            names=[
+                "Z",
+                "A",
+                "Stable",
+                "Symbol",
+                "Element",
+                "Spin",
+                "G_factor",
+                "Abundance",
+                "Quadrupole",
+            ],
+        )
+
+
+def reference_average(info, Z):
+    """The previous isotope average, summed over the rows of a pandas filter."""
+    average = 0.0
+    for a in info[info.Z == Z][["Abundance", "Spin", "G_factor"]].to_numpy():
+        average += (a[0] / 100) * a[1] * (a[1] + 1) * (munhbar * a[2]) ** 2
+    return average
+
+
+def test_isotopes_match_pandas(info):
+    for Z in range(1, info.Z.max() + 1):
+        expected = info[info.Z == Z][["Abundance", "Spin", "G_factor"]].to_numpy()
+        np.testing.assert_array_equal(get_isotopes(Z), expected.reshape(-1, 3))
+        assert isotope_average(Z) == pytest.approx(
+            reference_average(info, Z), rel=1e-12, abs=0.0
+        )
+
+
+def test_compiled_table_is_up_to_date():
+    """The shipped .npz is the compilation of the shipped text table."""
+    with as_file(ISOTOPE_TABLE_SOURCE) as path:
+        compiled = _compile_table(path)
+    table = get_isotope_table()
+    assert set(table) == set(compiled)
+    for key, values in compiled.items():
+        np.testing.assert_allclose(table[key], values, rtol=1e-14)
+
+
+def test_elements_beyond_the_table(info):
+    """As the pandas lookup, the elements missing from the table have no isotope."""
+    for Z in (0, info.Z.max() + 1, 200):
+        assert get_isotopes(Z).shape == (0, 3)
+        assert isotope_average(Z) == 0.0
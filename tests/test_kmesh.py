@@ -0,0 +1,63 @@
+"""The k-points mesh of the supercells against the calcfunction used at submission."""
+import numpy as np
+import pytest
+from ase import Atoms
+from ase.build import bulk, make_supercell
+
+from aiidalab_qe_muon.utils.kmesh import kpoints_mesh
+
+CELLS = {
+    "cubic": bulk("Cu", cubic=True),
+    "hexagonal": bulk("Mg", "hcp", a=3.21, c=5.21),
+    "skewed": Atoms(
+        "Fe2O",
+        scaled_positions=[[0.0, 0.0, 0.0], [0.5, 0.4, 0.3], [0.2, 0.7, 0.6]],
+        cell=[[4.1, 0.0, 0.0], [0.9, 3.7, 0.0], [0.6, -0.8, 5.2]],
+        pbc=True,
+    ),
+}
+SUPERCELLS = {
+    "identity": np.eye(3, dtype=int),
+    "diagonal": np.diag([1, 2, 3]),
+    "isotropic": np.diag([2, 2, 2]),
+    "non-diagonal": np.array([[1, 1, 0], [-1, 1, 0], [0, 0, 2]]),
+    "sheared": np.array([[2, 1, 0], [0, 1, 1], [1, 0, 2]]),
+}
+
+
+@pytest.mark.parametrize("supercell", SUPERCELLS)
+@pytest.mark.parametrize("cell", CELLS)
+def test_kpoints_mesh_matches_create_kpoints_from_distance(
+    aiida_profile, cell, supercell
+):
+    from aiida import orm
+    from aiida.plugins import CalculationFactory
+
+    create_kpoints_from_distance = CalculationFactory(
+        "quantumespresso.create_kpoints_from_distance"
+    )
+
+    atoms = CELLS[cell]
+    structure = orm.StructureData(ase=make_supercell(atoms, SUPERCELLS[supercell]))
+    for distance in (0.1, 0.15, 0.3, 0.5):
+        for force_parity in (False, True):
+            expected = create_kpoints_from_distance(
+                structure,
+                orm.Float(distance),
+                orm.Bool(force_parity),
+                metadata={"store_provenance": False},
+            ).get_kpoints_mesh()[0]
+            mesh = kpoints_mesh(
+                atoms.cell.array,
+                SUPERCELLS[supercell],
+                distance,
+                force_parity=force_parity,
+            )
+            assert list(mesh) == list(expected), (distance, force_parity)
+
+
+def test_kpoints_mesh_diagonal_shorthand():
+    cell = CELLS["hexagonal"].cell.array
+    assert kpoints_mesh(cell, [1, 2, 3], 0.2) == kpoints_mesh(
+        cell, np.diag([1, 2, 3]), 0.2
+    )
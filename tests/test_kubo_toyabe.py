@@ -0,0 +1,155 @@
+"""Kubo-Toyabe polarizations against the analytic forms and numerical references."""
+import numpy as np
+import pytest
+from scipy.integrate import cumulative_trapezoid, quad
+
+from aiidalab_qe_muon.utils.kubo_toyabe import (
+    dynamic_kubo_toyabe,
+    gamma_mu,
+    kubo_toyabe,
+    kubo_toyabe_sites,
+    static_kubo_toyabe,
+)
+
+DELTA2 = 1e12  # Delta = 1 us^-1
+TIMES = np.linspace(0, 10e-6, 201)
+FIELDS = [0.0, 0.002, 0.01, 0.05]
+
+
+def static_reference(delta2, field, times):
+    """Hayano et al. static LF polarization, integrated by adaptive quadrature."""
+    omega = gamma_mu * field
+    x = 0.5 * delta2 * times**2
+    if omega == 0:
+        return 1 / 3 + 2 / 3 * (1 - 2 * x) * np.exp(-x)
+    integral = np.array(
+        [
+            quad(
+                lambda s: np.exp(-0.5 * delta2 * s**2) * np.sin(omega * s),
+                0,
+                t,
+                limit=500,
+            )[0]
+            for t in times
+        ]
+    )
+    return (
+        1
+        - 2 * delta2 / omega**2 * (1 - np.exp(-x) * np.cos(omega * times))
+        + 2 * delta2**2 / omega**3 * integral
+    )
+
+
+def volterra(delta2, field, nu, t_max, n):
+    """Strong-collision equation solved by the plain trapezoidal rule on n points."""
+    t = np.linspace(0, t_max, n)
+    h = t[1] - t[0]
+    omega = gamma_mu * field
+    x = 0.5 * delta2 * t**2
+    if omega == 0:
+        static = 1 / 3 + 2 / 3 * (1 - 2 * x) * np.exp(-x)
+    else:
+        integral = cumulative_trapezoid(np.exp(-x) * np.sin(omega * t), t, initial=0)
+        static = (
+            1
+            - 2 * delta2 / omega**2 * (1 - np.exp(-x) * np.cos(omega * t))
+            + 2 * delta2**2 / omega**3 * integral
+        )
+    kernel = static * np.exp(-nu * t)
+    polarization = np.empty(n)
+    polarization[0] = 1.0
+    for i in range(1, n):
+        history = np.dot(polarization[i - 1 : 0 : -1], kernel[1:i]) + 0.5 * kernel[i]
+        polarization[i] = (kernel[i] + nu * h * history) / (
+            1 - 0.5 * nu * h * kernel[0]
+        )
+    return polarization
+
+
+def dynamic_reference(delta2, field, nu, times, n=10001):
+    """Richardson extrapolation of ``volterra`` on n and 2n - 1 points, at ``times``."""
+    coarse = volterra(delta2, field, nu, times[-1], n)
+    fine = volterra(delta2, field, nu, times[-1], 2 * n - 1)
+    extrapolated = (4 * fine[::2] - coarse) / 3
+    return extrapolated[:: (n - 1) // (len(times) - 1)]
+
+
+def test_zero_field_matches_kubo_toyabe():
+    second_moments = np.array([0.3e12, 1e12, 2.5e12])
+    expected = np.array([kubo_toyabe(TIMES, s) for s in second_moments])
+    np.testing.assert_allclose(
+        kubo_toyabe_sites(second_moments, TIMES), expected, atol=1e-9
+    )
+    np.testing.assert_allclose(
+        static_kubo_toyabe(second_moments, TIMES)[:, 0], expected, atol=1e-9
+    )
+
+
+def test_static_longitudinal_field_against_quadrature():
+    polarization = static_kubo_toyabe([DELTA2], TIMES, FIELDS)
+    for k, field in enumerate(FIELDS):
+        np.testing.assert_allclose(
+            polarization[0, k], static_reference(DELTA2, field, TIMES), atol=1e-6
+        )
+
+
+def test_dynamic_without_hopping_is_static():
+    polarization = dynamic_kubo_toyabe([0.5e12, DELTA2], TIMES, FIELDS, nu=[0.0])
+    np.testing.assert_allclose(
+        polarization[:, :, 0],
+        static_kubo_toyabe([0.5e12, DELTA2], TIMES, FIELDS),
+        atol=1e-12,
+    )
+
+
+@pytest.mark.parametrize("field", [0.0, 0.01, 0.05])
+@pytest.mark.parametrize("nu", [0.5e6, 2e6, 1e7])
+def test_dynamic_against_integral_equation(field, nu):
+    polarization = dynamic_kubo_toyabe([DELTA2], TIMES, [field], [nu])[0, 0, 0]
+    np.testing.assert_allclose(
+        polarization, dynamic_reference(DELTA2, field, nu, TIMES), atol=1e-4
+    )
+
+
+@pytest.mark.parametrize("field", [0.1, 0.5, 1.0])
+@pytest.mark.parametrize("nu", [1e6, 1e7, 1e8, 1e9])
+def test_dynamic_at_high_field(field, nu):
+    polarization = dynamic_kubo_toyabe([DELTA2], TIMES, [field], [nu])[0, 0, 0]
+    if nu < 1e8:
+        reference = dynamic_reference(DELTA2, field, nu, TIMES)
+    else:
+        # fast fluctuations: exponential relaxation at the Redfield rate.
+        omega = gamma_mu * field
+        reference = np.exp(-2 * DELTA2 * nu / (omega**2 + nu**2) * TIMES)
+    np.testing.assert_allclose(polarization, reference, atol=1e-5)
+
+
+def test_dynamic_at_high_field_runtime(record_property):
+    """The integration grid does not resolve the precession: no slowdown in field."""
+    import time
+
+    second_moments = np.linspace(0.2e12, 3e12, 10)
+    start = time.perf_counter()
+    polarization = dynamic_kubo_toyabe(
+        second_moments, TIMES, [0.1, 0.5, 1.0], [1e6, 1e7, 1e8]
+    )
+    elapsed = time.perf_counter() - start
+    record_property("seconds", elapsed)
+    assert polarization.shape == (10, 3, 3, len(TIMES))
+    assert elapsed < 2.0
+
+
+def test_dynamic_broadcasts_sites_fields_and_rates():
+    second_moments, fields, rates = [0.5e12, DELTA2], [0.0, 0.01], [1e6, 5e6, 2e7]
+    together = dynamic_kubo_toyabe(second_moments, TIMES, fields, rates)
+    assert together.shape == (2, 2, 3, len(TIMES))
+    for i, s in enumerate(second_moments):
+        for k, field in enumerate(fields):
+            for j, nu in enumerate(rates):
+                alone = dynamic_kubo_toyabe([s], TIMES, [field], [nu])[0, 0, 0]
+                np.testing.assert_allclose(together[i, k, j], alone, atol=1e-4)
+
+
+def test_dynamic_rejects_non_uniform_times():
+    with pytest.raises(ValueError):
+        dynamic_kubo_toyabe([DELTA2], TIMES**2, [0.0], [1e6])
@@ -0,0 +1,45 @@
+"""The plugin registration imports the panel modules only when the app asks."""
+import subprocess
+import sys
+
+import pytest
+
+panel = pytest.importorskip("aiidalab_qe.common.panel")
+if not hasattr(panel, "OutlinePanel"):
+    pytest.skip("aiidalab-qe without the OutlinePanel API", allow_module_level=True)
+
+
+def imported_after(code):
+    """Modules of the plugin imported by running ``code`` in a fresh interpreter."""
+    script = f"""
+import sys
+{code}
+modules = (name for name in sys.modules if name.startswith("aiidalab_qe_muon"))
+print(" ".join(sorted(modules)))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    )
+    return set(output.stdout.split())
+
+
+def test_import_is_lazy():
+    modules = imported_after("import aiidalab_qe_muon.app")
+    assert not modules & {
+        "aiidalab_qe_muon.app.settings",
+        "aiidalab_qe_muon.app.structure",
+        "aiidalab_qe_muon.app.workchain",
+        "aiidalab_qe_muon.app.result",
+        "aiidalab_qe_muon.app.codes",
+    }
+
+
+def test_get_imports_only_the_requested_item():
+    # as ``aiidalab_qe.app.utils.get_entry_items``, which calls ``get`` per item.
+    modules = imported_after(
+        "from aiidalab_qe_muon.app import property\n"
+        "property.get('outline', False)\n"
+        "property.get('outline')"
+    )
+    assert "aiidalab_qe_muon.app.result" not in modules
+    assert "aiidalab_qe_muon.app.settings" not in modules
@@ -0,0 +1,207 @@
+"""The calcfunctions and helpers of the trigger "sites", on small synthetic structures."""
+import numpy as np
+import pytest
+from aiida import orm
+from aiida.common.links import LinkType
+from ase.build import bulk
+
+from aiidalab_qe_muon.workflows.muon_sites import (
+    collect_contact_fields,
+    collect_unique_sites,
+    compute_dipolar_fields,
+    generate_muon_supercells,
+    group_relaxed_sites,
+    last_ionic_step,
+    select_screened_sites,
+)
+
+# sorted by energy, see RELAXED_MUONS: 1 and 3 are equivalent.
+LABELS = ["1", "3", "2", "4"]
+ENERGIES = [-1000.0, -999.99, -999.6, -999.2]
+
+
+@pytest.mark.parametrize("prune_symmetry, number", [(True, 4), (False, 50)])
+def test_generate_muon_supercells(aiida_profile, prune_symmetry, number):
+    host = orm.StructureData(ase=bulk("Fe", cubic=True))
+    matrix = [[1, 0, 0], [0, 1, 0], [0, 1, 2]]
+    outputs = generate_muon_supercells(
+        structure=host,
+        sc_matrix=orm.List([matrix]),
+        mu_spacing=orm.Float(0.8),
+        prune_symmetry=orm.Bool(prune_symmetry),
+        symprec=orm.Float(1e-3),
+    )
+    candidates = outputs["candidates"]
+    frac = candidates.get_array("positions")
+    multiplicities = candidates.get_array("multiplicities")
+    assert len(frac) == number
+    assert multiplicities.sum() == 50
+
+    pristine = outputs["pristine"]
+    assert pristine.get_kind_names() == ["Fe"]
+    assert len(pristine.sites) == 4
+    assert np.allclose(pristine.cell, np.array(matrix) @ host.cell)
+    supercells = [key for key in outputs if key.startswith("supercell_")]
+    assert len(supercells) == number
+    for idx, frac_muon in enumerate(frac):
+        supercell = outputs[f"supercell_{idx}"]
+        assert len(supercell.sites) == 5
+        assert supercell.sites[-1].kind_name == "H"
+        # in the first unit cell of the supercell.
+        assert np.allclose(supercell.sites[-1].position, frac_muon @ host.cell)
+
+
+def test_group_relaxed_sites(relaxed_muons):
+    host, sc_matrix, _, relaxed = relaxed_muons
+    labels, energies, representatives = group_relaxed_sites(
+        host, sc_matrix, orm.Float(1e-3), relaxed
+    )
+    assert labels == LABELS
+    assert np.allclose(energies, ENERGIES)
+    assert representatives == ["1", "1", "2", "4"]
+
+    # 1 and 3 are 10 meV apart.
+    _, _, representatives = group_relaxed_sites(
+        host, sc_matrix, orm.Float(1e-3), relaxed, energy_tolerance=1e-3
+    )
+    assert representatives == LABELS
+
+
+def test_collect_unique_sites(relaxed_muons):
+    host, sc_matrix, uuids, relaxed = relaxed_muons
+    pruned = {"5": {"energy": -990.0, "delta_E": 10.0, "steps": 5, "uuid": "x"}}
+    outputs = collect_unique_sites(
+        structure=host,
+        sc_matrix=sc_matrix,
+        relaxations=orm.Dict(uuids),
+        symprec=orm.Float(1e-3),
+        pruned=orm.Dict(pruned),
+        **relaxed,
+    )
+    unique_sites = outputs["unique_sites"].get_dict()
+    assert sorted(unique_sites) == ["1", "2", "4"]
+    assert unique_sites["2"][1] == pytest.approx(-999.6)
+    assert unique_sites["4"][0]["sites"][-1]["species"][0]["element"] == "H"
+    assert outputs["all_index_uuid"].get_dict() == uuids
+    assert outputs["pruned_sites"].get_dict() == pruned
+
+    outputs = collect_unique_sites(
+        structure=host,
+        sc_matrix=sc_matrix,
+        relaxations=orm.Dict(uuids),
+        symprec=orm.Float(1e-3),
+        **relaxed,
+    )
+    assert "pruned_sites" not in outputs
+
+
+def test_select_screened_sites(relaxed_muons):
+    host, sc_matrix, _, relaxed = relaxed_muons
+    screening = select_screened_sites(
+        structure=host,
+        sc_matrix=sc_matrix,
+        symprec=orm.Float(1e-3),
+        screening_parameters=orm.Dict(
+            {"energy_window": 0.5, "distance_tolerance": 0.5}
+        ),
+        **relaxed,
+    )["screening"].get_dict()
+    assert sorted(screening) == sorted(LABELS)
+    # the equivalent 3 and the 4, 0.8 eV above, are not relaxed again.
+    assert {idx for idx, site in screening.items() if site["selected"]} == {"1", "2"}
+    assert screening["3"]["representative"] == "1"
+    assert screening["4"]["delta_E"] == pytest.approx(0.8)
+
+
+def test_compute_dipolar_fields(relaxed_muons):
+    from aiidalab_qe_muon.utils.dipolar import dipolar_field
+
+    host, sc_matrix, uuids, relaxed = relaxed_muons
+    unique_sites = collect_unique_sites(
+        structure=host,
+        sc_matrix=sc_matrix,
+        relaxations=orm.Dict(uuids),
+        symprec=orm.Float(1e-3),
+        **relaxed,
+    )["unique_sites"]
+    magmom = [[0.0, 0.0, 2.2], [0.0, 0.0, 2.2]]
+    fields = compute_dipolar_fields(
+        structure=host, unique_sites=unique_sites, magmom=orm.List(magmom)
+    ).get_list()
+    assert [field["idx"] for field in fields] == ["1", "2", "4"]
+
+    cell = np.array(host.cell)
+    positions = [site.position for site in host.sites]
+    for field in fields:
+        # the muons are in the first unit cell of the supercell.
+        muon = relaxed[f"structure_{field['idx']}"].sites[-1].position
+        Bdip, B_L = dipolar_field(cell, positions, magmom, muon)
+        assert np.allclose(field["Bdip"], Bdip)
+        assert np.allclose(field["B_L"], B_L)
+        assert np.allclose(field["B_T"], Bdip + B_L)
+        assert field["B_T_norm"] == pytest.approx(np.linalg.norm(Bdip + B_L))
+
+
+def test_collect_contact_fields(relaxed_muons):
+    from aiidalab_qe_muon.utils.dipolar import contact_field
+
+    host, sc_matrix, uuids, relaxed = relaxed_muons
+    unique_sites = collect_unique_sites(
+        structure=host,
+        sc_matrix=sc_matrix,
+        relaxations=orm.Dict(uuids),
+        symprec=orm.Float(1e-3),
+        **relaxed,
+    )["unique_sites"]
+    densities = {}
+    for i, idx in enumerate(["1", "4"]):
+        density = orm.ArrayData()
+        density.set_array("data", np.full((4, 4, 4), 0.01 * (i + 1)))
+        densities[f"density_{idx}"] = density
+    hyperfine = collect_contact_fields(
+        unique_sites=unique_sites, **densities
+    ).get_dict()
+    # the site 2 has no spin density.
+    assert sorted(hyperfine) == ["1", "4"]
+    assert hyperfine["4"][0] == pytest.approx(0.02)
+    assert hyperfine["4"][1] == pytest.approx(
+        contact_field(np.full((4, 4, 4), 0.02), [0.0, 0.0, 0.0])[1]
+    )
+
+
+def pw_calculation(relaxation, structure, energy, label, exit_status=502):
+    """Stored pw.x calculation called by ``relaxation``, with its outputs: by default, it
+    exceeded `nstep`."""
+    from aiida.engine import ProcessState
+
+    calculation = orm.CalcJobNode(process_type="aiida.calculations:quantumespresso.pw")
+    calculation.set_option("resources", {"num_machines": 1})
+    calculation.base.links.add_incoming(relaxation, LinkType.CALL_CALC, label)
+    calculation.store()
+    outputs = {
+        "output_structure": structure.clone(),
+        "output_parameters": orm.Dict({"energy": energy}),
+    }
+    for link_label, node in outputs.items():
+        node.base.links.add_incoming(calculation, LinkType.CREATE, link_label)
+        node.store()
+    calculation.set_process_state(ProcessState.FINISHED)
+    calculation.set_exit_status(exit_status)
+    calculation.seal()
+    return calculation
+
+
+def test_last_ionic_step(relaxed_muons):
+    _, _, _, relaxed = relaxed_muons
+    relaxation = orm.WorkflowNode().store()
+    assert last_ionic_step(relaxation) is None
+
+    pw_calculation(relaxation, relaxed["structure_1"], -999.0, "iteration_01")
+    last = pw_calculation(relaxation, relaxed["structure_2"], -999.5, "iteration_02")
+    energy, structure = last_ionic_step(relaxation)
+    assert energy == pytest.approx(-999.5)
+    assert structure.uuid == last.outputs.output_structure.uuid
+
+    # the last calculation failed for another reason than `nstep`.
+    pw_calculation(relaxation, relaxed["structure_3"], -999.7, "iteration_03", 305)
+    assert last_ionic_step(relaxation) is None
@@ -0,0 +1,200 @@
+import numpy as np
+import pytest
+from aiida import orm
+
+from aiidalab_qe_muon.utils.results import MuonResults, findmuon_outputs
+
+
+@pytest.fixture
+def count_queries(monkeypatch):
+    """Number of ``QueryBuilder`` created since the fixture was requested."""
+    queries = []
+
+    class CountingQueryBuilder(orm.QueryBuilder):
+        def __init__(self, *args, **kwargs):
+            queries.append(self)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(orm, "QueryBuilder", CountingQueryBuilder)
+    return queries
+
+
+def test_muon_results_from_findmuon(fake_findmuon, count_queries):
+    results = MuonResults.from_findmuon(findmuon_outputs(fake_findmuon))
+    assert results.labels.tolist() == ["1", "2", "4"]
+    assert np.allclose(results.energy, [-1000.0, -999.6, -999.2])
+    assert np.allclose(results.delta_E, [0.0, 0.4, 0.8])
+    # in the 2x2x2 supercell.
+    assert np.allclose(results.positions[0], [0.25, 0.125, 0.0])
+    assert np.allclose(results.norm("B_T"), [0.0, 0.1, 0.2])
+    assert np.allclose(results.hyperfine_norm, [0.0, 0.5, 1.0])
+
+    # the relaxed structures come with the energies, in one query.
+    assert results.structure("4").get_ase()[-1].symbol == "H"
+    assert len(count_queries) == 1
+
+
+def test_query_relaxation_outputs(many_relaxations, count_queries, record_property):
+    """Benchmark of the single query against the previous ``load_node`` loop."""
+    import time
+
+    from aiidalab_qe_muon.utils.results import query_relaxation_outputs
+
+    start = time.perf_counter()
+    previous = {}
+    for uuid in many_relaxations:
+        node = orm.load_node(uuid)
+        previous[uuid] = (
+            node.outputs.output_parameters["energy"],
+            node.outputs.output_structure,
+        )
+    record_property("load_node_seconds", time.perf_counter() - start)
+
+    start = time.perf_counter()
+    relaxations = query_relaxation_outputs(many_relaxations)
+    record_property("query_seconds", time.perf_counter() - start)
+
+    assert len(count_queries) == 1
+    for outputs in (previous, relaxations):
+        assert {
+            uuid: (energy, structure.pk)
+            for uuid, (energy, structure) in outputs.items()
+        } == {
+            uuid: (pytest.approx(energy), structure.pk)
+            for uuid, (energy, structure) in many_relaxations.items()
+        }
+
+
+def test_muon_results_arrays(fake_findmuon):
+    results = MuonResults.from_findmuon(findmuon_outputs(fake_findmuon))
+    restored = MuonResults.from_arrays(results.to_arrays())
+    assert restored.labels.tolist() == results.labels.tolist()
+    assert np.allclose(restored.Bdip, results.Bdip)
+    assert restored.structure("2").pk == results.structure("2").pk
+
+
+def test_export_results(fake_findmuon):
+    from aiidalab_qe_muon.utils.results import export_results
+
+    times = np.linspace(0, 20e-6, 50)
+    exported = export_results(fake_findmuon, times=times)
+    sites = exported["sites"]
+    assert sites["site"].tolist() == [1, 2, 4]
+    assert np.all(sites["run"] == fake_findmuon.pk)
+    assert np.allclose(sites["B_T_norm"], [0.0, 0.1, 0.2])
+    assert np.all(sites["second_moment"] > 0)
+    assert exported["kubo_toyabe"].shape == (3, 50)
+    assert np.allclose(exported["kubo_toyabe"][:, 0], 1.0)
+
+    assert export_results(orm.WorkflowNode().store()) is None
+
+
+def test_collect_results(fake_findmuon):
+    from aiida.manage import get_manager
+
+    from aiidalab_qe_muon.scripts.results import collect_results, to_dataframes
+
+    empty = orm.WorkflowNode().store()
+    profile = get_manager().get_profile().name
+    results, errors = collect_results(
+        [fake_findmuon.pk, empty.pk],
+        processes=2,
+        times=np.linspace(0, 1e-5, 10),
+        profile=profile,
+    )
+    assert list(errors) == [empty.pk]
+    assert len(results) == 1
+
+    sites, curves = to_dataframes(results + results)
+    assert len(sites) == 6
+    assert len(curves) == 60
+    assert curves["time"].max() == pytest.approx(10.0)
+
+
+@pytest.mark.parametrize(
+    "output, engine", [("results", "pyarrow"), ("results.h5", "tables")]
+)
+def test_write_dataframes(fake_findmuon, tmp_path, output, engine):
+    import pandas as pd
+
+    from aiidalab_qe_muon.scripts.results import to_dataframes, write_dataframes
+    from aiidalab_qe_muon.utils.results import export_results
+
+    pytest.importorskip(engine, exc_type=ImportError)
+    sites, curves = to_dataframes(
+        [export_results(fake_findmuon, times=np.linspace(0, 1e-5, 10))]
+    )
+    write_dataframes(sites, curves, tmp_path / output)
+    if engine == "pyarrow":
+        read = pd.read_parquet(tmp_path / output / "sites.parquet")
+    else:
+        read = pd.read_hdf(tmp_path / output, key="sites")
+    assert read["site"].tolist() == [1, 2, 4]
+
+
+def test_produce_collective_unit_cell(fake_findmuon):
+    from aiidalab_qe_muon.utils.results import produce_collective_unit_cell
+
+    unit_cell = produce_collective_unit_cell(findmuon_outputs(fake_findmuon))
+    assert unit_cell.tags == [None, None, "1", "2", "4"]
+    # folded from the supercells into the unit cell.
+    assert np.allclose(
+        unit_cell.frac_coords[2:], [[0.5, 0.25, 0.0], [0.5, 0.5, 0.0], [0.25] * 3]
+    )
+    structure = orm.StructureData(pymatgen=unit_cell)
+    assert structure.get_kind_names() == ["Fe", "H1", "H2", "H4"]
+    assert {kind.symbol for kind in structure.kinds[1:]} == {"H"}
+
+    with pytest.raises(ValueError, match="H2-Fe"):
+        produce_collective_unit_cell(
+            findmuon_outputs(fake_findmuon), proximity_tolerance=1.5
+        )
+
+
+def test_query_relaxed_muons(fake_findmuon):
+    from aiidalab_qe_muon.utils.results import query_relaxed_muons
+
+    all_index_uuid = findmuon_outputs(fake_findmuon).all_index_uuid.get_dict()
+    failed = orm.WorkflowNode().store()
+    relaxed = query_relaxed_muons(list(all_index_uuid.values()) + [failed.uuid])
+    assert set(relaxed) == set(all_index_uuid.values())
+    energy, cell, position = relaxed[all_index_uuid["2"]]
+    assert energy == pytest.approx(-999.6)
+    # the muon in the 2x2x2 supercell of bcc Fe, a = 2.87 A.
+    assert np.allclose(np.diag(cell), 2 * 2.87)
+    assert np.allclose(position, [1.435, 1.435, 0.0])
+
+
+def test_recluster_sites(fake_findmuon):
+    from aiidalab_qe_muon.utils.results import recluster_sites
+
+    outputs = findmuon_outputs(fake_findmuon)
+    clusters = recluster_sites(outputs)
+    # 1 and 3 are equivalent (12d sites), 2 and 4 are the 6b and 8c sites.
+    assert clusters["site"].tolist() == ["1", "2", "4"]
+    assert clusters["members"].tolist() == [2, 1, 1]
+    assert clusters["multiplicity"].tolist() == [12, 6, 8]
+    assert np.allclose(clusters["delta_E"], [0.0, 0.4, 0.8])
+    assert np.allclose(
+        np.stack([clusters[f"position_{axis}"] for axis in "xyz"], axis=1),
+        [[0.5, 0.25, 0.0], [0.5, 0.5, 0.0], [0.25, 0.25, 0.25]],
+    )
+
+    # 1 and 3 are 10 meV apart.
+    clusters = recluster_sites(outputs, energy_tolerance=1e-3)
+    assert clusters["site"].tolist() == ["1", "3", "2", "4"]
+    assert clusters["members"].tolist() == [1, 1, 1, 1]
+
+
+def test_pruned_sites(fake_findmuon, pruned_findmuon):
+    from aiidalab_qe_muon.utils.results import pruned_sites
+
+    pruned = pruned_sites(findmuon_outputs(pruned_findmuon))
+    assert pruned["site"].tolist() == ["5", "6"]
+    assert np.allclose(pruned["delta_E"], [1.4, 2.0])
+    assert pruned["steps"].tolist() == [3, 3]
+    # with respect to the lowest relaxed site.
+    pruned = pruned_sites(findmuon_outputs(pruned_findmuon), -1000.0)
+    assert np.allclose(pruned["delta_E"], [1.5, 2.0])
+
+    assert len(pruned_sites(findmuon_outputs(fake_findmuon))["site"]) == 0
@@ -0,0 +1,94 @@
+"""The widgets of the results panel are built from the ``MuonResults``."""
+import pytest
+
+panel = pytest.importorskip("aiidalab_qe.common.panel")
+if not hasattr(panel, "OutlinePanel"):
+    pytest.skip("aiidalab-qe without the OutlinePanel API", allow_module_level=True)
+
+
+@pytest.fixture
+def results(fake_findmuon):
+    from aiidalab_qe_muon.utils.results import MuonResults, findmuon_outputs
+
+    return MuonResults.from_findmuon(findmuon_outputs(fake_findmuon))
+
+
+def test_single_muon_structure_bar_widget(results):
+    from aiidalab_qe_muon.app.utils_results import SingleMuonStructureBarWidget
+
+    widget = SingleMuonStructureBarWidget(results, "1")
+    assert widget.muon_index_list == ["1", "2", "4"]
+    assert len(widget.children) == 2
+    widget.children[0].children[1].value = "4"
+    assert widget.child3.selected == "4"
+
+
+def test_summary_muon_structure_bar_widget(results, fake_findmuon):
+    from aiida import orm
+
+    from aiidalab_qe_muon.app.utils_results import SummaryMuonStructureBarWidget
+    from aiidalab_qe_muon.utils.results import (
+        findmuon_outputs,
+        produce_collective_unit_cell,
+    )
+
+    unit_cell = produce_collective_unit_cell(findmuon_outputs(fake_findmuon))
+    widget = SummaryMuonStructureBarWidget(
+        orm.StructureData(pymatgen=unit_cell), results=results, tags=unit_cell.tags
+    )
+    assert widget.muon_index_list == ["1", "2", "4"]
+    assert set(widget.KT_asymmetry.KT) == {"1", "2", "4"}
+    widget.dropdown.value = "2"
+    assert widget.child2.selected == "2"
+
+
+def test_pruned_sites_in_tables(pruned_findmuon):
+    from aiidalab_qe_muon.app.utils_results import (
+        MuonSummaryTableWidget,
+        ReclusteringWidget,
+    )
+    from aiidalab_qe_muon.utils.results import (
+        MuonResults,
+        findmuon_outputs,
+        pruned_sites,
+    )
+
+    findmuon = findmuon_outputs(pruned_findmuon)
+    results = MuonResults.from_findmuon(findmuon)
+    table = MuonSummaryTableWidget(
+        results.to_dataframe(), pruned=pruned_sites(findmuon, results.energy[0])
+    )
+    html = table.children[0].children[1].value
+    assert "5 (pruned after 3 steps)" in html
+    assert html.index("5 (pruned") < html.index("6 (pruned")
+
+    reclustering = ReclusteringWidget(findmuon)
+    reclustering.button.click()
+    assert "6 (pruned after 3 steps)" in reclustering.table.value
+
+
+def test_recompute_results(fake_findmuon):
+    """The recompute button discards the cached results of the run."""
+    from unittest import mock
+
+    from aiidalab_qe_muon.app.result import Result
+    from aiidalab_qe_muon.utils.cache import get_result_cache
+    from aiidalab_qe_muon.utils.results import findmuon_outputs
+
+    findmuon = findmuon_outputs(fake_findmuon)
+    node = mock.MagicMock()
+    node.outputs.__contains__.side_effect = lambda key: key == "muonic"
+    node.outputs.muonic.__contains__.side_effect = lambda key: key == "findmuon"
+    node.outputs.muonic.findmuon = findmuon
+    panel = Result(node=node)
+    panel._update_view()
+    cache, key = get_result_cache(), findmuon.unique_sites.uuid
+    assert cache.get(key) is not None
+
+    recompute_button = panel.children[-1]
+    with mock.patch.object(Result, "_update_view") as update_view:
+        recompute_button.click()
+    assert cache.get(key) is None
+    update_view.assert_called_once()
+    recompute_button.click()
+    assert cache.get(key) is not None
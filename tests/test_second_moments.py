@@ -0,0 +1,98 @@
+"""Parity of the second moments with the previous implementation, one ase neighbor list
+per species."""
+import numpy as np
+import pytest
+from ase import Atoms
+from ase.build import bulk
+from ase.neighborlist import neighbor_list
+
+from aiidalab_qe_muon.utils.isotopes import isotope_average
+from aiidalab_qe_muon.utils.second_moments import (
+    converged_inverse_sixth_sums,
+    factor,
+    inverse_sixth_sums,
+    second_moments,
+)
+
+
+def reference_second_moments(atms, cutoff):
+    """The previous ``compute_second_moments``, with a single cutoff."""
+    numbers = atms.get_atomic_numbers()
+    tot_H = np.count_nonzero(numbers == 1)
+    moments = {}
+    for e in np.unique(numbers):
+        if e == 1:
+            continue
+        distances = neighbor_list("d", atms, cutoff={(1, e): cutoff})
+        moments[e] = isotope_average(e) * 0.5 * np.sum(distances**-6) * factor / tot_H
+    return moments
+
+
+def copper_octahedral():
+    atms = bulk("Cu", "fcc", a=3.61, cubic=True).repeat((2, 2, 2))
+    atms += Atoms("H", positions=[[1.805, 1.805, 1.805]])
+    return atms
+
+
+def rocksalt_two_muons():
+    atms = bulk("NaCl", "rocksalt", a=5.64).repeat((2, 1, 1))
+    atms += Atoms("H2", positions=[[1.41, 1.41, 1.41], [4.23, 1.41, 4.23]])
+    return atms
+
+
+def triclinic_rattled():
+    rng = np.random.default_rng(0)
+    cell = np.array([[4.1, 0.0, 0.0], [0.9, 3.7, 0.0], [0.6, -0.8, 5.2]])
+    atms = Atoms("Fe2OFH", scaled_positions=rng.random((5, 3)), cell=cell, pbc=True)
+    return atms
+
+
+@pytest.mark.parametrize(
+    "build", [copper_octahedral, rocksalt_two_muons, triclinic_rattled]
+)
+@pytest.mark.parametrize("cutoff", [6.0, 12.0])
+def test_parity_with_neighbor_list(build, cutoff):
+    atms = build()
+    reference = reference_second_moments(atms, cutoff)
+    _, moments = second_moments(
+        atms.cell.array, atms.positions, atms.get_atomic_numbers(), cutoff=cutoff
+    )
+
+    assert set(moments) == set(reference)
+    for e, value in reference.items():
+        assert moments[e][-1] == pytest.approx(value, rel=1e-12)
+
+
+def test_cutoff_per_species():
+    atms = rocksalt_two_muons()
+    _, moments = second_moments(
+        atms.cell.array,
+        atms.positions,
+        atms.get_atomic_numbers(),
+        cutoff=12.0,
+        cutoff_distances={11: 6.0},
+    )
+    assert moments[11][-1] == pytest.approx(
+        reference_second_moments(atms, 6.0)[11], rel=1e-12
+    )
+    assert moments[17][-1] == pytest.approx(
+        reference_second_moments(atms, 12.0)[17], rel=1e-12
+    )
+
+
+
+@pytest.mark.parametrize("build", [copper_octahedral, rocksalt_two_muons])
+@pytest.mark.parametrize("tolerance", [1e-3, 1e-4])
+def test_converged_against_large_cutoff(build, tolerance):
+    atms = build()
+    numbers = atms.get_atomic_numbers()
+    args = atms.cell.array, atms.positions, numbers, atms.positions[numbers == 1]
+    species, radii, sums = converged_inverse_sixth_sums(
+        *args, tolerance=tolerance, exclude=(1,)
+    )
+    _, reference = inverse_sixth_sums(*args, cutoff=40.0)
+
+    # converged well before the fixed cutoff, for every muon and host species.
+    assert radii[-1] < 40.0
+    host = species != 1
+    np.testing.assert_allclose(sums[-1][:, host], reference[:, host], rtol=tolerance)
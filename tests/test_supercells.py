@@ -0,0 +1,185 @@
+import itertools
+import sys
+
+import numpy as np
+import pytest
+from ase.build import bulk
+
+from aiidalab_qe_muon.utils.supercells import (
+    candidate_positions,
+    estimate_number_of_supercells,
+    inequivalent_candidate_positions,
+    minimal_supercell,
+    number_of_supercells,
+    shortest_image_distance,
+)
+
+
+def hermite_normal_forms(det):
+    """All the (lower triangular) Hermite normal form matrices of determinant ``det``.
+
+    The rows are the lattice vectors of the supercell:
+    ``[[a, 0, 0], [b, c, 0], [d, e, f]]`` with ``a c f = det``, ``0 <= b < a``,
+    ``0 <= d < a`` and ``0 <= e < c`` (each off-diagonal entry is reduced by the row
+    above it). Each sublattice of index ``det`` of the unit cell lattice corresponds to
+    exactly one of them.
+
+    :return: (n, 3, 3) integer array.
+    """
+    forms = []
+    for a in range(1, det + 1):
+        if det % a:
+            continue
+        for c in range(1, det // a + 1):
+            if (det // a) % c:
+                continue
+            f = det // (a * c)
+            b, d, e = np.meshgrid(
+                np.arange(a), np.arange(a), np.arange(c), indexing="ij"
+            )
+            block = np.zeros(b.shape + (3, 3), dtype=int)
+            block[..., 0, 0], block[..., 1, 1], block[..., 2, 2] = a, c, f
+            block[..., 1, 0], block[..., 2, 0], block[..., 2, 1] = b, d, e
+            forms.append(block.reshape(-1, 3, 3))
+    return np.concatenate(forms)
+
+
+def sublattice_keys(matrices, det):
+    """The points of the box [0, det)^3 in each sublattice.
+
+    The sublattice contains det Z^3, so they identify it.
+    """
+    matrices = np.asarray(matrices, dtype=np.int32)
+    r1, r2, r3 = matrices[:, 0], matrices[:, 1], matrices[:, 2]
+    # p = x @ M with integer x iff p @ adj(M) = 0 mod det.
+    adjugates = np.stack(
+        [np.cross(r2, r3), np.cross(r3, r1), np.cross(r1, r2)], axis=-1
+    )
+    box = np.array(list(itertools.product(range(det), repeat=3)), dtype=np.int32)
+    member = np.all(np.einsum("pi,nij->npj", box, adjugates) % det == 0, axis=-1)
+    return {row.tobytes() for row in member}
+
+
+def brute_force_sublattices(det):
+    """All the sublattices of index det, from every matrix with entries in [0, det].
+
+    The order of the rows does not matter.
+    """
+    vectors = np.array(
+        list(itertools.product(range(det + 1), repeat=3)), dtype=np.int32
+    )
+    matrices = vectors[np.array(list(itertools.combinations(range(len(vectors)), 3)))]
+    determinants = np.einsum(
+        "ni,ni->n", matrices[:, 0], np.cross(matrices[:, 1], matrices[:, 2])
+    )
+    return sublattice_keys(matrices[np.abs(determinants) == det], det)
+
+
+def brute_force_minimal_supercell(cell, min_distance):
+    """Number of unit cells and shortest muon-image distance, over every sublattice."""
+    det = 1
+    while True:
+        distance = max(
+            shortest_image_distance(cell, form) for form in hermite_normal_forms(det)
+        )
+        if distance >= min_distance:
+            return det, distance
+        det += 1
+
+
+@pytest.mark.parametrize("det, count", [(1, 1), (2, 7), (3, 13), (4, 35)])
+def test_hermite_normal_forms(det, count):
+    forms = hermite_normal_forms(det)
+    assert len(forms) == count
+    assert np.all(np.rint(np.linalg.det(forms)) == det)
+    keys = sublattice_keys(forms, det)
+    assert len(keys) == count
+    assert keys == brute_force_sublattices(det)
+
+
+@pytest.mark.parametrize(
+    "atoms, min_distance, det, distance",
+    [
+        (bulk("NaCl", "rocksalt", a=5.64, cubic=True), 6.0, 2, 7.976),
+        (bulk("NaCl", "rocksalt", a=5.64, cubic=True), 9.0, 4, 9.769),
+        (bulk("Cu"), 9.0, 51, None),
+        (bulk("Fe"), 9.0, 52, None),
+        (bulk("Si"), 9.0, 16, None),
+    ],
+)
+def test_minimal_supercell(atoms, min_distance, det, distance):
+    matrix, shortest = minimal_supercell(atoms.cell.array, min_distance)
+    assert round(np.linalg.det(matrix)) == det
+    assert shortest >= min_distance
+    assert shortest == pytest.approx(shortest_image_distance(atoms.cell.array, matrix))
+    if distance is not None:
+        assert shortest == pytest.approx(distance, abs=1e-3)
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_minimal_supercell_against_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    cell = np.diag(rng.uniform(3.0, 5.0, 3)) + rng.uniform(-1.0, 1.0, (3, 3))
+    min_distance = rng.uniform(5.0, 7.0)
+    matrix, shortest = minimal_supercell(cell, min_distance)
+    det, distance = brute_force_minimal_supercell(cell, min_distance)
+    assert round(np.linalg.det(matrix)) == det
+    assert shortest == pytest.approx(distance)
+
+
+def test_minimal_supercell_large():
+    # too many sublattices for the brute force: the smaller determinants have none.
+    cell = bulk("Cu").cell.array
+    matrix, shortest = minimal_supercell(cell, 12.0)
+    assert round(np.linalg.det(matrix)) == 120
+    assert shortest == pytest.approx(12.242, abs=1e-3)
+    assert np.linalg.norm(matrix @ cell, axis=1).min() == pytest.approx(shortest)
+    with pytest.raises(ValueError):
+        minimal_supercell(cell, 12.0, max_det=119)
+
+
+def test_minimal_supercell_max_det():
+    with pytest.raises(ValueError):
+        minimal_supercell(bulk("Cu").cell.array, 9.0, max_det=50)
+    matrix, _ = minimal_supercell(bulk("Cu").cell.array, 9.0, max_det=51)
+    assert round(np.linalg.det(matrix)) == 51
+
+
+@pytest.fixture
+def iron(aiida_profile):
+    from aiida import orm
+
+    return orm.StructureData(ase=bulk("Fe", cubic=True))
+
+
+def test_number_of_supercells_sites(iron):
+    cell, positions = iron.cell, [site.position for site in iron.sites]
+    frac, _ = candidate_positions(cell, positions, 0.7)
+    assert number_of_supercells(iron, 0.7, driver="sites") == (len(frac), True)
+
+    number, exact = number_of_supercells(iron, 0.7, driver="sites", prune_symmetry=True)
+    _, multiplicities = inequivalent_candidate_positions(cell, positions, [0, 0], 0.7)
+    assert exact
+    assert number == len(multiplicities) < len(frac)
+    assert multiplicities.sum() == len(frac)
+
+
+def test_number_of_supercells_without_niche(iron, monkeypatch):
+    monkeypatch.setitem(sys.modules, "aiida_muon", None)
+    positions = [site.position for site in iron.sites]
+    assert number_of_supercells(iron, 0.7) == (
+        estimate_number_of_supercells(iron.cell, positions, 0.7, mode="exact"),
+        False,
+    )
+
+
+def test_number_of_supercells_niche(iron):
+    """The count of the findmuon driver is the one of the ``FindMuonWorkChain``."""
+    sitegen_tools = pytest.importorskip("aiida_muon.utils.sitegen_tools")
+    candidates = sitegen_tools.niche_add_impurities(
+        iron.get_pymatgen_structure(),
+        niche_atom="H",
+        niche_spacing=0.7,
+        niche_distance=1.0,
+    )
+    assert number_of_supercells(iron, 0.7) == (len(candidates), True)